@@ -0,0 +1,545 @@
+''' Rough timings for the slow parts of the OpenTrails converter.
+
+    Run from the top of the repository, like tests.py:
+
+        python benchmarks.py
+
+    The pipeline suite times every stage of converting segments, from
+    unzipping an upload to packaging the OpenTrails download, on datasets
+    scaled up from the fixtures. Save a report, then compare later runs
+    with it to catch stages that have gotten slower or bigger:
+
+        python benchmarks.py pipeline --sizes 1000,100000 --report baseline.json
+        python benchmarks.py pipeline --sizes 1000,100000 --baseline baseline.json
+'''
+from shutil import rmtree, copy
+from os.path import join, basename, splitext
+from tempfile import mkdtemp, TemporaryFile
+from timeit import default_timer
+from subprocess import CalledProcessError
+from contextlib import contextmanager
+from StringIO import StringIO
+from struct import pack
+from glob import glob
+from math import ceil, sqrt
+from multiprocessing import cpu_count, Process, Queue
+import os, sys, csv, json, time, random, zipfile, platform, resource, traceback, argparse
+
+from open_trails import transformers
+from open_trails.functions import (
+    unzipped, make_named_trails, iter_geojson_chunks, zip_file_chunks, record_artifact,
+    get_dataset, build_opentrails_archive
+    )
+from open_trails.validators import check_open_trails
+from open_trails.topology import make_connected_named_trails
+from open_trails.models import FilesystemDatastore
+
+segment_fixtures = ('test-files/Boulder_County_Trails.zip',
+                    'test-files/santa-clara-segments.zip')
+
+def best_time(repeat, function, *args, **kwargs):
+    ''' Return the fastest of several wall-clock timings for a function call.
+    '''
+    times = []
+
+    for i in range(repeat):
+        start = default_timer()
+        function(*args, **kwargs)
+        times.append(default_timer() - start)
+
+    return min(times)
+
+def load_shapefile(zip_path, tmp):
+    ''' Return GeoJSON data for a zipped shapefile fixture.
+    '''
+    copy(zip_path, tmp)
+
+    with unzipped(join(tmp, basename(zip_path))) as shapefile_path:
+        return transformers.shapefile2geojson(shapefile_path)
+
+def benchmark_segments_transform(repeat=5):
+    ''' Time segments_transform() on the larger segment fixtures.
+    '''
+    tmp = mkdtemp(prefix='plats-bench-')
+
+    try:
+        for zip_path in segment_fixtures:
+            geojson = load_shapefile(zip_path, tmp)
+            count = len(geojson['features'])
+
+            for workers in sorted(set([1, cpu_count()])):
+                elapsed = best_time(repeat, transformers.segments_transform, geojson, None, workers, 250)
+
+                print '{0}: segments_transform with {4} workers, {1} features in {2:.4f} sec ({3:.1f} usec/feature)'.format(
+                    basename(zip_path), count, elapsed, elapsed * 1e6 / max(count, 1), workers)
+    finally:
+        rmtree(tmp)
+
+def benchmark_named_trails(repeat=5):
+    ''' Compare named trails by name alone with connected runs of segments.
+    '''
+    tmp = mkdtemp(prefix='plats-bench-')
+
+    try:
+        for zip_path in segment_fixtures:
+            geojson = load_shapefile(zip_path, tmp)
+            messages, converted = transformers.segments_transform(geojson, None)
+            features = converted['features']
+            count = len(features)
+
+            elapsed = best_time(repeat, make_named_trails, features)
+            print '{0}: make_named_trails, {1} features in {2:.4f} sec ({3:.1f} usec/feature), {4} named trails'.format(
+                basename(zip_path), count, elapsed, elapsed * 1e6 / max(count, 1), len(make_named_trails(features)))
+
+            for tolerance in (1, 10):
+                elapsed = best_time(repeat, make_connected_named_trails, features, tolerance)
+                trails = make_connected_named_trails(features, tolerance)
+                print '{0}: make_connected_named_trails at {5}m, {1} features in {2:.4f} sec ({3:.1f} usec/feature), {4} named trails'.format(
+                    basename(zip_path), count, elapsed, elapsed * 1e6 / max(count, 1), len(trails), tolerance)
+    finally:
+        rmtree(tmp)
+
+def benchmark_shapefile2geojson(repeat=3):
+    ''' Compare in-process shapefile reading with the ogr2ogr subprocess.
+    '''
+    tmp = mkdtemp(prefix='plats-bench-')
+
+    try:
+        for zip_path in sorted(glob('test-files/*.zip')):
+            copy(zip_path, tmp)
+
+            with unzipped(join(tmp, basename(zip_path))) as shapefile_path:
+                if shapefile_path is None:
+                    continue
+
+                for engine in ('python', 'ogr2ogr'):
+                    try:
+                        elapsed = best_time(repeat, transformers.shapefile2geojson, shapefile_path, engine)
+                    except (OSError, CalledProcessError, NotImplementedError), e:
+                        print '{0}: shapefile2geojson with {1} failed: {2}'.format(basename(zip_path), engine, e)
+                    else:
+                        print '{0}: shapefile2geojson with {1} in {2:.4f} sec'.format(basename(zip_path), engine, elapsed)
+    finally:
+        rmtree(tmp)
+
+def benchmark_filelist(datasets=10000, files=10, repeat=5):
+    ''' Time listing one dataset's files in a datastore with many of them.
+    '''
+    tmp = mkdtemp(prefix='plats-bench-')
+
+    try:
+        for index in range(datasets):
+            dirname = join(tmp, '{0:08x}'.format(index), 'uploads')
+            os.makedirs(dirname)
+
+            for number in range(files):
+                open(join(dirname, 'file-{0}'.format(number)), 'w').close()
+
+        datastore = FilesystemDatastore(tmp)
+        prefix = '{0:08x}/'.format(datasets // 2)
+
+        for (name, function) in (('filelist', lambda: list(datastore.filelist(prefix))),
+                                 ('os.walk', lambda: list(_walk_filelist(tmp, prefix)))):
+            elapsed = best_time(repeat, function)
+            print '{0} files: {1} of one dataset in {2:.4f} sec'.format(datasets * files, name, elapsed)
+    finally:
+        rmtree(tmp)
+
+def _walk_filelist(dirpath, prefix):
+    ''' Generate file names the way FilesystemDatastore.filelist() used to.
+    '''
+    for dirname, dirnames, filenames in os.walk(dirpath):
+        for filename in filenames:
+            name = os.path.relpath(join(dirname, filename), dirpath)
+            if name.startswith(prefix):
+                yield name
+
+def scale_features(features, count, jitter=1e-5, seed=0):
+    ''' Generate count features by tiling copies of a fixture's features.
+
+        Each copy after the first is moved over by the size of the fixture,
+        so copies don't overlap, and its positions are nudged by up to
+        jitter degrees so repeated geometries aren't identical.
+    '''
+    xs, ys = [], []
+
+    for feature in features:
+        for line in _shape_parts(feature['geometry']):
+            xs.extend([x for (x, y) in line])
+            ys.extend([y for (x, y) in line])
+
+    width, height = (max(xs) - min(xs)) * 1.1, (max(ys) - min(ys)) * 1.1
+    columns = int(ceil(sqrt(ceil(count / float(len(features))))))
+    rand = random.Random(seed)
+
+    for index in xrange(count):
+        replica, feature = divmod(index, len(features))
+        feature = features[feature]
+
+        if replica == 0 or feature['geometry'] is None:
+            yield feature
+            continue
+
+        dx, dy = (replica % columns) * width, (replica // columns) * height
+
+        def move(position):
+            return [position[0] + dx + rand.uniform(-jitter, jitter),
+                    position[1] + dy + rand.uniform(-jitter, jitter)]
+
+        geometry = feature['geometry']
+
+        if geometry['type'] == 'Point':
+            coordinates = move(geometry['coordinates'])
+        elif geometry['type'] == 'LineString':
+            coordinates = map(move, geometry['coordinates'])
+        else:
+            coordinates = [map(move, line) for line in geometry['coordinates']]
+
+        yield dict(feature, geometry=dict(type=geometry['type'], coordinates=coordinates))
+
+def write_zipped_shapefile(zip_path, features):
+    ''' Write point or line features to a zipped, unprojected shapefile.
+
+        Property types are kept only as far as the pipeline cares: whole
+        numbers and decimals become numeric fields, and the rest text.
+    '''
+    features = list(features)
+    tmp = mkdtemp(prefix='plats-bench-shp-')
+
+    try:
+        base = join(tmp, splitext(basename(zip_path))[0])
+        _write_shp(base, [feature['geometry'] for feature in features])
+        _write_dbf(base + '.dbf', [feature['properties'] for feature in features])
+
+        with open(base + '.cpg', 'w') as file:
+            file.write('UTF-8')
+
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for ext in ('.shp', '.shx', '.dbf', '.cpg'):
+                zf.write(base + ext, basename(base + ext))
+    finally:
+        rmtree(tmp)
+
+def _shape_parts(geometry):
+    ''' Return a list of lists of positions for a point or line geometry.
+    '''
+    if geometry is None:
+        return []
+    elif geometry['type'] == 'Point':
+        return [[geometry['coordinates']]]
+    elif geometry['type'] == 'LineString':
+        return [geometry['coordinates']]
+    elif geometry['type'] == 'MultiLineString':
+        return geometry['coordinates']
+
+    raise ValueError('Unsupported geometry type {0}'.format(geometry['type']))
+
+def _write_shp(base, geometries):
+    ''' Write .shp and .shx files for a list of point or line geometries.
+    '''
+    types = set([geometry['type'] for geometry in geometries if geometry])
+    shape_type = 1 if types == set(['Point']) else 3
+    records, xs, ys = [], [], []
+
+    for geometry in geometries:
+        parts = _shape_parts(geometry)
+        points = [position[:2] for part in parts for position in part]
+        xs.extend([x for (x, y) in points])
+        ys.extend([y for (x, y) in points])
+
+        if not parts:
+            records.append(pack('<i', 0))
+        elif shape_type == 1:
+            records.append(pack('<i2d', 1, *points[0]))
+        else:
+            box = (min([x for (x, y) in points]), min([y for (x, y) in points]),
+                   max([x for (x, y) in points]), max([y for (x, y) in points]))
+            starts = [0]
+
+            for part in parts[:-1]:
+                starts.append(starts[-1] + len(part))
+
+            records.append(pack('<i4d2i', 3, *(box + (len(parts), len(points))))
+                           + pack('<{0}i'.format(len(starts)), *starts)
+                           + pack('<{0}d'.format(len(points) * 2), *[n for point in points for n in point]))
+
+    box = (min(xs), min(ys), max(xs), max(ys)) if xs else (0, 0, 0, 0)
+
+    def header(length):
+        return pack('>i5ii', 9994, 0, 0, 0, 0, 0, length / 2) + pack('<2i4d4d', 1000, shape_type, *(box + (0, 0, 0, 0)))
+
+    with open(base + '.shp', 'wb') as shp, open(base + '.shx', 'wb') as shx:
+        shp.write(header(100 + sum([8 + len(record) for record in records])))
+        shx.write(header(100 + 8 * len(records)))
+        offset = 100
+
+        for (number, record) in enumerate(records, 1):
+            shp.write(pack('>2i', number, len(record) / 2) + record)
+            shx.write(pack('>2i', offset / 2, len(record) / 2))
+            offset += 8 + len(record)
+
+def _write_dbf(path, properties):
+    ''' Write a .dbf file of UTF-8 text and numeric fields for a list of property dicts.
+    '''
+    names = sorted(set([name for props in properties for name in props]))
+    fields, rows = [], [[] for props in properties]
+
+    for name in names:
+        values = [props.get(name) for props in properties]
+        kinds = set([type(value) for value in values if value is not None])
+
+        if kinds and kinds <= set([int, long]):
+            kind, decimals, strings = 'N', 0, [value is not None and str(value) or '' for value in values]
+        elif kinds and kinds <= set([int, long, float]):
+            kind, decimals, strings = 'N', 1, [value is not None and repr(float(value)) or '' for value in values]
+        else:
+            kind, decimals = 'C', 0
+            strings = [value is not None and unicode(value).encode('utf8')[:254] or '' for value in values]
+
+        length = max([len(string) for string in strings] + [1])
+        fields.append((name.encode('ascii')[:10], kind, length, decimals))
+
+        for (row, string) in zip(rows, strings):
+            row.append(string.rjust(length) if kind == 'N' else string.ljust(length))
+
+    record_length = 1 + sum([length for (name, kind, length, decimals) in fields])
+    header_length = 32 + 32 * len(fields) + 1
+    year, month, day = time.localtime()[:3]
+
+    with open(path, 'wb') as dbf:
+        dbf.write(pack('<4BIHH20x', 3, year - 1900, month, day, len(rows), header_length, record_length))
+
+        for (name, kind, length, decimals) in fields:
+            dbf.write(pack('<11sc4xBB14x', name, kind, length, decimals))
+
+        dbf.write('\r')
+
+        for row in rows:
+            dbf.write(' ' + ''.join(row))
+
+        dbf.write('\x1a')
+
+def max_rss_kb():
+    ''' Return the most memory this process has used so far, in kilobytes.
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Mac OS X counts bytes instead of kilobytes.
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+@contextmanager
+def timed_stage(stages, name):
+    ''' Time a block of code, and add its timing and memory use to a list of stages.
+
+        Peak memory only ever grows, so growth is how much a stage added
+        to the highest point reached by the stages before it.
+    '''
+    start, rss = default_timer(), max_rss_kb()
+    yield
+    stages.append(dict(stage=name, seconds=round(default_timer() - start, 4),
+                       max_rss_kb=max_rss_kb(), max_rss_growth_kb=max_rss_kb() - rss))
+
+def write_scaled_fixture(fixture_path, count, zip_path):
+    ''' Write a zipped shapefile of count features scaled up from a fixture.
+    '''
+    tmp = mkdtemp(prefix='plats-bench-')
+
+    try:
+        copy(fixture_path, tmp)
+
+        with unzipped(join(tmp, basename(fixture_path))) as shapefile_path:
+            fixture = transformers.shapefile2geojson(shapefile_path)
+
+        write_zipped_shapefile(zip_path, scale_features(fixture['features'], count))
+    finally:
+        rmtree(tmp)
+
+def benchmark_pipeline(zip_path):
+    ''' Return timings for each stage of converting a zipped shapefile of segments.
+    '''
+    tmp = mkdtemp(prefix='plats-bench-')
+    stages = []
+
+    try:
+        copy(zip_path, tmp)
+        zip_path = join(tmp, basename(zip_path))
+
+        # Unzipped files stay around just long enough to be read.
+        with timed_stage(stages, 'unzip'):
+            unzipping = unzipped(zip_path)
+            shapefile_path = unzipping.__enter__()
+
+        try:
+            with timed_stage(stages, 'shapefile2geojson'):
+                geojson = transformers.shapefile2geojson(shapefile_path)
+        finally:
+            unzipping.__exit__(None, None, None)
+
+        with timed_stage(stages, 'transform'):
+            messages, converted = transformers.segments_transform(geojson, None)
+            del geojson
+
+        with timed_stage(stages, 'json dump'):
+            segments_data = ''.join(iter_geojson_chunks(converted['features'], sort_keys=True))
+
+        with timed_stage(stages, 'zip'):
+            segments_zip = TemporaryFile()
+            zip_file_chunks(segments_zip, [segments_data], 'segments.geojson')
+
+        with timed_stage(stages, 'named trails'):
+            named_trails = make_named_trails(converted['features'])
+            named_trails_data = _csv_data(['id', 'name', 'segment_ids', 'description', 'part_of'],
+                                          [[(row[c] or '').encode('utf8') for c in ('id', 'name', 'segment_ids', 'description', 'part_of')]
+                                           for row in named_trails])
+            del converted
+
+        stewards_data = _csv_data(['name', 'id', 'url', 'phone', 'address', 'publisher', 'license'],
+                                  [['Benchmarks', '0', '', '', '', 'no', 'CC0']])
+
+        datastore = FilesystemDatastore(join(tmp, 'datastore'))
+        dataset_id = 'benchmark'
+        datastore.write('{0}/uploads/.valid'.format(dataset_id), StringIO(dataset_id))
+
+        with timed_stage(stages, 'datastore write'):
+            for (name, data) in (('opentrails/segments.geojson.zip', segments_zip),
+                                 ('opentrails/named_trails.csv', StringIO(named_trails_data)),
+                                 ('opentrails/stewards.csv', StringIO(stewards_data))):
+                written = datastore.write('{0}/{1}'.format(dataset_id, name), data)
+                record_artifact(datastore, dataset_id, name, written)
+
+        local_dir = join(tmp, 'validate')
+        os.mkdir(local_dir)
+
+        for (name, data) in (('trail_segments.geojson', segments_data),
+                             ('named_trails.csv', named_trails_data), ('stewards.csv', stewards_data)):
+            with open(join(local_dir, name), 'w') as file:
+                file.write(data.encode('utf8') if type(data) is unicode else data)
+
+        del segments_data
+
+        with timed_stage(stages, 'validate'):
+            check_open_trails(*[join(local_dir, name) for name in ('trail_segments.geojson', 'named_trails.csv',
+                                                                   'trailheads.geojson', 'stewards.csv', 'areas.geojson')])
+
+        with timed_stage(stages, 'package'):
+            build_opentrails_archive(get_dataset(datastore, dataset_id))
+
+    finally:
+        rmtree(tmp)
+
+    return stages
+
+def _csv_data(columns, rows):
+    ''' Return CSV text with a header row.
+    '''
+    file = StringIO()
+    writer = csv.writer(file)
+    writer.writerow(columns)
+    writer.writerows(rows)
+    return file.getvalue()
+
+def run_in_process(function, *args):
+    ''' Return the result of a function called in a new process, so memory use starts fresh.
+    '''
+    queue = Queue()
+    process = Process(target=_put_result, args=(queue, function) + args)
+    process.start()
+    failed, result = queue.get()
+    process.join()
+
+    if failed:
+        raise RuntimeError('{0} failed:\n{1}'.format(function.__name__, result))
+
+    return result
+
+def _put_result(queue, function, *args):
+    try:
+        queue.put((False, function(*args)))
+    except:
+        queue.put((True, traceback.format_exc()))
+
+def benchmark_pipelines(sizes, fixtures=segment_fixtures):
+    ''' Return a report of pipeline timings for each fixture scaled to each size.
+    '''
+    runs, tmp = [], mkdtemp(prefix='plats-bench-')
+
+    try:
+        for fixture_path in fixtures:
+            for count in sizes:
+                # Scaled fixtures are made in a process of their own, so
+                # the memory they take doesn't count against the pipeline.
+                zip_path = join(tmp, 'scaled-{0}.zip'.format(count))
+                run_in_process(write_scaled_fixture, fixture_path, count, zip_path)
+                stages = run_in_process(benchmark_pipeline, zip_path)
+                runs.append(dict(fixture=basename(fixture_path), features=count, stages=stages))
+                os.remove(zip_path)
+
+                for stage in stages:
+                    print '{0}: {1} with {2} features in {3:.4f} sec, max RSS {4:,} KB (+{5:,} KB)'.format(
+                        basename(fixture_path), stage['stage'], count, stage['seconds'], stage['max_rss_kb'], stage['max_rss_growth_kb'])
+    finally:
+        rmtree(tmp)
+
+    return dict(created=int(time.time()), python=platform.python_version(),
+                platform=platform.platform(), cpus=cpu_count(), runs=runs)
+
+def find_regressions(report, baseline, threshold=1.5, min_seconds=0.1, min_rss_kb=16384):
+    ''' Return a list of descriptions of stages that got slower or bigger than a baseline report.
+
+        A stage regresses when it's more than threshold times its baseline,
+        and also worse by more than min_seconds or min_rss_kb so that tiny,
+        noisy stages don't count. Runs missing from the baseline are skipped.
+    '''
+    baseline_stages = dict([((run['fixture'], run['features'], stage['stage']), stage)
+                            for run in baseline['runs'] for stage in run['stages']])
+    regressions = []
+
+    for run in report['runs']:
+        for stage in run['stages']:
+            old = baseline_stages.get((run['fixture'], run['features'], stage['stage']))
+
+            if old is None:
+                continue
+
+            for (key, minimum, unit) in (('seconds', min_seconds, 'sec'), ('max_rss_kb', min_rss_kb, 'KB')):
+                if stage[key] > old[key] * threshold and stage[key] - old[key] > minimum:
+                    regressions.append('{0}: {1} with {2} features took {3:,} {5}, up from {4:,} {5}'.format(
+                        run['fixture'], stage['stage'], run['features'], stage[key], old[key], unit))
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the slow parts of the OpenTrails converter.')
+    parser.add_argument('suite', nargs='?', choices=('micro', 'pipeline'), default='micro',
+                        help='Benchmarks of single functions, or of the whole conversion pipeline.')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='Comma-separated feature counts to scale pipeline fixtures to.')
+    parser.add_argument('--report', help='Write a JSON report of pipeline timings to this file.')
+    parser.add_argument('--baseline', help='Fail if pipeline stages regress from this JSON report.')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='Ratio to the baseline above which a stage has regressed.')
+
+    args = parser.parse_args()
+
+    if args.suite == 'micro':
+        benchmark_shapefile2geojson()
+        benchmark_segments_transform()
+        benchmark_named_trails()
+        benchmark_filelist()
+
+    else:
+        report = benchmark_pipelines([int(size) for size in args.sizes.split(',')])
+
+        if args.report:
+            with open(args.report, 'w') as file:
+                json.dump(report, file, indent=2, sort_keys=True)
+
+        if args.baseline:
+            with open(args.baseline) as file:
+                regressions = find_regressions(report, json.load(file), args.threshold)
+
+            for regression in regressions:
+                print >> sys.stderr, 'Regression:', regression
+
+            if regressions:
+                sys.exit(1)
@@ -1,29 +1,91 @@
 from open_trails import app
 from werkzeug.utils import secure_filename
-from itertools import groupby, count
-from operator import itemgetter
+from itertools import count, islice, izip
 from StringIO import StringIO
 from tempfile import mkdtemp
-import os, os.path, json, subprocess, zipfile, csv, boto, tempfile, urlparse, urllib, zipfile
+from types import GeneratorType
+from collections import OrderedDict
+from contextlib import contextmanager
+import os, os.path, json, subprocess, zipfile, csv, boto, tempfile, urlparse, urllib, zipfile, re, time, zlib, bisect, hashlib
+import shutil, threading, struct
 
 from boto.s3.key import Key
 from models import Dataset
+from tables import SegmentTable
+from spatial import SegmentIndex
+from shapefiles import ShapefileReader
+from metrics import timed
 from flask import make_response
 
 def get_dataset(datastore, id):
     '''
-    Creates a dataset object from the .valid file
+    Creates a dataset object from its manifest, or from the .valid file
+    for datasets with nothing finished yet.
+    '''
+    manifest = read_manifest(datastore, id)
+
+    if manifest is None:
+        try:
+            valid_path = '{0}/uploads/.valid'.format(id)
+            valid_file = datastore.read(valid_path)
+        except (IOError, AttributeError):
+            return None
+
+        if valid_file.read() != id:
+            return None
+
+    elif manifest.get('id') != id:
+        return None
+
+    dataset = Dataset(id)
+    dataset.datastore = datastore
+    dataset.manifest = manifest
+    return dataset
+
+def manifest_path(dataset_id):
+    return '{0}/manifest.json'.format(dataset_id)
+
+def read_manifest(datastore, dataset_id):
+    ''' Return a dictionary of a dataset's finished artifacts, or None.
     '''
     try:
-        valid_path = '{0}/uploads/.valid'.format(id)
-        valid_file = datastore.read(valid_path)
-    except AttributeError:
+        return json.load(datastore.read(manifest_path(dataset_id)))
+    except (IOError, AttributeError, ValueError):
         return None
 
-    if valid_file.read() == id:
-        dataset = Dataset(id)
-        dataset.datastore = datastore
-        return dataset
+# Number of times to try updating a manifest that others keep changing.
+manifest_attempts = 10
+
+def record_artifact(datastore, dataset_id, name, written, **details):
+    ''' Note a finished artifact in a dataset's manifest, and return the manifest.
+
+        Written is the size and MD5 returned by datastore.write(), and details
+        can add things like feature counts and message summaries. Jobs can
+        finish at the same time, so the manifest is only replaced if nobody
+        else has changed it since it was read, and read again if they have.
+    '''
+    artifact = dict(updated=int(time.time()), **written)
+    artifact.update(details)
+    path = manifest_path(dataset_id)
+
+    for attempt in range(manifest_attempts):
+        # Version first, so a change made between the two is never missed.
+        version = datastore.version(path)
+        manifest = (read_manifest(datastore, dataset_id) if version else None) \
+                   or dict(id=dataset_id, artifacts={})
+
+        manifest['artifacts'][name] = artifact
+
+        if datastore.replace(path, json.dumps(manifest, indent=2, sort_keys=True), version):
+            return manifest
+
+    raise IOError('Manifest for dataset {0} kept changing'.format(dataset_id))
+
+def summarize_messages(messages):
+    ''' Return a count of distinct messages at each level.
+    '''
+    levels = [message[0] for message in messages]
+    return dict([(level, levels.count(level)) for level in set(levels)])
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -43,13 +105,64 @@ def make_id_from_url(url):
     return secure_filename(steward_id).lower().replace("_","-")
 
 
-def unzip(zipfile_path, search_ext='.shp', other_exts=('.dbf', '.prj', '.shx')):
-    ''' Unzip and return the path of a shapefile in a temp directory.
+class _Tally (threading.local):
+    value = 0
+
+# Bytes written to temporary files by this thread, reset for each request.
+temp_bytes_written = _Tally()
+
+_shapefile_exts = ('.dbf', '.prj', '.shx', '.cpg')
+
+@timed('unzip')
+@contextmanager
+def unzipped(zipfile_path, search_ext='.shp', other_exts=_shapefile_exts):
+    ''' Unzip a shapefile to a temp directory, for tools like ogr2ogr that need paths.
+
+        Yields the path of the shapefile, and removes the directory after.
     '''
-    zf = zipfile.ZipFile(zipfile_path, 'r')
     dirname = mkdtemp(prefix='unzip-', suffix=search_ext)
+
+    try:
+        yield _unzip_to(zipfile_path, dirname, search_ext, other_exts)
+    finally:
+        shutil.rmtree(dirname)
+
+def _unzip_to(zipfile_path, dirname, search_ext, other_exts):
+    ''' Unzip matching files into a directory and return the path of the one searched for.
+    '''
     foundfile_path = None
 
+    for (ext, name, data) in _iter_zipped_members(zipfile_path, search_ext, other_exts):
+        unzipped_path = '{0}/{1}'.format(dirname, os.path.basename(name))
+
+        with open(unzipped_path, 'w') as f:
+            f.write(data)
+
+        temp_bytes_written.value += len(data)
+
+        if ext == search_ext:
+            foundfile_path = unzipped_path
+
+    return foundfile_path
+
+@timed('unzip')
+def unzip_members(zipfile_path, search_ext='.shp', other_exts=_shapefile_exts):
+    ''' Return in-memory files from a zip archive in a dictionary by extension.
+
+        Like unzipped(), but nothing is written to disk.
+    '''
+    members = dict()
+
+    for (ext, name, data) in _iter_zipped_members(zipfile_path, search_ext, other_exts):
+        members[ext] = StringIO(data)
+
+    return members
+
+def _iter_zipped_members(zipfile_path, search_ext, other_exts):
+    ''' Generate extension, name and content for matching files in a zip archive.
+    '''
+    zf = zipfile.ZipFile(zipfile_path, 'r')
+
     for name in sorted(zf.namelist()):
         base, (_, ext) = os.path.basename(name), os.path.splitext(name)
 
@@ -57,15 +170,20 @@ def unzip(zipfile_path, search_ext='.shp', other_exts=('.dbf', '.prj', '.shx')):
             continue
 
         if ext in [search_ext] + list(other_exts):
-            unzipped_path = '{0}/{1}'.format(dirname, base)
+            yield ext, name, zf.read(name)
 
-            with open(unzipped_path, 'w') as f:
-                f.write(zf.open(name).read())
+def open_zipped_shapefile(zipfile_path):
+    ''' Return a ShapefileReader for a zipped shapefile, read in memory.
+    '''
+    members = unzip_members(zipfile_path)
 
-            if ext == search_ext:
-                foundfile_path = unzipped_path
+    if '.shp' not in members or '.dbf' not in members:
+        raise IOError('No .shp and .dbf files found in zip archive')
 
-    return foundfile_path
+    prj = members['.prj'].read() if '.prj' in members else None
+    cpg = members['.cpg'].read() if '.cpg' in members else None
+
+    return ShapefileReader(members['.shp'], members['.dbf'], prj, cpg)
 
 def zip_file(destination, content, filename):
     ''' Adds an entry to a zip file.
@@ -73,24 +191,354 @@ def zip_file(destination, content, filename):
     with zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED) as zf:
         zf.writestr(filename, content)
 
-def get_sample_features(dataset, zipped_geojson_name):
+@timed('zip')
+def zip_file_chunks(destination, chunks, filename):
+    ''' Adds an entry to a zip file, deflating content chunks as they arrive.
+
+        Destination must be seekable, so the entry header can be finished
+        once the size and checksum of the content are known.
     '''
+    with zipfile.ZipFile(destination, 'w', zipfile.ZIP_DEFLATED) as zf:
+        info = zipfile.ZipInfo(filename, time.localtime(time.time())[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0600 << 16
+        info.CRC, info.file_size, info.compress_size = 0, 0, 0
+        info.header_offset = zf.fp.tell()
+        zf.fp.write(info.FileHeader(False))
+
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        crc, file_size, compress_size = 0, 0, 0
+
+        for chunk in chunks:
+            if type(chunk) is unicode:
+                chunk = chunk.encode('utf8')
+
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            data = compressor.compress(chunk)
+            compress_size += len(data)
+            zf.fp.write(data)
+
+        data = compressor.flush()
+        compress_size += len(data)
+        zf.fp.write(data)
+
+        if file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('{0} is too large to stream into a zip file'.format(filename))
+
+        info.CRC = crc & 0xffffffff
+        info.file_size, info.compress_size = file_size, compress_size
+
+        # Go back and rewrite the entry header with real sizes.
+        position = zf.fp.tell()
+        zf.fp.seek(info.header_offset, 0)
+        zf.fp.write(info.FileHeader(False))
+        zf.fp.seek(position, 0)
+
+        zf.filelist.append(info)
+        zf.NameToInfo[info.filename] = info
+        zf._didModify = True
+
+@timed('json-encode')
+def iter_geojson_chunks(features, sort_keys=False):
+    ''' Generate a GeoJSON FeatureCollection string in pieces, one feature at a time.
+
+        Output matches json.dumps() of a whole FeatureCollection with sorted keys.
+    '''
+    yield '{"features": ['
+
+    for (index, feature) in enumerate(features):
+        if index:
+            yield ', '
+        yield json.dumps(feature, sort_keys=sort_keys)
+
+    yield '], "type": "FeatureCollection"}'
+
+def open_zipped_geojson(zip_buffer):
+    ''' Return a file-like object for the first .geojson file in a zip archive.
     '''
-    zip_path = '{0}/{1}'.format(dataset.id, zipped_geojson_name)
-    zip_buffer = dataset.datastore.read(zip_path)
     zf = zipfile.ZipFile(zip_buffer, 'r')
 
-    # Search for a .geojson file
     for name in zf.namelist():
         _, ext = os.path.splitext(name)
 
         if ext == '.geojson':
-            # Return its first three features
-            gf = zf.open(name, 'r')
-            geojson = json.load(gf)
-            return geojson['features'][:3]
+            return zf.open(name, 'r')
+
+    raise IOError('No .geojson file found in zip archive')
+
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+
+class _JSONReader:
+    ''' Reads a JSON document from a file one value at a time.
+    '''
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer, self.pos, self.eof = '', 0, False
+
+    def _read_more(self):
+        ''' Add data to the buffer, return false at the end of the file.
+
+            Reads at least as much as is already waiting in the buffer,
+            so a large value is not decoded over and over again.
+        '''
+        if self.eof:
+            return False
+
+        unread = self.buffer[self.pos:]
+        chunk = self.file.read(max(self.chunk_size, len(unread)))
+
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buffer, self.pos = unread + chunk, 0
+        return True
+
+    def peek(self):
+        ''' Return the next non-whitespace character, or an empty string at the end.
+        '''
+        while True:
+            self.pos = _json_whitespace.match(self.buffer, self.pos).end()
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self._read_more():
+                return ''
+
+    def expect(self, chars):
+        ''' Consume and return the next non-whitespace character if it's in chars.
+        '''
+        char = self.peek()
+
+        if not char or char not in chars:
+            raise ValueError('Expected one of {0} in JSON, found {1}'.format(repr(chars), repr(char)))
+
+        self.pos += 1
+        return char
+
+    def value(self):
+        ''' Decode and return the next complete JSON value.
+        '''
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self._read_more():
+                    continue
+                raise
+
+            if end == len(self.buffer) and self._read_more():
+                # A number at the end of the buffer might not be finished.
+                continue
+
+            self.pos = end
+            return value
+
+def _iter_json_array(reader):
+    ''' Generate decoded values from a JSON array.
+    '''
+    reader.expect('[')
+
+    if reader.peek() == ']':
+        reader.pos += 1
+        return
+
+    while True:
+        yield reader.value()
+
+        if reader.expect(',]') == ']':
+            return
+
+def iter_geojson_members(file, chunk_size=65536):
+    ''' Generate (key, value) pairs from the top-level object of a GeoJSON file.
+
+        A "features" array is not decoded all at once. Its value is a generator
+        of individual features, which is used up before the next pair is read.
+    '''
+    reader = _JSONReader(file, chunk_size)
+    reader.expect('{')
+
+    if reader.peek() == '}':
+        reader.pos += 1
+        _expect_json_end(reader)
+        return
+
+    while True:
+        key = reader.value()
+
+        if type(key) not in (str, unicode):
+            raise ValueError('Expected a string key in JSON, found {0}'.format(repr(key)))
+
+        reader.expect(':')
+
+        if key == 'features' and reader.peek() == '[':
+            features = _iter_json_array(reader)
+            yield key, features
+
+            # Skip past whatever the caller didn't read.
+            for feature in features:
+                pass
+        else:
+            yield key, reader.value()
+
+        if reader.expect(',}') == '}':
+            _expect_json_end(reader)
+            return
+
+def _expect_json_end(reader):
+    ''' Raise a ValueError if anything but whitespace follows a JSON document.
+    '''
+    if reader.peek() != '':
+        raise ValueError('Extra data after JSON document')
+
+@timed('json-decode')
+def iter_geojson_features(file, chunk_size=65536):
+    ''' Generate features from a GeoJSON FeatureCollection file, one at a time.
+    '''
+    for (key, value) in iter_geojson_members(file, chunk_size):
+        if key != 'features':
+            continue
+
+        if not isinstance(value, GeneratorType):
+            raise ValueError('Bad features list in GeoJSON')
+
+        for feature in value:
+            yield feature
+
+class LRUCache:
+
+    def __init__(self, size):
+        '''
+        Dictionary-like cache that forgets its least-recently used items
+        '''
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def set(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+# Parsed samples by datastore path and version, see get_sample_features().
+_sample_cache = LRUCache(256)
+
+# Number of features in each sample.
+sample_count = 3
+
+# Spatial index saved next to transformed segments, see get_segment_index().
+segment_index_name = 'opentrails/segments.index'
+
+# Loaded segment indexes by datastore path and version.
+_segment_index_cache = LRUCache(16)
+
+def get_segment_index(dataset):
+    ''' Return a dataset's spatial index of transformed segments, or None if it has none.
+
+        Loaded indexes are kept by path and ETag or modification time,
+        so each is read once per process. Don't modify what's returned.
+    '''
+    path = '{0}/{1}'.format(dataset.id, segment_index_name)
+    version = dataset.datastore.version(path)
 
-    return []
+    if version is None:
+        return None
+
+    key = path, version
+    index = _segment_index_cache.get(key)
+
+    if index is None:
+        index = SegmentIndex.loads(dataset.datastore.read(path).read())
+        _segment_index_cache.set(key, index)
+
+    return index
+
+def sample_path(zip_path):
+    ''' Return the path of the sample written next to a zipped GeoJSON file.
+    '''
+    return re.sub(r'(\.geojson)?\.zip$', '', zip_path) + '.sample.json'
+
+def iter_sampled(features, sample, count=sample_count):
+    ''' Generate features unchanged, keeping the first few in a sample list.
+    '''
+    for (index, feature) in enumerate(features):
+        if index < count:
+            sample.append(feature)
+
+        yield feature
+
+def get_sample_features(dataset, zipped_geojson_name):
+    ''' Return the first few features from a zipped GeoJSON file in a dataset.
+
+        Reads the sample written next to the file when there is one. Parsed
+        samples are kept by path and ETag or modification time, in memory
+        and in SAMPLE_CACHE_DIR if it's set. Don't modify what's returned.
+    '''
+    zip_path = '{0}/{1}'.format(dataset.id, zipped_geojson_name)
+    path = sample_path(zip_path)
+    version = dataset.datastore.version(path)
+
+    if version is None:
+        # Older datasets don't have samples, so look in the file itself.
+        path, version = zip_path, dataset.datastore.version(zip_path)
+
+    key = path, version
+    features = _sample_cache.get(key)
+
+    if features is not None:
+        return features
+
+    cache_dir = app.config.get('SAMPLE_CACHE_DIR')
+    cache_path = cache_dir and os.path.join(cache_dir, hashlib.sha1(repr(key)).hexdigest() + '.json')
+
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as file:
+            features = json.load(file)
+
+    elif path == zip_path:
+        features = _read_sample_features(dataset.datastore.read(zip_path))
+
+    else:
+        features = json.load(dataset.datastore.read(path))
+
+    if version is not None:
+        _sample_cache.set(key, features)
+
+        if cache_path and not os.path.exists(cache_path):
+            handle, temporary = tempfile.mkstemp(dir=cache_dir, prefix='.write-')
+            with os.fdopen(handle, 'w') as file:
+                json.dump(features, file)
+            os.rename(temporary, cache_path)
+
+    return features
+
+def _read_sample_features(zip_buffer, count=sample_count):
+    ''' Return the first few features from a zipped GeoJSON file.
+
+        Features are decoded one at a time, and reading stops after count
+        of them, so the time it takes doesn't depend on the size of the file.
+    '''
+    try:
+        geojson_file = open_zipped_geojson(zip_buffer)
+    except IOError:
+        return []
+
+    return list(islice(iter_geojson_features(geojson_file), count))
 
 def get_sample_segment_features(dataset):
     return get_sample_features(dataset, 'uploads/trail-segments.geojson.zip')
@@ -109,66 +557,300 @@ def encode_list(items):
     '''
     return '; '.join(map(str, items))
 
-def make_named_trails(segment_features):
+# Number of feature indexes kept for each message.
+max_message_indexes = 5
+
+class Messages (list):
+
+    def __init__(self, messages=(), max_indexes=max_message_indexes):
+        '''
+        List of (level, id, words) messages that ignores duplicates
+
+        Keeps messages in the order they were first seen, and counts how
+        many times each one was added. Also keeps the first few indexes of
+        features that each message was added for.
+        '''
+        list.__init__(self)
+        self.counts = dict()
+        self.indexes = dict()
+        self.max_indexes = max_indexes
+        self.extend(messages)
+
+    def __contains__(self, message):
+        return tuple(message) in self.counts
+
+    def __reduce__(self):
+        return _rebuild_messages, (list(self), self.counts, self.indexes, self.max_indexes)
+
+    def append(self, message, index=None):
+        ''' Add one message, for the feature at an optional index.
+        '''
+        self.add(message, 1, () if index is None else (index, ))
+
+    def add(self, message, count, indexes=()):
+        ''' Add a message seen some number of times, for features at some indexes.
+        '''
+        message = tuple(message)
+
+        if message not in self.counts:
+            list.append(self, message)
+            self.counts[message] = 0
+            self.indexes[message] = []
+
+        self.counts[message] += count
+        found = self.indexes[message]
+
+        for index in indexes:
+            if len(found) < self.max_indexes:
+                bisect.insort(found, index)
+            elif index < found[-1]:
+                bisect.insort(found, index)
+                found.pop()
+
+    def extend(self, messages):
+        ''' Add messages from a list, with counts and indexes if it has them.
+        '''
+        if isinstance(messages, Messages):
+            for message in messages:
+                self.add(message, messages.counts[message], messages.indexes[message])
+        else:
+            for message in messages:
+                self.append(message)
+
+    def counted_list(self):
+        ''' Return a list of (level, id, words, count, indexes) for storage.
+        '''
+        return [message + (self.counts[message], self.indexes[message]) for message in self]
+
+def _rebuild_messages(messages, counts, indexes, max_indexes):
+    ''' Unpickle a Messages list without counting its messages twice.
     '''
+    rebuilt = Messages(max_indexes=max_indexes)
+    list.extend(rebuilt, messages)
+    rebuilt.counts, rebuilt.indexes = counts, indexes
+    return rebuilt
+
+def dedupe_messages(messages):
+    ''' Return a list of messages with later duplicates removed.
     '''
-    names = [(f['properties']['name'], f['properties']['id'])
-             for f in segment_features
-             if f['properties']['name']]
+    return Messages(messages)
 
-    # Cut to the chase if there's no name.
-    if not names:
-        return []
+def load_messages(data):
+    ''' Return stored messages as (level, id, words) tuples, and a dictionary of their counts.
+    '''
+    messages, counts = [], dict()
+
+    for message in data:
+        if len(message) == 2:
+            # Old stored format.
+            message = message[0], None, message[1]
+
+        messages.append(tuple(message[:3]))
+
+        if len(message) > 3:
+            counts[tuple(message[:3])] = message[3]
+
+    return messages, counts
+
+def make_named_trails(segment_features, normalize=False):
+    ''' Return a list of named trails, one for each distinct segment name.
+
+        Segment IDs are gathered in one pass over the features, and named
+        trails are numbered in order of name. With normalize set, names that
+        differ only by case or spacing are grouped under the first spelling.
+
+        Segment features can be a SegmentTable, whose columns are read directly.
+    '''
+    spellings, segment_ids = dict(), dict()
+
+    if isinstance(segment_features, SegmentTable):
+        names_ids = izip(segment_features.names, segment_features.ids)
+    else:
+        names_ids = ((f['properties']['name'], f['properties']['id']) for f in segment_features)
+
+    for (name, id) in names_ids:
+        if not name:
+            continue
+
+        key = normalize_trail_name(name) if normalize else name
 
-    # Generate a list of (name, ids) tuples
-    names = sorted(names, key=itemgetter(0))
-    groups = groupby(names, itemgetter(0))
+        if key not in segment_ids:
+            spellings[key], segment_ids[key] = name, []
 
-    name_ids = [(name, encode_list(map(itemgetter(1), names_ids)))
-                for (name, names_ids) in groups]
+        segment_ids[key].append(id)
 
     id_counter = count(1)
 
     return [dict(id=str(id_counter.next()),
-                 name=name, segment_ids=ids,
+                 name=spellings[key], segment_ids=encode_list(segment_ids[key]),
                  description=None, part_of=None)
-            for (name, ids) in name_ids]
+            for key in sorted(segment_ids)]
 
-def package_opentrails_archive(dataset):
+def normalize_trail_name(name):
+    ''' Fold case and spacing out of a trail name, for grouping near-duplicates.
     '''
+    return ' '.join(name.split()).lower()
+
+def package_opentrails_archive(dataset):
+    ''' Return a generator of chunks of a zip archive with a dataset's OpenTrails files.
+
+        Files are opened before anything is generated, so missing ones raise
+        errors right away instead of partway through a download.
     '''
-    buffer = StringIO()
-    zf = zipfile.ZipFile(buffer, 'w')
     ot_prefix = '{0}/opentrails'.format(dataset.id)
+    zipped_files, files = [], []
 
     # We moved this up from below the unzip and re-zip section
     # If a user skips adding and converting trailheads, we want to give them the option
     # to download a zip of their data thus far.
-    try:
-        trailheads_zipname = '{0}/trailheads.geojson.zip'.format(ot_prefix)
-        trailheads_zipfile = dataset.datastore.read(trailheads_zipname)
-        trailheads_path = unzip(trailheads_zipfile, '.geojson', [])
-        zf.writestr('trailheads.geojson', open(trailheads_path).read())
-    except AttributeError:
-        pass
+    if dataset.manifest is None or dataset.has('opentrails/trailheads.geojson.zip'):
+        try:
+            trailheads_zipname = '{0}/trailheads.geojson.zip'.format(ot_prefix)
+            trailheads_zipfile = dataset.datastore.read(trailheads_zipname)
+            zipped_files.append(('trailheads.geojson', trailheads_zipfile))
+        except (IOError, AttributeError):
+            pass
 
     # Add the segments file
     segments_zipname = '{0}/segments.geojson.zip'.format(ot_prefix)
     segments_zipfile = dataset.datastore.read(segments_zipname)
-    segments_path = unzip(segments_zipfile, '.geojson', [])
-    zf.writestr('trail_segments.geojson', open(segments_path).read())
+    zipped_files.append(('trail_segments.geojson', segments_zipfile))
 
     # Add the named trails file
     named_trails_path = '{0}/named_trails.csv'.format(ot_prefix)
     named_trails_data = dataset.datastore.read(named_trails_path)
-    zf.writestr('named_trails.csv', named_trails_data.read())
+    files.append(('named_trails.csv', named_trails_data))
 
     # Add the stewards file
     stewards_path = '{0}/stewards.csv'.format(ot_prefix)
     stewards_data = dataset.datastore.read(stewards_path)
-    zf.writestr('stewards.csv', stewards_data.read())
+    files.append(('stewards.csv', stewards_data))
+
+    return _iter_zip_chunks(zipped_files, files)
+
+archive_name = 'opentrails/open-trails.zip'
+
+archive_sources = (
+    'opentrails/segments.geojson.zip', 'opentrails/named_trails.csv',
+    'opentrails/stewards.csv', 'opentrails/trailheads.geojson.zip'
+    )
+
+def _archive_source_hashes(dataset):
+    ''' Return MD5s of the finished files that go into a dataset's archive.
+    '''
+    artifacts = dataset.manifest['artifacts']
+    return dict([(name, artifacts[name]['md5']) for name in archive_sources if name in artifacts])
+
+def can_build_opentrails_archive(dataset):
+    ''' Return true if a dataset has every file its archive needs.
+    '''
+    return dataset.manifest is not None and all(map(dataset.has, archive_sources[:3]))
+
+def build_opentrails_archive(dataset):
+    ''' Write a dataset's OpenTrails zip archive to the datastore, and return its manifest entry.
+
+        The MD5s of the files that went in are kept in the manifest,
+        so a stale archive can be told apart from a current one.
+    '''
+    sources = _archive_source_hashes(dataset)
+    path = '{0}/{1}'.format(dataset.id, archive_name)
+    written = dataset.datastore.write(path, package_opentrails_archive(dataset))
+
+    dataset.manifest = record_artifact(dataset.datastore, dataset.id,
+                                       archive_name, written, sources=sources)
+    return dataset.manifest['artifacts'][archive_name]
+
+def get_opentrails_archive(dataset):
+    ''' Return the manifest entry for a dataset's current archive, building it if needed.
+    '''
+    if dataset.has(archive_name):
+        archive = dataset.manifest['artifacts'][archive_name]
+        if archive.get('sources') == _archive_source_hashes(dataset):
+            return archive
+
+    return build_opentrails_archive(dataset)
+
+class _ZipOutput:
+
+    def __init__(self):
+        '''
+        Write-only file for a ZipFile, collecting chunks to be generated
+        '''
+        self.chunks, self.position = [], 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return ''.join(chunks)
+
+def _iter_zip_chunks(zipped_files, files):
+    ''' Generate chunks of a new zip archive without seeking back in it.
+
+        Zipped_files is a list of names and zip archives, whose first .geojson
+        file is copied still-compressed. Files is a list of names and small
+        files, compressed here.
+    '''
+    output = _ZipOutput()
+    zf = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED)
+
+    for (name, zip_buffer) in zipped_files:
+        for chunk in _iter_raw_member(zf, zip_buffer, name):
+            output.write(chunk)
+            yield output.drain()
+
+    for (name, file) in files:
+        zf.writestr(name, file.read())
+        yield output.drain()
 
     zf.close()
-    buffer.seek(0)
+    yield output.drain()
+
+def _iter_raw_member(zf, zip_buffer, name):
+    ''' Add the first .geojson file from another zip archive to a zip file being written.
+
+        Generates the new local file header and then compressed data, copied
+        as-is without inflating it.
+    '''
+    source = zipfile.ZipFile(zip_buffer, 'r')
+    infos = [info for info in source.infolist() if os.path.splitext(info.filename)[1] == '.geojson']
+
+    if not infos:
+        raise IOError('No .geojson file found in zip archive')
+
+    info = zipfile.ZipInfo(name, infos[0].date_time)
+    info.compress_type, info.external_attr = infos[0].compress_type, 0600 << 16
+    info.CRC, info.file_size, info.compress_size = infos[0].CRC, infos[0].file_size, infos[0].compress_size
+    info.header_offset = zf.fp.tell()
+
+    if info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT:
+        raise zipfile.LargeZipFile('{0} is too large to copy into a zip file'.format(name))
+
+    yield info.FileHeader(False)
+
+    # Skip past the source's local file header to its compressed data.
+    zip_buffer.seek(infos[0].header_offset, 0)
+    header = struct.unpack(zipfile.structFileHeader, zip_buffer.read(zipfile.sizeFileHeader))
+    zip_buffer.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    remaining = info.compress_size
+
+    while remaining:
+        chunk = zip_buffer.read(min(remaining, 65536))
+
+        if not chunk:
+            raise zipfile.BadZipfile('Truncated file {0} in zip archive'.format(infos[0].filename))
+
+        remaining -= len(chunk)
+        yield chunk
 
-    return buffer
+    zf.filelist.append(info)
+    zf.NameToInfo[info.filename] = info
@@ -0,0 +1,209 @@
+''' Optional lossy geometry stage for transformed features.
+
+    Coordinates from ogr2ogr carry full double precision, which is far more
+    than trail data needs. GeometryStage can round coordinates to a number of
+    decimal places and simplify lines and rings with Douglas-Peucker, and
+    keeps count of the vertices and bytes it saved. It does nothing by default.
+'''
+from array import array
+from math import cos, radians, hypot
+import json
+
+from .metrics import timed
+
+# Approximate meters per degree of latitude, and of longitude at the equator.
+meters_per_degree = 110540., 111320.
+
+class GeometryStage:
+
+    def __init__(self, decimals=None, tolerance=0):
+        '''
+        Rounds coordinates to decimals places and simplifies lines to a tolerance in meters
+
+        Either one can be turned off with None or zero, and with both off
+        geometries are passed through untouched.
+        '''
+        self.decimals = decimals
+        self.tolerance = tolerance or 0
+        self.vertices_in, self.vertices_out = 0, 0
+        self.bytes_in, self.bytes_out = 0, 0
+
+    @property
+    def lossless(self):
+        return self.decimals is None and not self.tolerance
+
+    @timed('simplify')
+    def iter_features(self, features):
+        ''' Generate features with new geometries, one at a time.
+        '''
+        for feature in features:
+            if not self.lossless:
+                feature = dict(feature, geometry=self.geometry(feature['geometry']))
+
+            yield feature
+
+    def geometry(self, geometry):
+        ''' Return a new geometry dict, or the same one if there's nothing to do.
+        '''
+        if type(geometry) is not dict or type(geometry.get('coordinates')) is not list:
+            return geometry
+
+        geometry_type, coordinates = geometry['type'], geometry['coordinates']
+
+        if geometry_type == 'Point':
+            new_coordinates = self._position(coordinates)
+        elif geometry_type == 'MultiPoint':
+            new_coordinates = map(self._position, coordinates)
+        elif geometry_type == 'LineString':
+            new_coordinates = self._line(coordinates, 2)
+        elif geometry_type == 'MultiLineString':
+            new_coordinates = self._lines(coordinates, 2)
+        elif geometry_type == 'Polygon':
+            new_coordinates = self._lines(coordinates, 4)
+        elif geometry_type == 'MultiPolygon':
+            new_coordinates = [self._lines(polygon, 4) for polygon in coordinates]
+        else:
+            return geometry
+
+        self.bytes_in += len(json.dumps(coordinates))
+        self.bytes_out += len(json.dumps(new_coordinates))
+
+        return dict(geometry, coordinates=new_coordinates)
+
+    def _position(self, position):
+        ''' Return a rounded position, counting it as one vertex in and out.
+
+            Anything but a position is returned unchanged, and isn't counted.
+        '''
+        if not is_position(position):
+            return position
+
+        self.vertices_in += 1
+        self.vertices_out += 1
+
+        if self.decimals is None:
+            return position
+
+        return _round_position(position, self.decimals)
+
+    def _lines(self, lines, minimum):
+        ''' Return a list of simplified and rounded lines or rings.
+        '''
+        if type(lines) is not list:
+            return lines
+
+        return [self._line(line, minimum) for line in lines]
+
+    def _line(self, line, minimum):
+        ''' Return a simplified and rounded line or ring with at least minimum positions.
+
+            Lines with anything but positions in them are returned unchanged,
+            and aren't counted.
+        '''
+        if not is_line(line):
+            return line
+
+        self.vertices_in += len(line)
+
+        if self.tolerance and len(line) > minimum:
+            kept = simplify_line(line, self.tolerance)
+
+            if len(kept) >= minimum:
+                line = kept
+
+        if self.decimals is not None:
+            rounded = [_round_position(position, self.decimals) for position in line]
+            line = _drop_repeats(rounded, minimum)
+
+        self.vertices_out += len(line)
+        return line
+
+def is_position(position):
+    return type(position) in (list, tuple) and len(position) >= 2 \
+        and type(position[0]) in (int, long, float) and type(position[1]) in (int, long, float)
+
+def is_line(line):
+    return type(line) in (list, tuple) and all([is_position(p) for p in line])
+
+def _round_position(position, decimals):
+    ''' Return a position with its numbers rounded, and anything else left alone.
+    '''
+    return [round(n, decimals) if type(n) in (int, long, float) else n for n in position]
+
+def _drop_repeats(line, minimum):
+    ''' Return a line without repeated consecutive positions, if it's still long enough.
+    '''
+    kept = line[:1] + [b for (a, b) in zip(line, line[1:]) if a != b]
+
+    if len(kept) < minimum:
+        return line
+
+    return kept
+
+def simplify_line(line, tolerance):
+    ''' Return a line of longitude, latitude positions simplified with Douglas-Peucker.
+
+        Tolerance is in meters, measured on a flat projection centered on
+        the line. End points are always kept, so rings stay closed. Lines
+        with anything but positions in them are returned unchanged.
+    '''
+    if len(line) < 3 or not is_line(line):
+        return line
+
+    lat_meters, lon_meters = meters_per_degree
+    lon_meters *= cos(radians(sum([p[1] for p in line]) / len(line)))
+
+    xs = array('d', [p[0] * lon_meters for p in line])
+    ys = array('d', [p[1] * lat_meters for p in line])
+    keep = bytearray(len(line))
+    keep[0] = keep[-1] = 1
+
+    # Ranges of positions still to simplify, instead of recursion.
+    ranges = [(0, len(line) - 1)]
+
+    while ranges:
+        start, end = ranges.pop()
+        farthest, distance = None, tolerance
+
+        for index in xrange(start + 1, end):
+            d = segment_distance(xs[index], ys[index], xs[start], ys[start], xs[end], ys[end])
+
+            if d > distance:
+                farthest, distance = index, d
+
+        if farthest is not None:
+            keep[farthest] = 1
+            ranges.append((start, farthest))
+            ranges.append((farthest, end))
+
+    return [position for (position, kept) in zip(line, keep) if kept]
+
+def segment_distance(x, y, x1, y1, x2, y2):
+    ''' Return the distance from point x, y to a line segment.
+    '''
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+
+    if length2 == 0:
+        return hypot(x - x1, y - y1)
+
+    t = max(0, min(1, ((x - x1) * dx + (y - y1) * dy) / length2))
+    return hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+def report_geometry_stage(messages, stage):
+    ''' Add a message about what a geometry stage saved, if it did anything.
+    '''
+    if stage.lossless or not stage.vertices_in:
+        return
+
+    words = 'Geometry was {0}, reducing {1:,} vertices to {2:,} and coordinates from {3:,} to {4:,} bytes.'
+    steps = []
+
+    if stage.tolerance:
+        steps.append('simplified to {0:g} meters'.format(stage.tolerance))
+
+    if stage.decimals is not None:
+        steps.append('rounded to {0} decimal places'.format(stage.decimals))
+
+    args = ' and '.join(steps), stage.vertices_in, stage.vertices_out, stage.bytes_in, stage.bytes_out
+    messages.append(('info', 'simplified-geometry', words.format(*args)))
@@ -0,0 +1,277 @@
+''' Background jobs for the slow upload and transform steps.
+
+    Job status is kept in the datastore next to its dataset, so any web
+    process can report on a job that another process is running. With
+    JOB_WORKERS set to zero jobs run inline, inside the request.
+'''
+from multiprocessing import Pool
+from StringIO import StringIO
+from tempfile import TemporaryFile
+import os, json, uuid, time, sys
+
+from open_trails import app
+from models import get_datastore
+from functions import (
+    get_dataset, open_zipped_shapefile, zip_file_chunks, iter_geojson_chunks,
+    iter_geojson_features, open_zipped_geojson, Messages, iter_sampled,
+    sample_path, record_artifact, summarize_messages, can_build_opentrails_archive,
+    build_opentrails_archive, segment_index_name
+    )
+from spatial import SegmentIndex
+from metrics import start_timings, finish_timings
+from geometry import GeometryStage, report_geometry_stage
+from transformers import (
+    iter_zipped_shapefile_features, segments_transform_table, iter_segments_transform,
+    iter_trailheads_transform, can_pool_segments
+    )
+
+# Uploaded and transformed file names for each kind of upload.
+upload_kinds = {
+    'segments': ('trail-segments', 'segments', iter_segments_transform),
+    'trailheads': ('trail-trailheads', 'trailheads', iter_trailheads_transform)
+    }
+
+# Pools are kept per process, because gunicorn forks after import.
+_pools = {}
+
+class Job:
+
+    def __init__(self, datastore, dataset_id, id, redirect):
+        '''
+        Running state of a job, saved to the datastore as it changes
+        '''
+        self.datastore = datastore
+        self.dataset_id = dataset_id
+        self.id = id
+        self.redirect = redirect
+        self.state = 'queued'
+        self.processed = 0
+        self.total = None
+        self.error = None
+        self.timings = None
+        self.saved = 0
+
+    def as_dict(self):
+        job = dict(id=self.id, state=self.state, processed=self.processed,
+                   total=self.total, redirect=self.redirect, error=self.error)
+
+        if self.timings is not None:
+            job['timings'] = self.timings
+
+        return job
+
+    def save(self):
+        ''' Write current state to the datastore.
+        '''
+        path = job_path(self.dataset_id, self.id)
+        self.datastore.write(path, StringIO(json.dumps(self.as_dict())))
+        self.saved = time.time()
+
+    def progress(self, processed, total=None, interval=1.0):
+        ''' Note progress, saving it no more than once per interval.
+        '''
+        self.processed, self.total = processed, total
+
+        if time.time() - self.saved >= interval:
+            self.save()
+
+    def counted(self, items, total=None):
+        ''' Generate items unchanged, noting progress as they go by.
+        '''
+        processed = 0
+        self.progress(processed, total)
+
+        for item in items:
+            yield item
+            processed += 1
+            self.progress(processed, total)
+
+        # Now the total is known for sure.
+        self.processed, self.total = processed, processed
+
+def job_path(dataset_id, job_id):
+    return '{0}/jobs/{1}.json'.format(dataset_id, job_id)
+
+def read_job(datastore, dataset_id, job_id):
+    ''' Return a dictionary of job status, or None if there isn't one.
+    '''
+    try:
+        return json.load(datastore.read(job_path(dataset_id, job_id)))
+    except (IOError, AttributeError):
+        return None
+
+def get_pool(workers):
+    ''' Return a worker pool for this process, creating it if necessary.
+    '''
+    pid = os.getpid()
+
+    if pid not in _pools:
+        _pools[pid] = Pool(workers)
+
+    return _pools[pid]
+
+def start_job(config, dataset_id, task, args, redirect):
+    ''' Start a task for a dataset and return its job status.
+
+        Runs the task inline when config has no JOB_WORKERS, otherwise
+        queues it on this process's worker pool and returns right away.
+    '''
+    datastore = get_datastore(config['DATASTORE'])
+    job = Job(datastore, dataset_id, str(uuid.uuid4()), redirect)
+    job.save()
+
+    workers = config.get('JOB_WORKERS')
+    run_args = config['DATASTORE'], dataset_id, job.id, redirect, task, args
+
+    if workers:
+        # Inline jobs are timed along with their request instead.
+        timing = bool(config.get('REQUEST_METRICS') or config.get('SERVER_TIMING_HEADER'))
+        get_pool(workers).apply_async(run_job, run_args + (timing, ))
+        return job.as_dict()
+
+    run_job(*run_args)
+    return read_job(datastore, dataset_id, job.id)
+
+def run_job(datastore_config, dataset_id, job_id, redirect, task, args, timing=False):
+    ''' Run a task, keeping its job status up to date.
+
+        Failures are logged and raised again, and recorded in the job status
+        by exception class only, because job status is shown to anyone.
+        With timing, time spent in each stage is saved in the job status too.
+    '''
+    datastore = get_datastore(datastore_config)
+    job = Job(datastore, dataset_id, job_id, redirect)
+    job.state = 'running'
+    job.save()
+
+    if timing:
+        start_timings()
+
+    try:
+        task(job, datastore, dataset_id, *args)
+    except:
+        app.logger.exception('Job %s for dataset %s failed', job_id, dataset_id)
+        job.state, job.error = 'failed', 'Failed with {0}'.format(sys.exc_info()[0].__name__)
+        job.timings = _job_timings(timing)
+        job.save()
+        raise
+    else:
+        job.state = 'finished'
+        job.timings = _job_timings(timing)
+        job.save()
+
+def _job_timings(timing):
+    ''' Return rounded stage timings collected by run_job(), or None.
+    '''
+    if not timing:
+        return None
+
+    return dict([(stage, round(seconds, 4)) for (stage, seconds) in finish_timings().items()])
+
+def convert_upload(job, datastore, dataset_id, kind):
+    ''' Convert an uploaded, zipped shapefile to zipped GeoJSON.
+    '''
+    upload_base = '{0}/uploads/{1}'.format(dataset_id, upload_kinds[kind][0])
+    geojson_name = '{0}.geojson'.format(upload_kinds[kind][0])
+
+    # Get geojson data from shapefile, in memory unless ogr2ogr is needed
+    shapefile_zip = datastore.read(upload_base + '.zip')
+
+    try:
+        reader = open_zipped_shapefile(shapefile_zip)
+    except NotImplementedError:
+        total, features = None, iter_zipped_shapefile_features(shapefile_zip, 'ogr2ogr')
+    else:
+        total, features = len(reader), iter(reader)
+
+    sample = []
+    features = job.counted(features, total)
+    features = iter_sampled(features, sample)
+
+    # Compress geojson file to disk, rather than holding it in memory
+    geojson_zip = TemporaryFile()
+    zip_file_chunks(geojson_zip, iter_geojson_chunks(features), geojson_name)
+
+    # Upload .geojson.zip file to datastore, with a sample for review pages
+    written = datastore.write(upload_base + '.geojson.zip', geojson_zip)
+    datastore.write(sample_path(upload_base + '.geojson.zip'), StringIO(json.dumps(sample)))
+
+    artifact_name = 'uploads/{0}.geojson.zip'.format(upload_kinds[kind][0])
+    record_artifact(datastore, dataset_id, artifact_name, written, features=job.total)
+
+def transform_upload(job, datastore, dataset_id, kind, workers=1, chunk_size=1000,
+                     decimals=None, tolerance=0):
+    ''' Transform uploaded GeoJSON into OpenTrails GeoJSON and messages.
+
+        Segments are transformed in a process pool when workers is more than one.
+        Geometries are kept as they are unless decimals or tolerance is given,
+        see GeometryStage.
+    '''
+    upload_name, output_name, transform = upload_kinds[kind]
+    dataset = get_dataset(datastore, dataset_id)
+
+    # Download the original file
+    uploaded_path = '{0}/uploads/{1}.geojson.zip'.format(dataset.id, upload_name)
+    uploaded_zip = datastore.read(uploaded_path)
+
+    # Read features from it one at a time
+    uploaded = iter_geojson_features(open_zipped_geojson(uploaded_zip))
+
+    if kind == 'segments' and can_pool_segments(workers):
+        # A pool needs all the features in memory at once, but new ones are
+        # kept in columns and the uploaded ones can go once they're copied.
+        # Jobs in a background worker stream features through instead.
+        raw_features = list(job.counted(uploaded))
+        messages, transformed = segments_transform_table(raw_features, dataset, workers, chunk_size)
+        del raw_features
+    else:
+        messages = Messages()
+        transformed = transform(messages, job.counted(uploaded), dataset)
+
+    # Optionally round and simplify geometries on the way through
+    stage = GeometryStage(decimals, tolerance)
+    transformed = stage.iter_features(transformed)
+
+    # Index segments by location, for matching trailheads to them later
+    if kind == 'segments':
+        segment_index = SegmentIndex()
+        transformed = segment_index.iter_added(transformed)
+
+    # Make a zip from transformed features, streaming them as they're converted
+    sample, tally = [], dict(features=0)
+    transformed = _iter_tallied(iter_sampled(transformed, sample), tally)
+    transformed_zip = TemporaryFile()
+    transformed_raw = iter_geojson_chunks(transformed, sort_keys=True)
+    zip_file_chunks(transformed_zip, transformed_raw, '{0}.geojson'.format(output_name))
+
+    report_geometry_stage(messages, stage)
+
+    # Save messages for output
+    messages_path = '{0}/opentrails/{1}-messages.json'.format(dataset.id, output_name)
+    datastore.write(messages_path, StringIO(json.dumps(messages.counted_list())))
+
+    # Upload transformed features
+    zip_path = '{0}/opentrails/{1}.geojson.zip'.format(dataset.id, output_name)
+    written = datastore.write(zip_path, transformed_zip)
+    datastore.write(sample_path(zip_path), StringIO(json.dumps(sample)))
+
+    if kind == 'segments':
+        segment_index.pack()
+        index_path = '{0}/{1}'.format(dataset.id, segment_index_name)
+        index_written = datastore.write(index_path, segment_index.dumps())
+        record_artifact(datastore, dataset.id, segment_index_name, index_written, segments=len(segment_index))
+
+    artifact_name = 'opentrails/{0}.geojson.zip'.format(output_name)
+    dataset.manifest = record_artifact(datastore, dataset.id, artifact_name, written,
+                                       features=tally['features'], messages=summarize_messages(messages))
+
+    # Trailheads are the last step, so package up the download now.
+    if kind == 'trailheads' and can_build_opentrails_archive(dataset):
+        build_opentrails_archive(dataset)
+
+def _iter_tallied(items, tally):
+    ''' Generate items unchanged, counting them in tally.
+    '''
+    for item in items:
+        tally['features'] += 1
+        yield item
@@ -0,0 +1,185 @@
+''' Lightweight timing of the slow stages inside requests and jobs.
+
+    Functions marked with the timed() decorator add up how long they take,
+    but only on threads where start_timings() has been called; otherwise
+    they cost one attribute check. Times are exclusive, so a stage nested
+    inside another one isn't counted twice, and generators are timed each
+    time they're resumed, so a streamed transform doesn't also get billed
+    for the datastore read feeding it.
+
+    Per-request totals go into per-route histograms in a Metrics registry,
+    which renders them in the Prometheus text format.
+'''
+from inspect import isgeneratorfunction
+from functools import wraps
+from time import time
+import threading
+
+# Upper bounds of histogram buckets in seconds, the Prometheus client defaults plus a few slow ones.
+buckets = .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 300.
+
+class _Timings (threading.local):
+
+    def __init__(self):
+        # Stage totals in seconds while timings are collected, otherwise None.
+        self.stages = None
+        self.stack = []
+
+# Stage timings for the current thread.
+current = _Timings()
+
+def start_timings(enabled=True):
+    ''' Start collecting stage timings for this thread, or stop if not enabled.
+    '''
+    current.stages = dict() if enabled else None
+    current.stack = []
+
+def finish_timings():
+    ''' Stop collecting stage timings for this thread, and return a dict of them or None.
+    '''
+    stages, current.stages = current.stages, None
+    return stages
+
+def timed(stage):
+    ''' Decorate a function to add its run time to a stage.
+
+        Generator functions are timed while they run between yields.
+    '''
+    def decorator(function):
+        if isgeneratorfunction(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if current.stages is None:
+                    return function(*args, **kwargs)
+
+                return _iter_timed(stage, function(*args, **kwargs))
+
+        else:
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if current.stages is None:
+                    return function(*args, **kwargs)
+
+                _push(stage)
+
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    _pop()
+
+        return wrapper
+
+    return decorator
+
+def _iter_timed(stage, iterator):
+    ''' Generate items from an iterator, timing each step as a stage.
+    '''
+    while True:
+        _push(stage)
+
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _pop()
+
+        yield item
+
+def _push(stage):
+    current.stack.append([stage, time(), 0.])
+
+def _pop():
+    ''' Finish the innermost stage, adding its time less any nested stages.
+    '''
+    stage, start, nested = current.stack.pop()
+    elapsed = time() - start
+
+    if current.stack:
+        current.stack[-1][2] += elapsed
+
+    # Generators can outlive the request that made them.
+    if current.stages is not None:
+        current.stages[stage] = current.stages.get(stage, 0.) + elapsed - nested
+
+def server_timing(stages):
+    ''' Return a Server-Timing header value for a dict of stage timings.
+    '''
+    return ', '.join(['{0};dur={1:.1f}'.format(stage, seconds * 1000)
+                      for (stage, seconds) in sorted(stages.items())])
+
+class Histogram:
+
+    def __init__(self):
+        '''
+        Counts of observed values at or below each bucket, with their sum
+        '''
+        self.counts = [0] * len(buckets)
+        self.count, self.sum = 0, 0.
+
+    def observe(self, value):
+        for (index, bound) in enumerate(buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+        self.count += 1
+        self.sum += value
+
+class Metrics:
+
+    def __init__(self):
+        '''
+        Histograms of request and stage times in seconds, by route and stage
+
+        Each web process keeps its own, like any Prometheus client does.
+        '''
+        self.requests, self.stages = dict(), dict()
+        self.lock = threading.Lock()
+
+    def observe(self, route, seconds, stages):
+        ''' Add one request's time and its stage timings.
+        '''
+        with self.lock:
+            self.requests.setdefault(route, Histogram()).observe(seconds)
+
+            for (stage, stage_seconds) in stages.items():
+                self.stages.setdefault((route, stage), Histogram()).observe(stage_seconds)
+
+    def prometheus_text(self):
+        ''' Return all histograms in the Prometheus text exposition format.
+        '''
+        lines = []
+
+        with self.lock:
+            requests = [((('route', route), ), histogram) for (route, histogram) in self.requests.items()]
+            stages = [((('route', route), ('stage', stage)), histogram)
+                      for ((route, stage), histogram) in self.stages.items()]
+
+            for (name, words, histograms) in (('opentrails_request_seconds', 'Time spent handling requests.', requests),
+                                              ('opentrails_stage_seconds', 'Time spent in each stage of a request.', stages)):
+                lines.append('# HELP {0} {1}'.format(name, words))
+                lines.append('# TYPE {0} histogram'.format(name))
+
+                for (labels, histogram) in sorted(histograms):
+                    _histogram_lines(lines, name, labels, histogram)
+
+        return ''.join([line + '\n' for line in lines])
+
+def _histogram_lines(lines, name, labels, histogram):
+    ''' Add Prometheus sample lines for one histogram to a list.
+    '''
+    for (bound, count) in zip(buckets, histogram.counts):
+        lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels + (('le', '{0:g}'.format(bound)), )), count))
+
+    lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels + (('le', '+Inf'), )), histogram.count))
+    lines.append('{0}_sum{1} {2!r}'.format(name, _labels(labels), histogram.sum))
+    lines.append('{0}_count{1} {2}'.format(name, _labels(labels), histogram.count))
+
+def _labels(labels):
+    ''' Return a Prometheus label set, with values escaped.
+    '''
+    escaped = [(key, value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')) for (key, value) in labels]
+    return '{' + ','.join(['{0}="{1}"'.format(key, value) for (key, value) in escaped]) + '}'
+
+# Request metrics for this process.
+registry = Metrics()
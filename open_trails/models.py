@@ -1,7 +1,25 @@
 from open_trails import app
-import urlparse, os, urllib, boto, glob
+import urlparse, os, urllib, boto, glob, threading, itertools, hashlib, sqlite3, time, fcntl
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
+from tempfile import mkstemp, gettempdir
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
+from boto.exception import S3ResponseError
+
+from metrics import timed
+
+try:
+    from scandir import scandir
+except ImportError:
+    # Python 3.5 has os.scandir, and older ones have a backport on PyPI.
+    scandir = getattr(os, 'scandir', None)
+
+# Size of chunks copied between files; S3 multipart parts must be 5MB or more.
+chunk_size = 8 * 1024 * 1024
+
+# Number of S3 multipart parts uploaded at the same time.
+upload_workers = 4
 
 class Dataset:
 
@@ -17,86 +35,546 @@ class Dataset:
         # self.publisher = publisher
         # self.datastore = datastore
         self.datastore = None
+        self.manifest = None
         # self.status = None
         
         # for key in initial_data:
         #     setattr(self, key, initial_data[key])
 
+    def has(self, name):
+        ''' Return true if the manifest lists a finished artifact by name.
+        '''
+        return bool(self.manifest) and name in self.manifest['artifacts']
+
 class FilesystemDatastore:
 
     def __init__(self, dirpath):
         self.dirpath = dirpath
 
+    @timed('datastore-write')
     def write(self, filepath, buffer):
-        ''' Write a buffer for a single file.
+        ''' Write a buffer for a single file, and return its size and MD5.
         '''
         destination = os.path.join(self.dirpath, filepath)
+        written = dict()
 
         try:
             os.makedirs(os.path.dirname(destination))
         except OSError:
             pass
-        finally:
-            with open(destination, 'w') as output:
-                output.write(buffer.getvalue())
+        
+        # Write to a temporary file and move it into place, so that
+        # other processes never see a partly-written file.
+        handle, temporary = mkstemp(dir=os.path.dirname(destination), prefix='.write-')
+        
+        try:
+            with os.fdopen(handle, 'w') as output:
+                for chunk in iter_digested(iter_chunks(buffer), written):
+                    output.write(chunk)
+            os.chmod(temporary, 0644)
+        except:
+            os.remove(temporary)
+            raise
+        
+        os.rename(temporary, destination)
+        return written
     
+    @timed('datastore-read')
     def read(self, filepath):
-        ''' Return a buffer for a single file.
+        ''' Return a readable file object for a single file.
         '''
-        with open(os.path.join(self.dirpath, filepath), 'r') as input:
-            return StringIO(input.read())
+        return open(os.path.join(self.dirpath, filepath), 'rb')
     
-    def filelist(self, prefix):
-        ''' Retrieve a list of files under a name prefix.
+    def version(self, filepath):
+        ''' Return a string that changes when a file does, or None if it's missing.
         '''
-        names = []
-
-        for dirname, dirnames, filenames in os.walk(self.dirpath):
-            for filename in filenames:
-                name = os.path.relpath(os.path.join(dirname, filename), self.dirpath)
-                if name.startswith(prefix):
-                    names.append(name)
-
+        try:
+            stat = os.stat(os.path.join(self.dirpath, filepath))
+        except OSError:
+            return None
+        
+        # Each write renames a new file into place, with a new inode.
+        return '{0!r}-{1}-{2}'.format(stat.st_mtime, stat.st_size, stat.st_ino)
+    
+    def replace(self, filepath, data, version):
+        ''' Write a small file only if its version() is still the given one.
+        
+            Return true if it was written. A version of None means the file
+            must not exist yet. Writers hold a lock on the file's directory.
+        '''
+        dirname = os.path.dirname(os.path.join(self.dirpath, filepath))
+        
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            pass
+        
+        lock = os.open(dirname, os.O_RDONLY)
+        
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            
+            if self.version(filepath) != version:
+                return False
+            
+            self.write(filepath, StringIO(data))
+            return True
+        
+        finally:
+            os.close(lock)
+    
+    def url(self, filepath, expires=3600):
+        ''' Return a URL where a file can be downloaded directly, or None.
+        '''
+        return None
+    
+    def local_path(self, filepath):
+        ''' Return a local filesystem path for a single file, or None.
+        '''
+        return os.path.join(self.dirpath, filepath)
+    
+    def filelist(self, prefix, marker=None, max_keys=None):
+        ''' Generate names of files under a name prefix, in S3's sorted order.
+        
+            Only directories that can hold matching names are read, starting
+            with the deepest one named in the prefix. Names after the optional
+            marker are generated, up to an optional max_keys of them.
+        '''
+        start = prefix[:prefix.rfind('/') + 1]
+        names = self._iter_names(start, prefix, marker or '')
+        
+        if max_keys is not None:
+            names = itertools.islice(names, max_keys)
+        
         return names
+    
+    def _iter_names(self, base, prefix, marker):
+        ''' Generate sorted names of files under a base directory name.
+        '''
+        try:
+            entries = _list_directory(os.path.join(self.dirpath, base))
+        except OSError:
+            return
+        
+        # Directories sort as if followed by "/", just like S3 key names.
+        entries = sorted([(base + name + ('/' if is_dir else ''), is_dir)
+                          for (name, is_dir) in entries])
+        
+        for (name, is_dir) in entries:
+            if is_dir:
+                if not (name.startswith(prefix) or prefix.startswith(name)):
+                    continue
+                
+                if name < marker and not marker.startswith(name):
+                    # Every name in this directory comes before the marker.
+                    continue
+                
+                for subname in self._iter_names(name, prefix, marker):
+                    yield subname
+            
+            elif name.startswith(prefix) and name > marker:
+                yield name
 
     def datasets(self):
         ''' Retrieve a list of datasets based on directory names.
         '''
         return list(os.listdir(self.dirpath))
 
+def _list_directory(dirpath):
+    ''' Return a list of (name, is directory) tuples for a directory's entries.
+    '''
+    if scandir is None:
+        return [(name, os.path.isdir(os.path.join(dirpath, name)))
+                for name in os.listdir(dirpath)]
+
+    # scandir gets directory flags without a stat() call per entry.
+    return [(entry.name, entry.is_dir()) for entry in scandir(dirpath)]
+
 class S3Datastore:
 
     def __init__(self, key, secret, bucketname):
-        conn = boto.connect_s3(key, secret)
-        self.bucket = conn.get_bucket(bucketname)
+        self.key, self.secret = key, secret
+        self.bucketname = bucketname
+        self.local = threading.local()
 
-    #def __delete__(self):
-    #    self.conn.close()
+    @property
+    def bucket(self):
+        ''' Return a bucket for this thread, connecting if necessary.
+        
+            Boto connections aren't thread-safe, so each thread gets one of
+            its own. They keep their HTTP connections alive between requests,
+            and are made again in a forked process instead of being shared.
+        '''
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = boto.connect_s3(self.key, self.secret)
+            self.local.bucket = conn.get_bucket(self.bucketname)
+            self.local.pid = os.getpid()
+        
+        return self.local.bucket
 
+    @timed('datastore-write')
     def write(self, filepath, buffer):
-        ''' Write a buffer for a single file.
+        ''' Write a buffer for a single file, and return its size and MD5.
+        
+            Anything bigger than one chunk is sent as a multipart upload,
+            with up to upload_workers parts in flight at the same time.
         '''
-        k = Key(self.bucket)
-        k.key = filepath
-        k.set_contents_from_string(buffer.getvalue())
-        self.bucket.set_acl('public-read', k.key)
+        written = dict()
+        parts = iter_parts(iter_digested(iter_chunks(buffer), written), chunk_size)
+        first_part = next(parts, '')
+        second_part = next(parts, None)
+        
+        if second_part is None:
+            k = Key(self.bucket)
+            k.key = filepath
+            k.set_contents_from_string(first_part, policy='public-read')
+            return written
+        
+        upload = self.bucket.initiate_multipart_upload(filepath, policy='public-read')
+        
+        try:
+            all_parts = itertools.chain((first_part, second_part), parts)
+            self._upload_parts(upload, filepath, all_parts)
+        except:
+            upload.cancel_upload()
+            raise
+        else:
+            upload.complete_upload()
+        
+        return written
     
+    def _upload_parts(self, upload, filepath, parts):
+        ''' Upload parts in the shared thread pool, holding only a few in memory at once.
+        '''
+        pool, pending = get_upload_pool(), []
+        
+        try:
+            for (number, part) in enumerate(parts, 1):
+                if len(pending) == upload_workers:
+                    pending.pop(0).get()
+                
+                args = upload.id, filepath, number, part
+                pending.append(pool.apply_async(self._upload_part, args))
+        
+        finally:
+            # Parts still in flight must finish before the upload is cancelled.
+            for result in pending:
+                result.wait()
+        
+        for result in pending:
+            result.get()
+        
+    def _upload_part(self, upload_id, filepath, number, part):
+        ''' Upload one part of a multipart upload, using this thread's connection.
+        '''
+        upload = MultiPartUpload(self.bucket)
+        upload.id, upload.key_name = upload_id, filepath
+        upload.upload_part_from_file(StringIO(part), number)
+    
+    @timed('datastore-read')
     def read(self, filepath):
-        ''' Return a buffer for a single file.
+        ''' Return a readable file object for a single file.
+        '''
+        key = self.bucket.get_key(filepath)
+        return S3File(key)
+    
+    def version(self, filepath):
+        ''' Return a string that changes when a file does, or None if it's missing.
         '''
         key = self.bucket.get_key(filepath)
-        return StringIO(key.get_contents_as_string())
+        return key and key.etag
+    
+    def replace(self, filepath, data, version):
+        ''' Write a small file only if its version() is still the given one.
+        
+            Return true if it was written. A version of None means the file
+            must not exist yet. S3 checks the ETag with a conditional request.
+        '''
+        k = Key(self.bucket)
+        k.key = filepath
+        headers = {'If-Match': version} if version else {'If-None-Match': '*'}
+        
+        try:
+            k.set_contents_from_string(data, headers=headers, policy='public-read')
+        except S3ResponseError, e:
+            # 412 when the ETag didn't match, 409 when another write got there first.
+            if e.status in (409, 412):
+                return False
+            raise
+        
+        return True
     
-    def filelist(self, prefix):
-        ''' Retrieve a list of files under a name prefix.
+    def url(self, filepath, expires=3600):
+        ''' Return a URL where a file can be downloaded directly, or None.
+        
+            URLs are signed so they work for private keys too, and are made
+            without a request to S3.
+        '''
+        return self.bucket.new_key(filepath).generate_url(expires)
+    
+    def local_path(self, filepath):
+        ''' Return a local filesystem path for a single file, or None.
         '''
-        return [file.name for file in self.bucket.list(prefix)]
+        return None
+    
+    def filelist(self, prefix, marker=None, max_keys=None):
+        ''' Generate names of files under a name prefix, in sorted order.
+        
+            Names after the optional marker are generated, up to an optional
+            max_keys of them. Keys are requested a page at a time as needed.
+        '''
+        names = (key.name for key in self.bucket.list(prefix, marker=marker or ''))
+        
+        if max_keys is not None:
+            names = itertools.islice(names, max_keys)
+        
+        return names
 
     def datasets(self):
         ''' Retrieve a list of datasets based on directory names.
         '''
         return [dataset.name.replace('/', '') for dataset in self.bucket.list('', '/')]
 
+class S3File:
+
+    def __init__(self, key, block_size=1024*1024):
+        '''
+        Read-only file object for an S3 key, fetching byte ranges as they're read
+        '''
+        self.key = key
+        self.size = key.size
+        self.block_size = block_size
+        self.position = 0
+        self.block, self.block_start = '', 0
+        self.closed = False
+    
+    @timed('datastore-read')
+    def read(self, size=-1):
+        ''' Read up to size bytes, fetching at least block_size at a time.
+        '''
+        if size < 0 or self.position + size > self.size:
+            size = max(0, self.size - self.position)
+        
+        chunks = []
+        
+        while size > 0:
+            offset = self.position - self.block_start
+            
+            if not 0 <= offset < len(self.block):
+                self._fetch(self.position, max(size, self.block_size))
+                offset = 0
+            
+            chunk = self.block[offset:offset + size]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        
+        return ''.join(chunks)
+    
+    def _fetch(self, start, length):
+        end = min(start + length, self.size) - 1
+        headers = {'Range': 'bytes={0}-{1}'.format(start, end)}
+        self.block, self.block_start = self.key.get_contents_as_string(headers), start
+    
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        
+        self.position = max(0, offset)
+    
+    def tell(self):
+        return self.position
+    
+    def close(self):
+        self.block, self.closed = '', True
+
+def iter_chunks(buffer, size=chunk_size):
+    ''' Generate string chunks from a string, file-like object, or iterator.
+    
+        File-like objects are read from the start if they can seek, like
+        StringIO.getvalue() used to do.
+    '''
+    if isinstance(buffer, basestring):
+        yield buffer
+        return
+    
+    if not hasattr(buffer, 'read'):
+        for chunk in buffer:
+            yield chunk
+        return
+    
+    if hasattr(buffer, 'seek'):
+        buffer.seek(0)
+    
+    while True:
+        chunk = buffer.read(size)
+        
+        if not chunk:
+            break
+        
+        yield chunk
+
+def iter_digested(chunks, written):
+    ''' Generate chunks unchanged, noting their total size and MD5 in written.
+    '''
+    md5, size = hashlib.md5(), 0
+    
+    for chunk in chunks:
+        md5.update(chunk)
+        size += len(chunk)
+        yield chunk
+    
+    written.update(size=size, md5=md5.hexdigest())
+
+def iter_parts(chunks, size):
+    ''' Regroup string chunks into parts of at least size bytes, except the last.
+    '''
+    part, length = [], 0
+    
+    for chunk in chunks:
+        part.append(chunk)
+        length += len(chunk)
+        
+        if length >= size:
+            yield ''.join(part)
+            part, length = [], 0
+    
+    if part:
+        yield ''.join(part)
+
+class DatasetIndex:
+
+    def __init__(self, path):
+        '''
+        SQLite catalog of datasets, listed newest first a page at a time
+        '''
+        self.path = path
+        
+        self.execute('''CREATE TABLE IF NOT EXISTS datasets
+                        (id TEXT PRIMARY KEY, created REAL NOT NULL, kind TEXT)''')
+        self.execute('''CREATE INDEX IF NOT EXISTS datasets_created
+                        ON datasets (created, id)''')
+    
+    def execute(self, query, args=(), many=False):
+        ''' Run a query in its own connection and transaction, and return all rows.
+        
+            Connections aren't kept, so they're never shared across a fork.
+        '''
+        db = sqlite3.connect(self.path, timeout=10)
+        
+        try:
+            with db:
+                if many:
+                    return db.executemany(query, args).fetchall()
+                return db.execute(query, args).fetchall()
+        finally:
+            db.close()
+    
+    def add(self, dataset_id, kind=None, created=None):
+        ''' Add a dataset, created now unless a time is given.
+        '''
+        self.add_all([(dataset_id, kind, time.time() if created is None else created)])
+    
+    def add_all(self, datasets):
+        ''' Add a list of (id, kind, created) datasets, ignoring any already here.
+        '''
+        self.execute('''INSERT OR IGNORE INTO datasets (id, kind, created)
+                        VALUES (?, ?, ?)''', datasets, many=True)
+    
+    def page(self, after=None, limit=50):
+        ''' Return a list of (id, kind, created) datasets and a cursor for the next page.
+        
+            Cursors are (created, id) tuples, and None on the last page. Only
+            one page of rows is read, however many datasets there are.
+        '''
+        query = 'SELECT id, kind, created FROM datasets'
+        args = []
+        
+        if after:
+            created, dataset_id = after
+            query += ' WHERE created < ? OR (created = ? AND id < ?)'
+            args += [created, created, dataset_id]
+        
+        query += ' ORDER BY created DESC, id DESC LIMIT ?'
+        args.append(limit + 1)
+        
+        rows = self.execute(query, args)
+        
+        if len(rows) <= limit:
+            return rows, None
+        
+        (dataset_id, kind, created) = rows[limit - 1]
+        return rows[:limit], (created, dataset_id)
+
+# Shared dataset indexes by process ID and path, see get_dataset_index().
+_dataset_indexes = {}
+
+def get_dataset_index(config):
+    ''' Return a shared dataset index for this process, making it if necessary.
+    
+        A new index file starts with every dataset already in the datastore,
+        though without the times they were created.
+    '''
+    path = config.get('DATASET_INDEX')
+    
+    if not path:
+        # The default index only sees datasets made on this host, so a
+        # datastore that could be shared between hosts needs one chosen on purpose.
+        if (config['DATASTORE'] or '').startswith('s3n:'):
+            raise RuntimeError('DATASET_INDEX must be set for an S3 DATASTORE')
+        
+        path = os.path.join(gettempdir(), 'open-trails-datasets.sqlite')
+    
+    key = os.getpid(), path
+    
+    if key not in _dataset_indexes:
+        is_new = not os.path.exists(path)
+        index = DatasetIndex(path)
+        
+        if is_new:
+            datastore = get_datastore(config['DATASTORE'])
+            index.add_all([(id, None, 0) for id in datastore.datasets()])
+        
+        _dataset_indexes[key] = index
+    
+    return _dataset_indexes[key]
+
+# Shared S3 upload thread pools by process ID, see get_upload_pool().
+_upload_pools = {}
+_upload_pools_lock = threading.Lock()
+
+def get_upload_pool():
+    ''' Return a shared thread pool for S3 multipart uploads in this process.
+    
+        Its threads live as long as the process, so they keep their S3
+        connections open between uploads instead of making new ones.
+    '''
+    key = os.getpid()
+    
+    with _upload_pools_lock:
+        if key not in _upload_pools:
+            _upload_pools[key] = ThreadPool(upload_workers)
+    
+    return _upload_pools[key]
+
+# Shared datastores by process ID and configuration, see get_datastore().
+_datastores = {}
+
+def get_datastore(config):
+    ''' Return a shared datastore for this process, making it if necessary.
+    
+        Datastores are kept per process, because gunicorn forks after import.
+    '''
+    key = os.getpid(), config
+    
+    if key not in _datastores:
+        # Threads racing here each make one, and all but one is thrown away.
+        _datastores[key] = make_datastore(config)
+    
+    return _datastores[key]
+
 def make_datastore(config):
     ''' Returns an object with an upload method.
     '''
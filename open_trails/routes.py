@@ -1,17 +1,52 @@
 from open_trails import app
-from models import Dataset, make_datastore
+from models import Dataset, get_datastore, get_dataset_index
 from functions import (
-    get_dataset, clean_name, unzip, make_id_from_url, zip_file, allowed_file,
+    get_dataset, clean_name, make_id_from_url, zip_file, allowed_file,
     get_sample_segment_features, make_named_trails, package_opentrails_archive,
     get_sample_trailhead_features, get_sample_transformed_trailhead_features,
-    get_sample_transformed_segments_features
+    get_sample_transformed_segments_features, iter_geojson_features,
+    open_zipped_geojson, load_messages, record_artifact, summarize_messages,
+    temp_bytes_written, archive_name, can_build_opentrails_archive,
+    build_opentrails_archive, get_opentrails_archive
     )
-from transformers import shapefile2geojson, segments_transform, trailheads_transform
+from jobs import start_job, read_job, convert_upload, transform_upload
 from validators import check_open_trails
-from flask import request, render_template, redirect, make_response, send_file
-import json, os, csv, zipfile, time, re, shutil, uuid
+from topology import make_connected_named_trails
+from metrics import start_timings, finish_timings, server_timing, registry
+from flask import request, render_template, redirect, make_response, send_file, g, Response
+import json, os, csv, zipfile, time, re, uuid, math
 from StringIO import StringIO
-from tempfile import mkdtemp
+from tempfile import NamedTemporaryFile
+from urlparse import urljoin
+from urllib import urlencode
+
+@app.before_request
+def start_timer():
+    g.request_start = time.time()
+    temp_bytes_written.value = 0
+    start_timings(app.config['REQUEST_METRICS'] or app.config['SERVER_TIMING_HEADER'])
+
+@app.after_request
+def report_time(response):
+    ''' Report how long each request took and how much it wrote to temp files.
+
+        With REQUEST_METRICS or SERVER_TIMING_HEADER set, time spent in
+        each stage is also added to /metrics or sent in a header.
+    '''
+    elapsed = (time.time() - g.request_start) * 1000
+    response.headers['X-Response-Time'] = '{0:.1f}ms'.format(elapsed)
+    response.headers['X-Temp-Bytes-Written'] = str(temp_bytes_written.value)
+
+    stages = finish_timings()
+
+    if stages is not None:
+        if app.config['REQUEST_METRICS'] and request.endpoint:
+            registry.observe(request.endpoint, elapsed / 1000, stages)
+
+        if app.config['SERVER_TIMING_HEADER'] and stages:
+            response.headers['Server-Timing'] = server_timing(stages)
+
+    return response
 
 @app.route('/')
 def index():
@@ -20,11 +55,66 @@ def index():
 @app.route('/datasets')
 def datasets():
     '''
-    List out all the datasets that have used opentrails so far
+    List out the datasets that have used opentrails so far, a page at a time
+    '''
+    try:
+        datasets_list, next_url = get_datasets_page('/datasets')
+    except ValueError:
+        return make_response("Bad page cursor", 400)
+
+    return render_template('datasets_list.html', datasets_list=datasets_list, next_url=next_url)
+
+@app.route('/datasets.json')
+def datasets_json():
+    '''
+    List out datasets a page at a time, for other programs
+    '''
+    try:
+        datasets_list, next_url = get_datasets_page('/datasets.json')
+    except ValueError:
+        return make_response("Bad page cursor", 400)
+
+    response = make_response(json.dumps(dict(datasets=datasets_list, next=next_url)))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+def get_datasets_page(base_url):
+    '''
+    Return a list of dataset dictionaries from the index, and a URL for the next page
+
+    Raises ValueError for an "after" cursor that didn't come from a next page URL.
+    '''
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    index = get_dataset_index(app.config)
+    rows, cursor = index.page(parse_datasets_cursor(request.args.get('after')), limit)
+
+    datasets_list = [dict(id=id, kind=kind, created=created or None,
+                          url=urljoin(request.url_root, '{0}/{1}/'.format('checks' if kind == 'check' else 'datasets', id)))
+                     for (id, kind, created) in rows]
+
+    if cursor is None:
+        return datasets_list, None
+
+    after = '{0!r}:{1}'.format(*cursor)
+    return datasets_list, '{0}?{1}'.format(base_url, urlencode(dict(after=after, limit=limit)))
+
+def parse_datasets_cursor(after):
+    '''
+    Return a (created, id) cursor from a "created:id" string, or None
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
-    datasets_list = datastore.datasets()
-    return render_template('datasets_list.html', datasets_list=datasets_list, server_url=request.url_root)
+    if not after:
+        return None
+
+    if ':' not in after:
+        raise ValueError('Missing ":" in cursor {0!r}'.format(after))
+
+    created, dataset_id = after.split(':', 1)
+    created = float(created)
+
+    if math.isnan(created) or math.isinf(created):
+        raise ValueError('Bad time in cursor {0!r}'.format(after))
+
+    return created, dataset_id
 
 @app.route('/check-dataset', methods=['POST'])
 def check_dataset():
@@ -35,11 +125,12 @@ def check_dataset():
     # Make a new dataset object
     id = str(uuid.uuid4())
     dataset = Dataset(id)
-    dataset.datastore = make_datastore(app.config['DATASTORE'])
+    dataset.datastore = get_datastore(app.config['DATASTORE'])
     
     # Write a verifying file to prove we created these folders
     validname = '{0}/uploads/.valid'.format(dataset.id)
     dataset.datastore.write(validname, StringIO(dataset.id))
+    get_dataset_index(app.config).add(dataset.id, 'check')
 
     return redirect('/checks/' + dataset.id)
 
@@ -52,11 +143,12 @@ def new_dataset():
     # Make a new dataset object
     id = str(uuid.uuid4())
     dataset = Dataset(id)
-    dataset.datastore = make_datastore(app.config['DATASTORE'])
+    dataset.datastore = get_datastore(app.config['DATASTORE'])
     
     # Write a verifying file to prove we created these folders
     validname = '{0}/uploads/.valid'.format(dataset.id)
     dataset.datastore.write(validname, StringIO(dataset.id))
+    get_dataset_index(app.config).add(dataset.id, 'dataset')
 
     return redirect('/datasets/' + dataset.id)
 
@@ -66,38 +158,32 @@ def upload(dataset_id):
     '''
     Upload a zip of one shapefile to datastore
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
+    if not get_dataset(datastore, dataset_id):
+        return make_response("No Dataset Found", 404)
 
     # Check that they uploaded a .zip file
     if not request.files['file'] or not allowed_file(request.files['file'].filename):
         return make_response("Only .zip files allowed", 403)
 
-    # Upload original file to S3
-    zip_buff = StringIO(request.files['file'].read())
+    # Upload original file to S3, streaming it from the request
+    zip_buff = request.files['file'].stream
     zip_base = '{0}/uploads/trail-segments'.format(dataset_id)
-    datastore.write(zip_base + '.zip', zip_buff)
+    written = datastore.write(zip_base + '.zip', zip_buff)
+    record_artifact(datastore, dataset_id, 'uploads/trail-segments.zip', written)
 
-    # Get geojson data from shapefile
-    shapefile_path = unzip(zip_buff)
-    geojson_obj = shapefile2geojson(shapefile_path)
-
-    # Compress geojson file
-    geojson_zip = StringIO()
-    geojson_raw = json.dumps(geojson_obj)
-    zip_file(geojson_zip, geojson_raw, 'trail-segments.geojson')
-    
-    # Upload .geojson.zip file to datastore
-    datastore.write(zip_base + '.geojson.zip', geojson_zip)
+    # Convert it to geojson in the background
+    redirect_url = '/datasets/' + dataset_id + "/sample-segment"
+    job = start_job(app.config, dataset_id, convert_upload, ('segments', ), redirect_url)
 
-    # Show sample data from original file
-    return redirect('/datasets/' + dataset_id + "/sample-segment")
+    return job_response(dataset_id, job)
 
 @app.route('/datasets/<dataset_id>/sample-segment')
 def show_sample_segment(dataset_id):
     '''
     Show an example row of data
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No dataset Found", 404)
@@ -115,39 +201,25 @@ def transform_segments(dataset_id):
     Unzip it
     Transform into opentrails
     Upload
+
+    Work happens in a background job, see transform_upload()
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
 
-    # Download the original segments file
-    up_segments_name = '{0}/uploads/trail-segments.geojson.zip'.format(dataset.id)
-    up_segments_zip = datastore.read(up_segments_name)
-
-    # Unzip it
-    up_segments_path = unzip(up_segments_zip, '.geojson', [])
-    up_segments = json.load(open(up_segments_path))
-    messages, ot_segments = segments_transform(up_segments, dataset)
-
-    # Save messages for output
-    transform_messages_path = dataset.id + "/opentrails/segments-messages.json"
-    datastore.write(transform_messages_path, StringIO(json.dumps(messages)))
-
-    # Make a zip from transformed segments
-    ot_segments_zip = StringIO()
-    ot_segments_raw = json.dumps(ot_segments, sort_keys=True)
-    zip_file(ot_segments_zip, ot_segments_raw, 'segments.geojson')
+    # Transform it in the background
+    redirect_url = '/datasets/' + dataset.id + '/transformed-segments'
+    args = ('segments', app.config['TRANSFORM_WORKERS'], app.config['TRANSFORM_CHUNK_SIZE'],
+            app.config['GEOMETRY_DECIMALS'], app.config['SIMPLIFY_TOLERANCE'])
+    job = start_job(app.config, dataset.id, transform_upload, args, redirect_url)
 
-    # Upload transformed segments and messages
-    zip_path = '{0}/opentrails/segments.geojson.zip'.format(dataset.id)
-    datastore.write(zip_path, ot_segments_zip)
-
-    return redirect('/datasets/' + dataset.id + '/transformed-segments', code=303)
+    return job_response(dataset.id, job)
 
 @app.route('/datasets/<dataset_id>/transformed-segments')
 def transformed_segments(dataset_id):
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
@@ -162,19 +234,14 @@ def transformed_segments(dataset_id):
 
     # Download the transformed segments messages file
     transformed_segments_messages = dataset.id + '/opentrails/segments-messages.json'
-    data = json.load(datastore.read(transformed_segments_messages))
-
-    try:
-        messages = [(type, id, words) for (type, id, words) in data]
-    except ValueError:
-        # Old stored format.
-        messages = [(type, None, words) for (type, words) in data]
+    messages, message_counts = load_messages(json.load(datastore.read(transformed_segments_messages)))
 
     message_types = [message[0] for message in messages]
 
     vars = dict(
         dataset = dataset,
         messages = messages,
+        message_counts = message_counts,
         uploaded_keys = uploaded_keys,
         uploaded_features = uploaded_features,
         transformed_features = transformed_features,
@@ -186,7 +253,7 @@ def transformed_segments(dataset_id):
 
 @app.route('/datasets/<dataset_id>/name-trails', methods=['POST'])
 def name_trails(dataset_id):
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
@@ -195,12 +262,16 @@ def name_trails(dataset_id):
     transformed_segments_path = '{0}/opentrails/segments.geojson.zip'.format(dataset.id)
     transformed_segments_zip = datastore.read(transformed_segments_path)
 
-    # Unzip it
-    segments_path = unzip(transformed_segments_zip, '.geojson', [])
-    transformed_segments = json.load(open(segments_path))
+    # Read features from it one at a time
+    transformed_segments = iter_geojson_features(open_zipped_geojson(transformed_segments_zip))
 
-    # Generate a list of (name, ids) tuples
-    named_trails = make_named_trails(transformed_segments['features'])
+    # Group segment IDs by trail name, and optionally by connections too
+    if app.config['CONNECTED_TRAILS_TOLERANCE'] is not None:
+        named_trails = make_connected_named_trails(transformed_segments,
+                                                   app.config['CONNECTED_TRAILS_TOLERANCE'],
+                                                   app.config['NORMALIZE_TRAIL_NAMES'])
+    else:
+        named_trails = make_named_trails(transformed_segments, app.config['NORMALIZE_TRAIL_NAMES'])
     
     file = StringIO()
     cols = 'id', 'name', 'segment_ids', 'description', 'part_of'
@@ -210,13 +281,14 @@ def name_trails(dataset_id):
         writer.writerow([(row[c] or '').encode('utf8') for c in cols])
 
     named_trails_path = '{0}/opentrails/named_trails.csv'.format(dataset.id)
-    datastore.write(named_trails_path, file)
+    written = datastore.write(named_trails_path, file)
+    record_artifact(datastore, dataset.id, 'opentrails/named_trails.csv', written, features=len(named_trails))
 
     return redirect('/datasets/' + dataset.id + '/named-trails', code=303)
 
 @app.route('/datasets/<dataset_id>/named-trails')
 def named_trails(dataset_id):
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
@@ -225,7 +297,7 @@ def named_trails(dataset_id):
 
 @app.route('/datasets/<dataset_id>/create-steward', methods=['POST'])
 def create_steward(dataset_id):
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
@@ -243,13 +315,18 @@ def create_steward(dataset_id):
     writer.writerow([(v or '').encode('utf8') for v in steward_values])
     
     stewards_path = '{0}/opentrails/stewards.csv'.format(dataset.id)
-    datastore.write(stewards_path, file)
+    written = datastore.write(stewards_path, file)
+    dataset.manifest = record_artifact(datastore, dataset.id, 'opentrails/stewards.csv', written)
+
+    # Stewards can be the last step, so the download is ready right away.
+    if can_build_opentrails_archive(dataset):
+        build_opentrails_archive(dataset)
 
     return redirect('/datasets/' + dataset.id + '/stewards', code=303)
 
 @app.route('/datasets/<dataset_id>/stewards')
 def view_stewards(dataset_id):
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
@@ -258,7 +335,7 @@ def view_stewards(dataset_id):
 
 @app.route('/datasets/<dataset_id>/no-trailheads', methods=['POST', 'GET'])
 def no_trailheads(dataset_id):
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
@@ -269,38 +346,32 @@ def upload_trailheads(dataset_id):
     '''
     Upload a zip of one shapefile to datastore
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
+    if not get_dataset(datastore, dataset_id):
+        return make_response("No Dataset Found", 404)
 
     # Check that they uploaded a .zip file
     if not request.files['file'] or not allowed_file(request.files['file'].filename):
         return make_response("Only .zip files allowed", 403)
 
-    # Upload original file to S3
-    zip_buff = StringIO(request.files['file'].read())
+    # Upload original file to S3, streaming it from the request
+    zip_buff = request.files['file'].stream
     zip_base = '{0}/uploads/trail-trailheads'.format(dataset_id)
-    datastore.write(zip_base + '.zip', zip_buff)
-
-    # Get geojson data from shapefile
-    shapefile_path = unzip(zip_buff)
-    geojson_obj = shapefile2geojson(shapefile_path)
+    written = datastore.write(zip_base + '.zip', zip_buff)
+    record_artifact(datastore, dataset_id, 'uploads/trail-trailheads.zip', written)
 
-    # Compress geojson file
-    geojson_zip = StringIO()
-    geojson_raw = json.dumps(geojson_obj)
-    zip_file(geojson_zip, geojson_raw, 'trail-trailheads.geojson')
-    
-    # Upload .geojson.zip file to datastore
-    datastore.write(zip_base + '.geojson.zip', geojson_zip)
+    # Convert it to geojson in the background
+    redirect_url = '/datasets/' + dataset_id + "/sample-trailhead"
+    job = start_job(app.config, dataset_id, convert_upload, ('trailheads', ), redirect_url)
 
-    # Show sample data from original file
-    return redirect('/datasets/' + dataset_id + "/sample-trailhead")
+    return job_response(dataset_id, job)
 
 @app.route('/datasets/<dataset_id>/sample-trailhead')
 def show_sample_trailhead(dataset_id):
     '''
     Show an example row of data
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No dataset Found", 404)
@@ -318,39 +389,25 @@ def transform_trailheads(dataset_id):
     Unzip it
     Transform into opentrails
     Upload
+
+    Work happens in a background job, see transform_upload()
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
 
-    # Download the original trailheads file
-    up_trailheads_name = '{0}/uploads/trail-trailheads.geojson.zip'.format(dataset.id)
-    up_trailheads_zip = datastore.read(up_trailheads_name)
+    # Transform it in the background
+    redirect_url = '/datasets/' + dataset.id + '/transformed-trailheads'
+    args = ('trailheads', 1, app.config['TRANSFORM_CHUNK_SIZE'],
+            app.config['GEOMETRY_DECIMALS'], app.config['SIMPLIFY_TOLERANCE'])
+    job = start_job(app.config, dataset.id, transform_upload, args, redirect_url)
 
-    # Unzip it
-    up_trailheads_path = unzip(up_trailheads_zip, '.geojson', [])
-    up_trailheads = json.load(open(up_trailheads_path))
-    messages, ot_trailheads = trailheads_transform(up_trailheads, dataset)
-
-    # Save messages for output
-    transform_messages_path = dataset.id + "/opentrails/trailheads-messages.json"
-    datastore.write(transform_messages_path, StringIO(json.dumps(messages)))
-
-    # Make a zip from transformed trailheads
-    ot_trailheads_zip = StringIO()
-    ot_trailheads_raw = json.dumps(ot_trailheads, sort_keys=True)
-    zip_file(ot_trailheads_zip, ot_trailheads_raw, 'trailheads.geojson')
-
-    # Upload transformed trailheads and messages
-    zip_path = '{0}/opentrails/trailheads.geojson.zip'.format(dataset.id)
-    datastore.write(zip_path, ot_trailheads_zip)
-
-    return redirect('/datasets/' + dataset.id + '/transformed-trailheads', code=303)
+    return job_response(dataset.id, job)
 
 @app.route('/datasets/<dataset_id>/transformed-trailheads')
 def transformed_trailheads(dataset_id):
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
@@ -365,19 +422,14 @@ def transformed_trailheads(dataset_id):
 
     # Download the transformed trailheads messages file
     messages_path = '{0}/opentrails/trailheads-messages.json'.format(dataset.id)
-    data = json.load(datastore.read(messages_path))
-
-    try:
-        messages = [(type, id, words) for (type, id, words) in data]
-    except ValueError:
-        # Old stored format.
-        messages = [(type, None, words) for (type, words) in data]
+    messages, message_counts = load_messages(json.load(datastore.read(messages_path)))
 
     message_types = [message[0] for message in messages]
 
     vars = dict(
         dataset = dataset,
         messages = messages,
+        message_counts = message_counts,
         uploaded_keys = uploaded_keys,
         uploaded_features = uploaded_features,
         transformed_features = transformed_features,
@@ -387,39 +439,97 @@ def transformed_trailheads(dataset_id):
 
     return render_template('dataset-08-transformed-trailheads.html', **vars)
 
+@app.route('/datasets/<dataset_id>/jobs/<job_id>')
+def job_status(dataset_id, job_id):
+    '''
+    Report on the state and progress of a background job
+    '''
+    datastore = get_datastore(app.config['DATASTORE'])
+    job = read_job(datastore, dataset_id, job_id)
+    if not job:
+        return make_response("No Job Found", 404)
+
+    response = make_response(json.dumps(job), 200)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+def job_response(dataset_id, job):
+    '''
+    Redirect to a finished job's next page, or show progress for one still running
+    '''
+    if job['state'] == 'finished':
+        return redirect(job['redirect'], code=303)
+
+    status_url = '/datasets/{0}/jobs/{1}'.format(dataset_id, job['id'])
+    response = make_response(render_template('job-progress.html', job=job, status_url=status_url), 202)
+    response.headers['Location'] = status_url
+    return response
+
 @app.route('/datasets/<dataset_id>/open-trails.zip')
 def download_opentrails_data(dataset_id):
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No Dataset Found", 404)
 
-    buffer = package_opentrails_archive(dataset)
+    if not can_build_opentrails_archive(dataset):
+        # Stream the archive as it's put together, with chunked transfer encoding
+        chunks = package_opentrails_archive(dataset)
+        return Response(chunks, mimetype='application/zip')
+
+    archive = get_opentrails_archive(dataset)
+    archive_path = '{0}/{1}'.format(dataset.id, archive_name)
+
+    if archive['md5'] in request.if_none_match:
+        response = make_response('', 304)
 
-    return send_file(buffer, 'application/zip')
+    elif datastore.url(archive_path):
+        response = redirect(datastore.url(archive_path), code=302)
+
+    elif app.config['ACCEL_REDIRECT_PREFIX']:
+        response = make_response('', 200)
+        response.mimetype = 'application/zip'
+        response.headers['X-Accel-Redirect'] = app.config['ACCEL_REDIRECT_PREFIX'] + archive_path
+
+    else:
+        # Sent with X-Sendfile when USE_X_SENDFILE is configured.
+        response = send_file(datastore.local_path(archive_path), 'application/zip', add_etags=False)
+
+    response.set_etag(archive['md5'])
+    return response
 
 @app.route('/datasets/<id>/')
 def existing_dataset(id):
     '''
-    Reads available files on S3 to figure out how far a dataset has gotten in the process
+    Reads the dataset manifest to figure out how far a dataset has gotten in the process
     '''
-
-    # Init some variable
-    # sample_segment, opentrails_sample_segment = False, False
-
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, id)
     if not dataset:
         return make_response("No dataset Found", 404)
 
-    # return render_template('index.html', steward = steward, sample_segment = sample_segment, opentrails_sample_segment = opentrails_sample_segment)
+    # Resume at the page after the last finished step.
+    for (name, page) in resume_pages:
+        if dataset.has(name):
+            return redirect('/datasets/{0}/{1}'.format(dataset.id, page))
+
     return render_template('dataset-01-upload-segments.html', dataset=dataset)
 
+# Pages to resume at, for the furthest artifact a dataset has finished.
+resume_pages = (
+    ('opentrails/trailheads.geojson.zip', 'transformed-trailheads'),
+    ('uploads/trail-trailheads.geojson.zip', 'sample-trailhead'),
+    ('opentrails/stewards.csv', 'stewards'),
+    ('opentrails/named_trails.csv', 'named-trails'),
+    ('opentrails/segments.geojson.zip', 'transformed-segments'),
+    ('uploads/trail-segments.geojson.zip', 'sample-segment')
+    )
+
 @app.route('/checks/<id>/')
 def existing_validation(id):
     '''
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, id)
     if not dataset:
         return make_response("No dataset Found", 404)
@@ -430,42 +540,43 @@ def existing_validation(id):
 def validate_upload(dataset_id):
     ''' 
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
+    if not get_dataset(datastore, dataset_id):
+        return make_response("No Dataset Found", 404)
 
     # Check that they uploaded a .zip file
     if not request.files['file'] or not allowed_file(request.files['file'].filename):
         return make_response("Only .zip files allowed", 403)
         
-    # Read zip data to buffer
-    zipfile_data = StringIO()
+    # Read zip data to a temporary file, with a name for validators to open.
+    zipfile_data = NamedTemporaryFile(prefix='validate-', suffix='.zip')
     zipfile_path = '{0}/uploads/open-trails.zip'.format(dataset_id)
-    request.files['file'].save(zipfile_data)
 
-    # Upload original file data to S3
-    datastore.write(zipfile_path, zipfile_data)
+    try:
+        request.files['file'].save(zipfile_data)
+        zipfile_data.flush()
 
-    # Validate data locally.
-    zf = zipfile.ZipFile(zipfile_data, 'r')
-    local_dir = mkdtemp(prefix='validate-')
+        # Upload original file data to S3
+        written = datastore.write(zipfile_path, zipfile_data)
+        record_artifact(datastore, dataset_id, 'uploads/open-trails.zip', written)
 
-    names = ['trail_segments.geojson', 'named_trails.csv',
-             'trailheads.geojson', 'stewards.csv', 'areas.geojson']
+        # Validate files straight from the zip, without unzipping them.
+        names = ['trail_segments.geojson', 'named_trails.csv',
+                 'trailheads.geojson', 'stewards.csv', 'areas.geojson']
 
-    for name in sorted(zf.namelist()):
-        base, (_, ext) = os.path.basename(name), os.path.splitext(name)
+        members = dict([(os.path.basename(name), name) for name
+                        in sorted(zipfile.ZipFile(zipfile_data.name).namelist())])
 
-        if base in names:
-            with open(os.path.join(local_dir, base), 'w') as file:
-                file.write(zf.open(name).read())
+        args = [(zipfile_data.name, members[base]) if base in members else None for base in names]
+        messages, succeeded = check_open_trails(*args, workers=app.config['VALIDATE_WORKERS'])
+
+    finally:
+        zipfile_data.close()
 
-    args = [os.path.join(local_dir, base) for base in names]
-    messages, succeeded = check_open_trails(*args)
-    
-    # Clean up after ourselves.
-    shutil.rmtree(local_dir)
-    
     path = '{0}/opentrails/validate-messages.json'.format(dataset_id)
-    datastore.write(path, StringIO(json.dumps(messages)))
+    written = datastore.write(path, StringIO(json.dumps(messages.counted_list())))
+    record_artifact(datastore, dataset_id, 'opentrails/validate-messages.json', written,
+                    messages=summarize_messages(messages), passed=succeeded)
 
     # Show sample data from original file
     return redirect('/checks/' + dataset_id + "/results", code=303)
@@ -474,15 +585,15 @@ def validate_upload(dataset_id):
 def validated_results(dataset_id):
     ''' 
     '''
-    datastore = make_datastore(app.config['DATASTORE'])
+    datastore = get_datastore(app.config['DATASTORE'])
     dataset = get_dataset(datastore, dataset_id)
     if not dataset:
         return make_response("No dataset Found", 404)
 
     path = '{0}/opentrails/validate-messages.json'.format(dataset.id)
-    messages = map(tuple, json.load(datastore.read(path)))
+    messages, message_counts = load_messages(json.load(datastore.read(path)))
     
-    return render_template('check-02-validated-opentrails.html', messages=messages)
+    return render_template('check-02-validated-opentrails.html', messages=messages, message_counts=message_counts)
 
 @app.route('/errors/<error_id>')
 def get_error(error_id):
@@ -498,7 +609,7 @@ def status():
 
     # Connect to S3
     try:
-      datastore = make_datastore(app.config['DATASTORE'])
+      datastore = get_datastore(app.config['DATASTORE'])
     except AttributeError:
       response['status'] = 'Can\'t parse S3 auth'
       response = make_response(json.dumps(response), 403)
@@ -511,3 +622,14 @@ def status():
 
     response = make_response(json.dumps(response), 200)
     return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    ''' Request and stage time histograms for this process, in Prometheus text format.
+    '''
+    if not app.config['REQUEST_METRICS']:
+        return make_response("No Metrics Collected", 404)
+
+    response = make_response(registry.prometheus_text(), 200)
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
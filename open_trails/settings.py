@@ -5,5 +5,53 @@ app.config.update(
     # AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID'),
     # AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY'),
     # S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
-    DATASTORE = os.environ.get("DATASTORE")
+    DATASTORE = os.environ.get("DATASTORE"),
+
+    # Number of background processes for slow uploads and transforms,
+    # zero to do the work inside each request.
+    JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 0)),
+
+    # Number of processes and features per chunk for transforming segments.
+    # Transforms run by background jobs are never split up any further.
+    TRANSFORM_WORKERS = int(os.environ.get("TRANSFORM_WORKERS", 1)),
+    TRANSFORM_CHUNK_SIZE = int(os.environ.get("TRANSFORM_CHUNK_SIZE", 1000)),
+
+    # Number of processes for checking uploaded OpenTrails files at the same time.
+    VALIDATE_WORKERS = int(os.environ.get("VALIDATE_WORKERS", 1)),
+
+    # Optional directory for caching samples of uploaded and transformed files.
+    SAMPLE_CACHE_DIR = os.environ.get("SAMPLE_CACHE_DIR"),
+
+    # SQLite index of datasets for the /datasets page, rebuilt from the
+    # datastore if it's missing. Required with an S3 datastore, otherwise
+    # kept in the temporary directory by default, see get_dataset_index().
+    DATASET_INDEX = os.environ.get("DATASET_INDEX"),
+
+    # Optional lossy geometry stage for transforms: decimal places to round
+    # coordinates to, and a Douglas-Peucker simplification tolerance in meters.
+    # Geometries are kept exactly as uploaded when these are unset.
+    GEOMETRY_DECIMALS = int(os.environ["GEOMETRY_DECIMALS"]) if os.environ.get("GEOMETRY_DECIMALS") else None,
+    SIMPLIFY_TOLERANCE = float(os.environ.get("SIMPLIFY_TOLERANCE") or 0),
+
+    # Distance in meters for matching trailheads to nearby segments,
+    # when trailheads have no trail columns of their own.
+    TRAILHEAD_DISTANCE = float(os.environ.get("TRAILHEAD_DISTANCE", 100)),
+
+    # Group segments whose names differ only by case or spacing into one named trail.
+    NORMALIZE_TRAIL_NAMES = bool(os.environ.get("NORMALIZE_TRAIL_NAMES")),
+
+    # Snapping distance in meters for splitting named trails into runs of
+    # connected segments. Unset to group segments by name alone.
+    CONNECTED_TRAILS_TOLERANCE = float(os.environ["CONNECTED_TRAILS_TOLERANCE"]) if os.environ.get("CONNECTED_TRAILS_TOLERANCE") else None,
+
+    # Let the web server send downloads from a filesystem datastore, with
+    # X-Sendfile for Apache or X-Accel-Redirect to an internal nginx location.
+    USE_X_SENDFILE = bool(os.environ.get("USE_X_SENDFILE")),
+    ACCEL_REDIRECT_PREFIX = os.environ.get("ACCEL_REDIRECT_PREFIX"),
+
+    # Time stages of each request, like datastore reads and transforms, for
+    # per-route histograms at /metrics and an optional Server-Timing header.
+    # Background jobs save their own stage times in their job status.
+    REQUEST_METRICS = bool(os.environ.get("REQUEST_METRICS")),
+    SERVER_TIMING_HEADER = bool(os.environ.get("SERVER_TIMING_HEADER"))
 )
@@ -0,0 +1,600 @@
+''' Pure-Python shapefile reading, without a trip through ogr2ogr.
+
+    Reads .shp, .dbf, .prj and .cpg files and produces the same GeoJSON
+    feature dicts as "ogr2ogr -t_srs EPSG:4326 -dim 2 -f GeoJSON". Anything
+    this module can't handle raises NotImplementedError, so callers can fall
+    back to ogr2ogr.
+'''
+from os.path import exists, splitext
+from struct import unpack
+from math import pi, sin, cos, tan, atan, atan2, sqrt, log, exp, radians, degrees
+import codecs, re
+
+from .metrics import timed
+
+_point_types = 1, 11, 21
+_multipoint_types = 8, 18, 28
+_polyline_types = 3, 13, 23
+_polygon_types = 5, 15, 25
+
+# Language driver IDs from DBF headers, as GDAL interprets them.
+_dbf_ldids = {0x01: 'cp437', 0x02: 'cp850', 0x03: 'cp1252', 0x57: 'iso-8859-1',
+              0x58: 'cp1252', 0x59: 'cp1252', 0x64: 'cp852', 0x65: 'cp866',
+              0x66: 'cp865', 0x67: 'cp861', 0x6a: 'cp737', 0x6b: 'cp857',
+              0xc8: 'cp1250', 0xc9: 'cp1251', 0xca: 'cp1254', 0xcb: 'cp1253'}
+
+class ShapefileReader:
+    ''' Iterable GeoJSON features from an open shapefile, in EPSG:4326.
+
+        Headers, projection and shape records are checked up front, so
+        NotImplementedError is raised when the reader is created rather
+        than partway through.
+    '''
+    def __init__(self, shp, dbf, prj=None, cpg=None):
+        self.shp, self.dbf = shp, dbf
+
+        header = shp.read(100)
+
+        if len(header) < 100 or unpack('>i', header[:4])[0] != 9994:
+            raise ValueError('Not a shapefile')
+
+        self.shape_type = unpack('<i', header[32:36])[0]
+        supported = (0, ) + _point_types + _multipoint_types + _polyline_types + _polygon_types
+
+        if self.shape_type not in supported:
+            raise NotImplementedError('Unsupported shape type {0}'.format(self.shape_type))
+
+        self.projection = parse_prj(prj) if prj and prj.strip() else None
+        self.count, self.fields, self.record_length, ldid = _read_dbf_header(dbf)
+        self.encoding = _dbf_encoding(cpg, ldid)
+        self._check_records()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.shp.close()
+        self.dbf.close()
+
+    def _check_records(self):
+        ''' Raise NotImplementedError for any shape record that can't be read.
+
+            Record types can differ from the header's, and records can be
+            cut short, so each one is looked at before any are generated.
+        '''
+        self.shp.seek(0, 2)
+        end, offset = self.shp.tell(), 100
+
+        while offset + 8 <= end:
+            self.shp.seek(offset)
+            header = self.shp.read(8)
+            length = unpack('>i', header[4:])[0] * 2
+
+            if length < 4 or offset + 8 + length > end:
+                raise NotImplementedError('Shape record at byte {0} is cut short'.format(offset))
+
+            content = self.shp.read(min(length, 44))
+            shape_type = unpack('<i', content[:4])[0]
+
+            if shape_type == 0:
+                needed = 4
+            elif shape_type in _point_types:
+                needed = 20
+            elif shape_type in _multipoint_types and length >= 40:
+                needed = 40 + 16 * unpack('<i', content[36:40])[0]
+            elif shape_type in _polyline_types + _polygon_types and length >= 44:
+                part_count, point_count = unpack('<ii', content[36:44])
+                needed = 44 + 4 * part_count + 16 * point_count if min(part_count, point_count) >= 0 else None
+            else:
+                raise NotImplementedError('Unsupported shape type {0}'.format(shape_type))
+
+            if needed is None or needed < 4 or needed > length:
+                raise NotImplementedError('Shape record at byte {0} is cut short'.format(offset))
+
+            offset += 8 + length
+
+        self.shp.seek(100)
+
+    @timed('shapefile2geojson')
+    def __iter__(self):
+        for index in range(self.count):
+            record = self.dbf.read(self.record_length)
+            geometry = self._read_geometry()
+
+            if record[:1] == '*':
+                # Deleted record.
+                continue
+
+            properties = dict()
+            offset = 1
+
+            for (name, kind, length, decimals) in self.fields:
+                raw = record[offset:offset + length]
+                properties[name] = _dbf_value(raw, kind, length, decimals, self.encoding)
+                offset += length
+
+            yield {'type': 'Feature', 'properties': properties, 'geometry': geometry}
+
+    def _read_geometry(self):
+        ''' Read the next shape record and return a GeoJSON geometry or None.
+        '''
+        header = self.shp.read(8)
+
+        if len(header) < 8:
+            return None
+
+        length = unpack('>i', header[4:])[0] * 2
+        content = self.shp.read(length)
+        shape_type = unpack('<i', content[:4])[0]
+
+        if shape_type == 0:
+            return None
+
+        if shape_type in _point_types:
+            (x, ), (y, ) = self._project([unpack('<d', content[4:12])[0]], [unpack('<d', content[12:20])[0]])
+            return {'type': 'Point', 'coordinates': [x, y]}
+
+        if shape_type in _multipoint_types:
+            count = unpack('<i', content[36:40])[0]
+            points = self._points(content, 40, count)
+            return {'type': 'MultiPoint', 'coordinates': points}
+
+        if shape_type in _polyline_types + _polygon_types:
+            part_count, point_count = unpack('<ii', content[36:44])
+            starts = unpack('<{0}i'.format(part_count), content[44:44 + 4 * part_count])
+            points = self._points(content, 44 + 4 * part_count, point_count)
+            parts = [points[start:end] for (start, end) in zip(starts, starts[1:] + (point_count, ))]
+
+            if shape_type in _polyline_types:
+                if len(parts) == 1:
+                    return {'type': 'LineString', 'coordinates': parts[0]}
+                return {'type': 'MultiLineString', 'coordinates': parts}
+
+            polygons = _group_rings(parts)
+
+            if len(polygons) == 1:
+                return {'type': 'Polygon', 'coordinates': polygons[0]}
+            return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+        raise NotImplementedError('Unsupported shape type {0}'.format(shape_type))
+
+    def _points(self, content, offset, count):
+        ''' Return a list of projected [x, y] pairs, dropping any Z or M values.
+        '''
+        flat = unpack('<{0}d'.format(count * 2), content[offset:offset + 16 * count])
+        xs, ys = self._project(flat[0::2], flat[1::2])
+        return map(list, zip(xs, ys))
+
+    def _project(self, xs, ys):
+        if self.projection is None:
+            return xs, ys
+
+        return self.projection.inverse(xs, ys)
+
+def _read_dbf_header(dbf):
+    ''' Return record count, field list, record length, and language driver ID.
+
+        Fields are (name, type, length, decimals) tuples.
+    '''
+    header = dbf.read(32)
+    count, header_length, record_length = unpack('<IHH', header[4:12])
+    descriptors = dbf.read(header_length - 32)
+    fields = []
+
+    for offset in range(0, len(descriptors) - 31, 32):
+        descriptor = descriptors[offset:offset + 32]
+
+        if descriptor[:1] == '\r':
+            break
+
+        name = descriptor[:11].split('\0')[0].decode('ascii', 'replace')
+        fields.append((name, descriptor[11], ord(descriptor[16]), ord(descriptor[17])))
+
+    return count, fields, record_length, ord(header[29])
+
+def _dbf_encoding(cpg, ldid):
+    ''' Return a Python codec name for DBF text, like GDAL would pick.
+    '''
+    if cpg and cpg.strip():
+        name = cpg.strip()
+
+        if name.isdigit():
+            name = 'cp' + name
+
+        try:
+            return codecs.lookup(name).name
+        except LookupError:
+            pass
+
+    return _dbf_ldids.get(ldid, 'iso-8859-1')
+
+def _dbf_value(raw, kind, width, decimals, encoding):
+    ''' Convert one raw DBF field value to a Python value, or None if blank.
+
+        Numbers follow OGR's field types: without decimals, fields narrower
+        than 19 characters are Integer or Integer64, and wider ones are Real.
+    '''
+    if kind in 'NF':
+        value = raw.strip()
+
+        if not value or value.startswith('*'):
+            return None
+
+        try:
+            if decimals == 0 and width < 19:
+                return int(float(value)) if '.' in value else int(value)
+            return float(value)
+        except ValueError:
+            return None
+
+    if kind == 'D':
+        value = raw.strip()
+
+        if len(value) != 8 or not value.isdigit():
+            return None
+
+        return u'{0}/{1}/{2}'.format(value[:4], value[4:6], value[6:])
+
+    value = raw.decode(encoding, 'replace').strip()
+
+    return value or None
+
+def _ring_area(ring):
+    ''' Return twice the signed area of a ring; negative means clockwise.
+    '''
+    area = 0.
+
+    for ((x1, y1), (x2, y2)) in zip(ring, ring[1:]):
+        area += x1 * y2 - x2 * y1
+
+    return area
+
+def _ring_contains(ring, (x, y)):
+    ''' Return true if the point is inside the ring, by ray casting.
+    '''
+    inside = False
+
+    for ((x1, y1), (x2, y2)) in zip(ring, ring[1:]):
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+
+    return inside
+
+def _group_rings(rings):
+    ''' Return a list of polygons, each a list of rings with the outer ring first.
+
+        Shapefile outer rings are clockwise and holes are counter-clockwise.
+    '''
+    areas = map(_ring_area, rings)
+    outers = [[ring] for (ring, area) in zip(rings, areas) if area <= 0]
+    holes = [ring for (ring, area) in zip(rings, areas) if area > 0]
+
+    if not outers:
+        # Badly-wound data; treat every ring as its own polygon, as GDAL does.
+        return [[ring] for ring in rings]
+
+    for hole in holes:
+        for polygon in outers:
+            if len(outers) == 1 or _ring_contains(polygon[0], hole[0]):
+                polygon.append(hole)
+                break
+        else:
+            outers.append([hole])
+
+    return outers
+
+def open_shapefile(shapefilepath):
+    ''' Return a ShapefileReader for a .shp path and its sibling files.
+    '''
+    base, _ = splitext(shapefilepath)
+    prj, cpg = _read_text(base + '.prj'), _read_text(base + '.cpg')
+    shp, dbf = open(shapefilepath, 'rb'), open(base + '.dbf', 'rb')
+
+    try:
+        return ShapefileReader(shp, dbf, prj, cpg)
+    except:
+        shp.close()
+        dbf.close()
+        raise
+
+def _read_text(path):
+    ''' Return the contents of a small sidecar file, or None if it's missing.
+    '''
+    if not exists(path):
+        return None
+
+    with open(path) as file:
+        return file.read()
+
+#
+# Projections.
+#
+
+_wkt_token = re.compile(r'\s*("(?:[^"]|"")*"|[A-Za-z_][A-Za-z0-9_]*|[-+]?[0-9.]+(?:[eE][-+]?[0-9]+)?|[\[\(\]\),])')
+
+def _parse_wkt(wkt):
+    ''' Parse WKT into nested (keyword, [arguments]) tuples.
+    '''
+    tokens, position = [], 0
+
+    while position < len(wkt.rstrip()):
+        match = _wkt_token.match(wkt, position)
+
+        if not match:
+            raise NotImplementedError('Unreadable projection WKT')
+
+        tokens.append(match.group(1))
+        position = match.end()
+
+    def node(index):
+        keyword, args = tokens[index], []
+
+        if tokens[index + 1] not in '[(':
+            raise NotImplementedError('Unreadable projection WKT')
+
+        index += 2
+
+        while tokens[index] not in '])':
+            token = tokens[index]
+
+            if token == ',':
+                index += 1
+            elif token.startswith('"'):
+                args.append(token[1:-1].replace('""', '"'))
+                index += 1
+            elif token[0].isalpha() and tokens[index + 1] in '[(':
+                child, index = node(index)
+                args.append(child)
+            elif token[0].isalpha():
+                args.append(token)
+                index += 1
+            else:
+                args.append(float(token))
+                index += 1
+
+        return (keyword.upper(), args), index + 1
+
+    return node(0)[0]
+
+def _children(node, keyword):
+    return [arg for arg in node[1] if type(arg) is tuple and arg[0] == keyword]
+
+def parse_prj(prj):
+    ''' Return a projection object for .prj WKT, or None if it's geographic.
+
+        Coordinates are never shifted to another datum or prime meridian,
+        so WKT that asks for that raises NotImplementedError, as does WKT
+        that's cut short or missing parts.
+    '''
+    try:
+        return _parse_prj(prj)
+    except (IndexError, ValueError, TypeError, KeyError, ZeroDivisionError):
+        raise NotImplementedError('Unreadable projection WKT')
+
+def _parse_prj(prj):
+    root = _parse_wkt(prj.strip())
+
+    if root[0] == 'GEOGCS':
+        _check_geogcs(root)
+        return None
+
+    if root[0] != 'PROJCS':
+        raise NotImplementedError('Unsupported coordinate system {0}'.format(root[0]))
+
+    (geogcs, ) = _children(root, 'GEOGCS')
+    spheroid = _check_geogcs(geogcs)
+
+    semi_major, inverse_flattening = spheroid[1][1:3]
+    flattening = 1 / inverse_flattening if inverse_flattening else 0
+
+    (projection, ) = _children(root, 'PROJECTION')
+    units = _children(root, 'UNIT')
+    unit = units[-1][1][1] if units else 1.
+
+    params = dict([(p[1][0].lower(), p[1][1]) for p in _children(root, 'PARAMETER')])
+    name = projection[1][0].lower()
+
+    if name in ('lambert_conformal_conic', 'lambert_conformal_conic_1sp', 'lambert_conformal_conic_2sp'):
+        return LambertConformalConic(semi_major, flattening, unit, params)
+
+    if name in ('transverse_mercator', 'gauss_kruger'):
+        return TransverseMercator(semi_major, flattening, unit, params)
+
+    if name in ('mercator', 'mercator_1sp', 'mercator_2sp', 'mercator_auxiliary_sphere',
+                'popular_visualisation_pseudo_mercator'):
+        return Mercator(semi_major, flattening, unit, params, name)
+
+    raise NotImplementedError('Unsupported projection {0}'.format(projection[1][0]))
+
+def _check_geogcs(geogcs):
+    ''' Return the spheroid of a GEOGCS node, if its coordinates need no shifting.
+
+        Datum shifts, prime meridians other than Greenwich, and angular units
+        other than degrees raise NotImplementedError.
+    '''
+    (datum, ) = _children(geogcs, 'DATUM')
+    (spheroid, ) = _children(datum, 'SPHEROID')
+
+    for towgs84 in _children(datum, 'TOWGS84'):
+        if any(towgs84[1]):
+            raise NotImplementedError('Datum shifts are not supported')
+
+    for primem in _children(geogcs, 'PRIMEM'):
+        if primem[1][1] != 0:
+            raise NotImplementedError('Prime meridians other than Greenwich are not supported')
+
+    for unit in _children(geogcs, 'UNIT'):
+        if abs(unit[1][1] - radians(1)) > 1e-9:
+            raise NotImplementedError('Angular units other than degrees are not supported')
+
+    return spheroid
+
+def _param(params, default, *names):
+    for name in names:
+        if name in params:
+            return params[name]
+    return default
+
+class _Projection:
+    ''' Shared ellipsoid setup for projections.
+    '''
+    def __init__(self, semi_major, flattening, unit, params):
+        self.a = semi_major
+        self.e2 = flattening * (2 - flattening)
+        self.e = sqrt(self.e2)
+        self.unit = unit
+        self.false_easting = _param(params, 0., 'false_easting')
+        self.false_northing = _param(params, 0., 'false_northing')
+        self.lon0 = radians(_param(params, 0., 'central_meridian', 'longitude_of_origin', 'longitude_of_center'))
+
+    def _m(self, lat):
+        return cos(lat) / sqrt(1 - self.e2 * sin(lat) ** 2)
+
+    def _t(self, lat):
+        e, es = self.e, self.e * sin(lat)
+        return tan(pi / 4 - lat / 2) / ((1 - es) / (1 + es)) ** (e / 2)
+
+    def _lat_from_t(self, t):
+        ''' Iteratively find latitude from Snyder's isometric t, equation 7-9.
+        '''
+        e, lat = self.e, pi / 2 - 2 * atan(t)
+
+        for i in range(15):
+            es = e * sin(lat)
+            next_lat = pi / 2 - 2 * atan(t * ((1 - es) / (1 + es)) ** (e / 2))
+
+            if abs(next_lat - lat) < 1e-12:
+                return next_lat
+
+            lat = next_lat
+
+        return lat
+
+class LambertConformalConic (_Projection):
+    ''' Ellipsoidal Lambert Conformal Conic, Snyder pages 107-109.
+    '''
+    def __init__(self, semi_major, flattening, unit, params):
+        _Projection.__init__(self, semi_major, flattening, unit, params)
+
+        lat0 = radians(_param(params, 0., 'latitude_of_origin', 'latitude_of_center'))
+        lat1 = radians(_param(params, degrees(lat0), 'standard_parallel_1'))
+        lat2 = radians(_param(params, degrees(lat1), 'standard_parallel_2'))
+        self.k0 = _param(params, 1., 'scale_factor')
+
+        m1, t1, t0 = self._m(lat1), self._t(lat1), self._t(lat0)
+
+        if abs(lat1 - lat2) > 1e-10:
+            self.n = (log(m1) - log(self._m(lat2))) / (log(t1) - log(self._t(lat2)))
+        else:
+            self.n = sin(lat1)
+
+        self.aF = self.a * self.k0 * m1 / (self.n * t1 ** self.n)
+        self.rho0 = self.aF * t0 ** self.n
+
+    def inverse(self, xs, ys):
+        ''' Return lists of longitudes and latitudes for projected coordinates.
+        '''
+        n, aF, rho0, lon0 = self.n, self.aF, self.rho0, self.lon0
+        fe, fn, unit = self.false_easting, self.false_northing, self.unit
+        sign = 1 if n > 0 else -1
+        lons, lats = [], []
+
+        for (x, y) in zip(xs, ys):
+            x, y = (x - fe) * unit, rho0 - (y - fn) * unit
+            rho = sign * sqrt(x * x + y * y)
+            theta = atan2(sign * x, sign * y)
+
+            if rho == 0:
+                lat = sign * pi / 2
+            else:
+                lat = self._lat_from_t((rho / aF) ** (1 / n))
+
+            lons.append(degrees(theta / n + lon0))
+            lats.append(degrees(lat))
+
+        return lons, lats
+
+class TransverseMercator (_Projection):
+    ''' Ellipsoidal Transverse Mercator, Snyder pages 60-64.
+    '''
+    def __init__(self, semi_major, flattening, unit, params):
+        _Projection.__init__(self, semi_major, flattening, unit, params)
+
+        e2 = self.e2
+        self.k0 = _param(params, 1., 'scale_factor')
+        self.ep2 = e2 / (1 - e2)
+        self.m_coefficients = (1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256,
+                               3 * e2 / 8 + 3 * e2 ** 2 / 32 + 45 * e2 ** 3 / 1024,
+                               15 * e2 ** 2 / 256 + 45 * e2 ** 3 / 1024,
+                               35 * e2 ** 3 / 3072)
+
+        e1 = (1 - sqrt(1 - e2)) / (1 + sqrt(1 - e2))
+        self.mu_coefficients = (3 * e1 / 2 - 27 * e1 ** 3 / 32,
+                                21 * e1 ** 2 / 16 - 55 * e1 ** 4 / 32,
+                                151 * e1 ** 3 / 96,
+                                1097 * e1 ** 4 / 512)
+
+        self.m0 = self._meridian(radians(_param(params, 0., 'latitude_of_origin')))
+
+    def _meridian(self, lat):
+        c0, c2, c4, c6 = self.m_coefficients
+        return self.a * (c0 * lat - c2 * sin(2 * lat) + c4 * sin(4 * lat) - c6 * sin(6 * lat))
+
+    def inverse(self, xs, ys):
+        ''' Return lists of longitudes and latitudes for projected coordinates.
+        '''
+        a, e2, ep2, k0, m0, lon0 = self.a, self.e2, self.ep2, self.k0, self.m0, self.lon0
+        fe, fn, unit = self.false_easting, self.false_northing, self.unit
+        c0 = self.m_coefficients[0]
+        u2, u4, u6, u8 = self.mu_coefficients
+        lons, lats = [], []
+
+        for (x, y) in zip(xs, ys):
+            x, y = (x - fe) * unit, (y - fn) * unit
+            mu = (m0 + y / k0) / (a * c0)
+            lat1 = mu + u2 * sin(2 * mu) + u4 * sin(4 * mu) + u6 * sin(6 * mu) + u8 * sin(8 * mu)
+
+            sin1, cos1, tan1 = sin(lat1), cos(lat1), tan(lat1)
+            c1, t1 = ep2 * cos1 ** 2, tan1 ** 2
+            n1 = a / sqrt(1 - e2 * sin1 ** 2)
+            r1 = a * (1 - e2) / (1 - e2 * sin1 ** 2) ** 1.5
+            d = x / (n1 * k0)
+
+            lat = lat1 - (n1 * tan1 / r1) * (d ** 2 / 2
+                - (5 + 3 * t1 + 10 * c1 - 4 * c1 ** 2 - 9 * ep2) * d ** 4 / 24
+                + (61 + 90 * t1 + 298 * c1 + 45 * t1 ** 2 - 252 * ep2 - 3 * c1 ** 2) * d ** 6 / 720)
+
+            lon = lon0 + (d - (1 + 2 * t1 + c1) * d ** 3 / 6
+                + (5 - 2 * c1 + 28 * t1 - 3 * c1 ** 2 + 8 * ep2 + 24 * t1 ** 2) * d ** 5 / 120) / cos1
+
+            lons.append(degrees(lon))
+            lats.append(degrees(lat))
+
+        return lons, lats
+
+class Mercator (_Projection):
+    ''' Mercator, ellipsoidal or spherical for web mercator, Snyder pages 44-47.
+    '''
+    def __init__(self, semi_major, flattening, unit, params, name):
+        _Projection.__init__(self, semi_major, flattening, unit, params)
+
+        if name in ('mercator_auxiliary_sphere', 'popular_visualisation_pseudo_mercator'):
+            # Web mercator treats ellipsoidal coordinates as spherical.
+            self.e2, self.e = 0., 0.
+
+        lat1 = radians(_param(params, 0., 'standard_parallel_1'))
+        self.k0 = _param(params, self._m(lat1), 'scale_factor')
+
+    def inverse(self, xs, ys):
+        ''' Return lists of longitudes and latitudes for projected coordinates.
+        '''
+        ak0, lon0 = self.a * self.k0, self.lon0
+        fe, fn, unit = self.false_easting, self.false_northing, self.unit
+        lons, lats = [], []
+
+        for (x, y) in zip(xs, ys):
+            x, y = (x - fe) * unit, (y - fn) * unit
+            lons.append(degrees(x / ak0 + lon0))
+            lats.append(degrees(self._lat_from_t(exp(-y / ak0))))
+
+        return lons, lats
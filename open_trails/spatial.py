@@ -0,0 +1,240 @@
+''' Spatial index of transformed segments, for finding trails near trailheads.
+
+    SegmentIndex is a packed R-tree built with Sort-Tile-Recursive: segment
+    bounding boxes are sorted into tiles of neighbors once, then grouped into
+    parent boxes level by level. It's built as segments are transformed and
+    saved next to them, so trailhead transforms can load it instead of
+    scanning every segment.
+'''
+from array import array
+from math import ceil, sqrt, cos, radians
+import json, struct, sys
+
+from .geometry import meters_per_degree, segment_distance, is_position, is_line
+from .metrics import timed
+
+# Format version and array type codes, in the order they're saved.
+_version = 1
+_arrays = ('boxes', 'd'), ('order', 'I'), ('coords', 'd'), ('lines', 'I'), ('parts', 'I')
+
+class SegmentIndex:
+
+    def __init__(self, node_size=16):
+        '''
+        Packed R-tree of segment geometries, looked up by distance from a trailhead
+
+        Add segments with add(), then call pack() once before searching.
+        Coordinates are kept in flat arrays of longitude, latitude pairs.
+        '''
+        self.node_size = node_size
+        self.ids = []
+        self.coords = array('d')
+        self.lines, self.parts = array('I', [0]), array('I', [0])
+        self.boxes, self.order = array('d'), array('I')
+        self.levels = []
+        self._extents = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id, geometry):
+        ''' Add one segment's lines, remembering its bounding box for pack().
+        '''
+        xs, ys = [], []
+
+        for line in geometry_lines(geometry):
+            for position in line:
+                self.coords.extend(position[:2])
+                xs.append(position[0])
+                ys.append(position[1])
+
+            self.lines.append(len(self.coords) / 2)
+
+        self.ids.append(id)
+        self.parts.append(len(self.lines) - 1)
+        self._extents.append((min(xs), min(ys), max(xs), max(ys)) if xs else None)
+
+    @timed('segment-index')
+    def iter_added(self, features):
+        ''' Generate features unchanged, adding each one to the index.
+        '''
+        for feature in features:
+            self.add(feature['properties']['id'], feature['geometry'])
+            yield feature
+
+    @timed('segment-index')
+    def pack(self):
+        ''' Sort segment boxes into tiles, and build parent levels over them.
+        '''
+        M = self.node_size
+        leaves = [(box, index) for (index, box) in enumerate(self._extents) if box]
+
+        # Sort by x into vertical slices, then by y within each slice.
+        leaves.sort(key=lambda (box, i): box[0] + box[2])
+        slice_size = M * int(ceil(sqrt(ceil(len(leaves) / float(M)))))
+        tiled = []
+
+        for start in range(0, len(leaves), slice_size or 1):
+            tiled.extend(sorted(leaves[start:start + slice_size], key=lambda (box, i): box[1] + box[3]))
+
+        self.order = array('I', [index for (box, index) in tiled])
+        self.boxes = array('d')
+        level = [box for (box, index) in tiled]
+        self.levels = []
+
+        while True:
+            self.levels.append((len(self.boxes) / 4, len(level)))
+
+            for box in level:
+                self.boxes.extend(box)
+
+            if len(level) <= 1:
+                break
+
+            level = [_union(level[start:start + M]) for start in range(0, len(level), M)]
+
+        self._extents = []
+
+    def nearby(self, geometry, distance):
+        ''' Return ids of segments within a distance in meters, nearest first.
+        '''
+        positions = [position for line in geometry_lines(geometry) for position in line]
+
+        if not positions or not self.order:
+            return []
+
+        lat_meters, lon_meters = meters_per_degree
+        lon_meters *= cos(radians(sum([p[1] for p in positions]) / len(positions)))
+
+        # Search a box around the positions at least as big as the distance.
+        dx, dy = distance / max(lon_meters, 1.), distance / lat_meters
+        search = (min([p[0] for p in positions]) - dx, min([p[1] for p in positions]) - dy,
+                  max([p[0] for p in positions]) + dx, max([p[1] for p in positions]) + dy)
+
+        found = []
+
+        for slot in self._search(search):
+            index = self.order[slot]
+            d = self._distance(index, positions, lon_meters, lat_meters)
+
+            if d <= distance:
+                found.append((d, index))
+
+        return [self.ids[index] for (d, index) in sorted(found)]
+
+    def _search(self, search):
+        ''' Return leaf slots whose boxes intersect a search box, from the top down.
+        '''
+        M = self.node_size
+        nodes = range(self.levels[-1][1])
+
+        for level in range(len(self.levels) - 1, -1, -1):
+            start, count = self.levels[level]
+            matched = [node for node in nodes if _intersects(self.boxes, (start + node) * 4, search)]
+
+            if level == 0:
+                return matched
+
+            nodes = [child for node in matched
+                     for child in xrange(node * M, min(node * M + M, self.levels[level - 1][1]))]
+
+    def _distance(self, index, positions, lon_meters, lat_meters):
+        ''' Return the distance in meters from the nearest position to one segment.
+        '''
+        points = [(p[0] * lon_meters, p[1] * lat_meters) for p in positions]
+        distances = []
+
+        for line in xrange(self.parts[index], self.parts[index + 1]):
+            start, end = self.lines[line], self.lines[line + 1]
+            xs = [self.coords[i * 2] * lon_meters for i in xrange(start, end)]
+            ys = [self.coords[i * 2 + 1] * lat_meters for i in xrange(start, end)]
+
+            # A line of one position is a point, measured as a line to itself.
+            pairs = zip(range(len(xs) - 1), range(1, len(xs))) or [(0, 0)]
+
+            for (x, y) in points:
+                distances.extend([segment_distance(x, y, xs[a], ys[a], xs[b], ys[b]) for (a, b) in pairs])
+
+        return min(distances)
+
+    def dumps(self):
+        ''' Return the packed index as a string for saving.
+        '''
+        header = json.dumps(dict(version=_version, ids=self.ids, levels=self.levels,
+                                 node_size=self.node_size, byteorder=sys.byteorder))
+        chunks = [struct.pack('<I', len(header)), header]
+
+        for (name, typecode) in _arrays:
+            data = getattr(self, name).tostring()
+            chunks.extend([struct.pack('<I', len(data)), data])
+
+        return ''.join(chunks)
+
+    @staticmethod
+    def loads(data):
+        ''' Return a packed index from a string made by dumps().
+        '''
+        (length, ), offset = struct.unpack('<I', data[:4]), 4
+        header = json.loads(data[offset:offset + length])
+        offset += length
+
+        if header['version'] != _version:
+            raise ValueError('Unknown segment index version {0}'.format(header['version']))
+
+        index = SegmentIndex(header['node_size'])
+        index.ids = header['ids']
+        index.levels = [tuple(level) for level in header['levels']]
+        index._extents = []
+
+        for (name, typecode) in _arrays:
+            (length, ), offset = struct.unpack('<I', data[offset:offset + 4]), offset + 4
+            values = array(typecode, data[offset:offset + length])
+            offset += length
+
+            if header['byteorder'] != sys.byteorder:
+                values.byteswap()
+
+            setattr(index, name, values)
+
+        return index
+
+def geometry_lines(geometry, check_positions=True):
+    ''' Return a list of lines of positions from any GeoJSON geometry, empty for none.
+
+        Lines with anything but positions in them are left out, unless
+        check_positions is false and only the lines themselves are checked.
+    '''
+    if type(geometry) is not dict or type(geometry.get('coordinates')) is not list:
+        return []
+
+    geometry_type, coordinates = geometry.get('type'), geometry['coordinates']
+
+    if geometry_type == 'Point':
+        lines = [[coordinates]]
+    elif geometry_type == 'MultiPoint':
+        lines = [[position] for position in coordinates]
+    elif geometry_type == 'LineString':
+        lines = [coordinates]
+    elif geometry_type in ('MultiLineString', 'Polygon'):
+        lines = coordinates
+    elif geometry_type == 'MultiPolygon':
+        lines = [ring for polygon in coordinates for ring in polygon]
+    else:
+        return []
+
+    if not check_positions:
+        return [line for line in lines if type(line) in (list, tuple) and line]
+
+    return [line for line in lines if line and is_line(line)]
+
+def _union(boxes):
+    ''' Return a bounding box around a list of boxes.
+    '''
+    return (min([b[0] for b in boxes]), min([b[1] for b in boxes]),
+            max([b[2] for b in boxes]), max([b[3] for b in boxes]))
+
+def _intersects(boxes, offset, search):
+    ''' Return true if the box at an offset in a flat array overlaps a search box.
+    '''
+    return boxes[offset] <= search[2] and boxes[offset + 2] >= search[0] \
+        and boxes[offset + 1] <= search[3] and boxes[offset + 3] >= search[1]
@@ -0,0 +1,221 @@
+''' Compact in-memory storage for transformed OpenTrails segments.
+
+    A list of GeoJSON feature dicts spends hundreds of bytes per feature on
+    keys, repeated values and nested coordinate lists. SegmentTable keeps the
+    same features in columns instead, and builds feature dicts on demand.
+'''
+from array import array
+
+geometry_types = 'Point', 'LineString', 'MultiLineString', 'Polygon', 'MultiPolygon', 'MultiPoint'
+
+# Nesting depth of coordinate counts for each geometry type; points have none.
+_count_depths = dict(Point=0, LineString=1, MultiPoint=1, MultiLineString=2, Polygon=2, MultiPolygon=3)
+
+# Geometry type code for geometries kept as they came, like nulls or integer coordinates.
+_unpacked = 255
+
+flag_fields = 'motor_vehicles', 'foot', 'bicycle', 'horse', 'ski', 'wheelchair'
+
+class _Irregular (Exception):
+    pass
+
+class SegmentTable:
+    ''' Transformed segment features, stored in columns.
+
+        IDs and names are lists, yes/no flags are interned codes, and
+        coordinates are one flat array of doubles with per-feature offsets.
+        Iterating or indexing the table generates ordinary feature dicts.
+    '''
+    def __init__(self):
+        self.ids, self.names = [], []
+        self.flags = [array('B') for field in flag_fields]
+        self.values, self.value_codes = [], dict()
+
+        for value in (None, 'yes', 'no'):
+            self._intern(value)
+
+        self.types, self.dims = array('B'), array('B')
+        self.coords, self.coord_offsets = array('d'), array('L', [0])
+        self.counts, self.count_offsets = array('L'), array('L', [0])
+        self.unpacked = dict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for index in xrange(len(self.ids)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        ''' Return a new GeoJSON feature dict for one segment.
+        '''
+        index = self._index(index)
+        properties = dict(id=self.ids[index], steward_id='0',
+                          name=self.names[index], osm_tags=None)
+
+        for (field, codes) in zip(flag_fields, self.flags):
+            properties[field] = self.values[codes[index]]
+
+        return dict(type='Feature', geometry=self.geometry(index), properties=properties)
+
+    def _index(self, index):
+        ''' Return a non-negative index, or raise IndexError.
+        '''
+        if index < 0:
+            index += len(self.ids)
+
+        if not 0 <= index < len(self.ids):
+            raise IndexError('segment index out of range')
+
+        return index
+
+    def geojson(self):
+        ''' Return a plain GeoJSON FeatureCollection dict with every segment.
+        '''
+        return {'type': 'FeatureCollection', 'features': list(self)}
+
+    def append(self, geometry, id, name, motor_vehicles, foot, bicycle, horse, ski, wheelchair):
+        ''' Add one segment to the end of the table.
+
+            The geometry is packed first, so columns stay in step even if
+            something else goes wrong.
+        '''
+        index = len(self.ids)
+
+        try:
+            type, dims = self._pack_geometry(geometry)
+        except _Irregular:
+            del self.coords[self.coord_offsets[-1]:]
+            del self.counts[self.count_offsets[-1]:]
+            type, dims = _unpacked, 0
+            self.unpacked[index] = geometry
+
+        self.ids.append(id)
+        self.names.append(name)
+
+        for (codes, value) in zip(self.flags, (motor_vehicles, foot, bicycle, horse, ski, wheelchair)):
+            codes.append(self._intern(value))
+
+        self.types.append(type)
+        self.dims.append(dims)
+        self.coord_offsets.append(len(self.coords))
+        self.count_offsets.append(len(self.counts))
+
+    def _intern(self, value):
+        ''' Return a code for a flag value, adding it to the table if it's new.
+        '''
+        # Key by type too, so that 0 and False stay apart.
+        key = type(value), value
+
+        if key not in self.value_codes:
+            self.value_codes[key] = len(self.values)
+            self.values.append(value)
+
+        return self.value_codes[key]
+
+    def _pack_geometry(self, geometry):
+        ''' Add a geometry's coordinates to the arrays, and return its type code and dimensions.
+
+            Raise _Irregular for anything that wouldn't come back out the same,
+            leaving partly-added coordinates for the caller to remove.
+        '''
+        if type(geometry) is not dict or geometry.get('type') not in _count_depths:
+            raise _Irregular()
+
+        coordinates = geometry.get('coordinates')
+
+        if set(geometry.keys()) != set(('type', 'coordinates')) or type(coordinates) is not list:
+            raise _Irregular()
+
+        depth = _count_depths[geometry['type']]
+        positions = self._pack_counts(coordinates, depth)
+
+        if depth == 0:
+            positions = [coordinates]
+
+        if not positions:
+            # Dimensions can't be known, but there are no positions to need them.
+            return geometry_types.index(geometry['type']), 2
+
+        if type(positions[0]) is not list or len(positions[0]) < 2:
+            raise _Irregular()
+
+        dims = len(positions[0])
+
+        for position in positions:
+            if type(position) is not list or len(position) != dims:
+                raise _Irregular()
+
+            for number in position:
+                if type(number) is not float:
+                    raise _Irregular()
+
+            self.coords.extend(position)
+
+        return geometry_types.index(geometry['type']), dims
+
+    def _pack_counts(self, coordinates, depth):
+        ''' Add lengths of nested coordinate lists to counts, and return a flat list of positions.
+        '''
+        if depth == 0:
+            return []
+
+        self.counts.append(len(coordinates))
+
+        if depth == 1:
+            return coordinates
+
+        positions = []
+
+        for part in coordinates:
+            if type(part) is not list:
+                raise _Irregular()
+
+            positions.extend(self._pack_counts(part, depth - 1))
+
+        return positions
+
+    def geometry_layout(self, index):
+        ''' Return geometry type, dimensions, nested counts and flat coordinates of one segment.
+
+            Type is None for geometries that aren't stored in columns; use
+            geometry() for those.
+        '''
+        index = self._index(index)
+
+        if self.types[index] == _unpacked:
+            return None, None, None, None
+
+        counts = self.counts[self.count_offsets[index]:self.count_offsets[index + 1]]
+        coords = self.coords[self.coord_offsets[index]:self.coord_offsets[index + 1]]
+
+        return geometry_types[self.types[index]], self.dims[index], counts, coords
+
+    def geometry(self, index):
+        ''' Return a new GeoJSON geometry dict for one segment.
+        '''
+        index = self._index(index)
+
+        if self.types[index] == _unpacked:
+            return self.unpacked[index]
+
+        geometry_type, dims, counts, coords = self.geometry_layout(index)
+        flat = coords.tolist()
+        positions = [flat[i:i + dims] for i in xrange(0, len(flat), dims)]
+
+        if geometry_type == 'Point':
+            coordinates = positions[0]
+        else:
+            coordinates = _unpack_counts(iter(counts), iter(positions), _count_depths[geometry_type])
+
+        return dict(type=geometry_type, coordinates=coordinates)
+
+def _unpack_counts(counts, positions, depth):
+    ''' Rebuild nested coordinate lists from iterators of counts and positions.
+    '''
+    length = counts.next()
+
+    if depth == 1:
+        return [positions.next() for i in xrange(length)]
+
+    return [_unpack_counts(counts, positions, depth - 1) for i in xrange(length)]
@@ -0,0 +1,207 @@
+''' Segment network topology, for named trails that follow real connections.
+
+    make_named_trails() groups segments by name alone, so two unconnected
+    "Loop Trail"s in different parks become one named trail. Here segment
+    endpoints within a snapping tolerance are merged into nodes with a hash
+    grid, and segments sharing a name and a node are joined into connected
+    components with union-find. Runs of unnamed segments can join together
+    named segments at either end. Everything is close to linear in the
+    number of segments.
+'''
+from array import array
+from math import cos, radians, floor
+from itertools import count
+
+from .functions import encode_list, normalize_trail_name
+from .geometry import meters_per_degree
+from .spatial import geometry_lines, is_position
+
+class UnionFind:
+
+    def __init__(self, size=0):
+        '''
+        Disjoint sets of integers, joined with union() and named by find()
+        '''
+        self.parents = array('l', xrange(size))
+        self.sizes = array('l', [1] * size)
+
+    def find(self, item):
+        ''' Return the representative of an item's set, halving paths along the way.
+        '''
+        parents = self.parents
+
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+
+        return item
+
+    def union(self, a, b):
+        ''' Join the sets of two items, smaller into larger.
+        '''
+        a, b = self.find(a), self.find(b)
+
+        if a == b:
+            return
+
+        if self.sizes[a] < self.sizes[b]:
+            a, b = b, a
+
+        self.parents[b] = a
+        self.sizes[a] += self.sizes[b]
+
+class SegmentNetwork:
+
+    def __init__(self, tolerance=1.0):
+        '''
+        Graph of segments joined at endpoints within tolerance meters of each other
+
+        Add segments with add(), then call components() once they're all in.
+        '''
+        self.tolerance = tolerance
+        self.ids, self.names = [], []
+        self.xs, self.ys = array('d'), array('d')
+        self.ends = array('L', [0])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id, name, geometry):
+        ''' Add a segment with the endpoints of each of its lines.
+        '''
+        for position in _line_ends(geometry):
+            self.xs.append(position[0])
+            self.ys.append(position[1])
+
+        self.ids.append(id)
+        self.names.append(name)
+        self.ends.append(len(self.xs))
+
+    def nodes(self):
+        ''' Return an array of node numbers, one for each endpoint.
+
+            Endpoints are snapped together when they're within tolerance of
+            one another, or of other endpoints that are, using a hash grid of
+            tolerance-sized cells so only neighboring cells are compared.
+        '''
+        if not self.xs:
+            return array('l')
+
+        points = UnionFind(len(self.xs))
+
+        lat_meters, lon_meters = meters_per_degree
+        lon_meters *= cos(radians(sum(self.ys) / len(self.ys)))
+        tolerance = max(self.tolerance, 1e-9)
+        cell_x, cell_y = tolerance / lon_meters, tolerance / lat_meters
+        grid = dict()
+
+        for (point, (x, y)) in enumerate(zip(self.xs, self.ys)):
+            column, row = int(floor(x / cell_x)), int(floor(y / cell_y))
+
+            for key in [(c, r) for c in (column - 1, column, column + 1)
+                               for r in (row - 1, row, row + 1)]:
+                for other in grid.get(key, ()):
+                    dx = (x - self.xs[other]) * lon_meters
+                    dy = (y - self.ys[other]) * lat_meters
+
+                    if dx * dx + dy * dy <= tolerance * tolerance:
+                        points.union(point, other)
+
+            grid.setdefault((column, row), []).append(point)
+
+        return array('l', [points.find(point) for point in xrange(len(self.xs))])
+
+    def components(self, normalize=False, join_unnamed=True):
+        ''' Return lists of segment indexes for each connected run of named segments.
+
+            Named segments are joined when they share a name and a node.
+            With join_unnamed, nodes linked by runs of unnamed segments count
+            as one node, so a named trail can cross an unnamed connector.
+            Components are in order of their first segment.
+        '''
+        nodes = self.nodes()
+        junctions = UnionFind(len(nodes))
+
+        if join_unnamed:
+            for (segment, name) in enumerate(self.names):
+                if not name:
+                    ends = self._segment_nodes(segment, nodes)
+
+                    for node in ends[1:]:
+                        junctions.union(ends[0], node)
+
+        segments = UnionFind(len(self.ids))
+        first_segments = dict()
+
+        for (segment, name) in enumerate(self.names):
+            if not name:
+                continue
+
+            key = normalize_trail_name(name) if normalize else name
+
+            for node in self._segment_nodes(segment, nodes):
+                junction = key, junctions.find(node)
+
+                if junction in first_segments:
+                    segments.union(segment, first_segments[junction])
+                else:
+                    first_segments[junction] = segment
+
+        components, order = dict(), []
+
+        for (segment, name) in enumerate(self.names):
+            if not name:
+                continue
+
+            root = segments.find(segment)
+
+            if root not in components:
+                components[root] = []
+                order.append(root)
+
+            components[root].append(segment)
+
+        return [components[root] for root in order]
+
+    def _segment_nodes(self, segment, nodes):
+        ''' Return node numbers for the endpoints of one segment, all joined to each other.
+        '''
+        return nodes[self.ends[segment]:self.ends[segment + 1]]
+
+def make_connected_named_trails(segment_features, tolerance=1.0, normalize=False, join_unnamed=True):
+    ''' Return a list of named trails, one for each connected run of same-named segments.
+
+        Rows look like those from make_named_trails(), and are ordered by
+        name and then by where each run first appears. Segments without
+        geometry are runs of their own.
+    '''
+    network = SegmentNetwork(tolerance)
+
+    for feature in segment_features:
+        properties = feature['properties']
+        network.add(properties['id'], properties['name'], feature['geometry'])
+
+    components = network.components(normalize, join_unnamed)
+
+    def sort_key(component):
+        name = network.names[component[0]]
+        return (normalize_trail_name(name) if normalize else name), component[0]
+
+    id_counter = count(1)
+
+    return [dict(id=str(id_counter.next()),
+                 name=network.names[component[0]],
+                 segment_ids=encode_list([network.ids[segment] for segment in component]),
+                 description=None, part_of=None)
+            for component in sorted(components, key=sort_key)]
+
+def _line_ends(geometry):
+    ''' Return first and last positions of each line in a geometry, skipping bad ones.
+    '''
+    ends = []
+
+    for line in geometry_lines(geometry, check_positions=False):
+        if is_position(line[0]) and is_position(line[-1]):
+            ends.extend((line[0], line[-1]))
+
+    return ends
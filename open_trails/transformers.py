@@ -1,9 +1,75 @@
 import os, json, subprocess, itertools, re
 
-from .functions import encode_list
-
-def shapefile2geojson(shapefilepath):
+from operator import itemgetter
+from multiprocessing import Pool, current_process
+from . import app
+from .functions import (
+    encode_list, dedupe_messages, Messages, open_zipped_shapefile, unzipped,
+    get_segment_index, max_message_indexes
+    )
+from .shapefiles import open_shapefile
+from .tables import SegmentTable
+from .metrics import timed
+
+@timed('shapefile2geojson')
+def shapefile2geojson(shapefilepath, engine=None):
     '''Converts a shapefile to a geojson file with spherical mercator.
+
+        Reads the shapefile in-process by default, falling back to ogr2ogr
+        for anything the reader doesn't support. Pass engine='python' or
+        engine='ogr2ogr' to use just one of them.
+    '''
+    if engine == 'ogr2ogr':
+        return _ogr2ogr_geojson(shapefilepath)
+
+    return {'type': 'FeatureCollection',
+            'features': list(iter_shapefile_features(shapefilepath, engine))}
+
+@timed('shapefile2geojson')
+def iter_shapefile_features(shapefilepath, engine=None):
+    ''' Generate GeoJSON features from a shapefile one at a time.
+    '''
+    if engine != 'ogr2ogr':
+        try:
+            reader = open_shapefile(shapefilepath)
+        except NotImplementedError:
+            if engine == 'python':
+                raise
+        else:
+            try:
+                for feature in reader:
+                    yield feature
+            finally:
+                reader.close()
+            return
+
+    for feature in _ogr2ogr_geojson(shapefilepath)['features']:
+        yield feature
+
+@timed('shapefile2geojson')
+def iter_zipped_shapefile_features(zip_buffer, engine=None):
+    ''' Generate GeoJSON features from a zipped shapefile one at a time.
+
+        Reads the shapefile in memory, only unzipping it to disk for ogr2ogr.
+    '''
+    if engine != 'ogr2ogr':
+        try:
+            reader = open_zipped_shapefile(zip_buffer)
+        except NotImplementedError:
+            if engine == 'python':
+                raise
+        else:
+            for feature in reader:
+                yield feature
+            return
+
+    with unzipped(zip_buffer) as shapefilepath:
+        for feature in _ogr2ogr_geojson(shapefilepath)['features']:
+            yield feature
+
+@timed('ogr2ogr')
+def _ogr2ogr_geojson(shapefilepath):
+    ''' Convert a shapefile to GeoJSON with an ogr2ogr subprocess.
     '''
     geojsonfilepath = '{0}.geojson'.format(shapefilepath)
 
@@ -17,234 +83,393 @@ def shapefile2geojson(shapefilepath):
     geojson_data.close()
     return geojson
 
-def segments_transform(raw_geojson, dataset):
+@timed('transform')
+def segments_transform(raw_geojson, dataset, workers=1, chunk_size=1000):
     ''' Return progress messages and a new GeoJSON structure.
 
-        Guess standard fields from properties.
+        Guess standard fields from properties. With more than one worker,
+        chunks of features are transformed in a process pool; inputs of
+        one chunk or less are always transformed here.
+    '''
+    messages, table = segments_transform_table(raw_geojson['features'], dataset, workers, chunk_size)
+    opentrails_geojson = table.geojson()
+
+    return messages, opentrails_geojson
+
+@timed('transform')
+def segments_transform_table(raw_features, dataset, workers=1, chunk_size=1000):
+    ''' Return progress messages and a SegmentTable of new segments.
+
+        Same as segments_transform(), but new features are kept in columns
+        instead of a list of GeoJSON dicts.
     '''
-    messages = []
-    opentrails_geojson = {'type': 'FeatureCollection', 'features': []}
+    messages, table = Messages(), SegmentTable()
+
+    if can_pool_segments(workers) and len(raw_features) > chunk_size:
+        values = _segments_transform_pooled(messages, raw_features, workers, chunk_size)
+    else:
+        plans = {}
+        values = [transform_segment_properties(messages, plans, old_segment['properties'], index)
+                  for (index, old_segment) in enumerate(raw_features)]
+        count_plan_messages(messages, plans)
+
     id_counter = itertools.count(1)
 
-    for old_segment in raw_geojson['features']:
-        old_properties = old_segment['properties']
-
-        new_segment = {
-         "type" : "Feature",
-         "geometry" : old_segment['geometry'],
-         "properties" : {
-             "id" : str(find_segment_id(messages, old_properties) or id_counter.next()),
-             "steward_id" : "0",
-             "name" : find_segment_name(messages, old_properties),
-             "motor_vehicles" : find_segment_motor_vehicles_use(messages, old_properties),
-             "foot" : find_segment_foot_use(messages, old_properties),
-             "bicycle" : find_segment_bicycle_use(messages, old_properties),
-             "horse" : find_segment_horse_use(messages, old_properties),
-             "ski" : find_segment_ski_use(messages, old_properties),
-             "wheelchair" : find_segment_wheelchair_use(messages, old_properties),
-             "osm_tags" : None
-         }
-        }
-        opentrails_geojson['features'].append(new_segment)
+    for (old_segment, segment_values) in zip(raw_features, values):
+        table.append(old_segment['geometry'], *_number_segment(segment_values, id_counter))
+
+    return messages, table
+
+@timed('transform')
+def iter_segments_transform(messages, raw_features, dataset):
+    ''' Generate new GeoJSON segment features one at a time.
+
+        Guess standard fields from properties, gathering messages along the way.
+    '''
+    id_counter = itertools.count(1)
+    plans = {}
+
+    for (index, old_segment) in enumerate(raw_features):
+        values = transform_segment_properties(messages, plans, old_segment['properties'], index)
+        yield _segment_feature(old_segment['geometry'], values, id_counter)
+
+    count_plan_messages(messages, plans)
 
-    deduped_messages = []
+def can_pool_segments(workers):
+    ''' Return true if segments can be transformed in a pool of this many workers.
 
-    for message in messages:
-        if message not in deduped_messages:
-            deduped_messages.append(message)
+        Pool workers, like background jobs, are daemons and can't start
+        pools of their own.
+    '''
+    return workers > 1 and not current_process().daemon
+
+# Features being transformed by _segments_transform_pooled(), which
+# pool workers get a copy of when they're forked.
+_pooled_features = None
 
-    return deduped_messages, opentrails_geojson
+def _segments_transform_pooled(messages, raw_features, workers, chunk_size):
+    ''' Return a list of new segment property values, transformed in a process pool.
 
-def find_segment_id(messages, properties):
-    ''' Return the value of a unique segment identifier from feature properties.
+        Values and messages are the same as from transform_segment_properties().
+        Workers are forked with the features already in memory, so only
+        index ranges go to them and only new property values come back.
+    '''
+    global _pooled_features
+    _pooled_features = raw_features
+    pool = Pool(workers)
+
+    try:
+        ranges = [(start, start + chunk_size) for start in range(0, len(raw_features), chunk_size)]
+        values = []
+
+        for (chunk_messages, chunk_values) in pool.imap(_transform_segments_range, ranges):
+            messages.extend(chunk_messages)
+            values.extend(chunk_values)
+
+        return values
+
+    finally:
+        pool.terminate()
+        _pooled_features = None
+
+def _transform_segments_range((start, end)):
+    ''' Return messages and new property values for a range of pooled features.
+    '''
+    messages, plans = Messages(), {}
+    values = [transform_segment_properties(messages, plans, old_segment['properties'], index)
+              for (index, old_segment) in enumerate(_pooled_features[start:end], start)]
+
+    count_plan_messages(messages, plans)
+    return messages, values
+
+def transform_segment_properties(messages, plans, old_properties, index=None):
+    ''' Return a tuple of new OpenTrails property values for one segment.
+
+        Values are in the order used by plan_segment_fields(). Plans are
+        cached per set of keys, and the id is None when there's no value.
+    '''
+    keys = tuple(old_properties.keys())
+
+    # Work out which columns to use once for each distinct set of keys.
+    if keys not in plans:
+        plans[keys] = FieldPlan(plan_segment_fields, messages, keys)
+
+    plan = plans[keys]
+    plan.used(index)
+
+    old_id = plan.getters[0](old_properties)
+    values = [get_value(old_properties) for get_value in plan.getters[1:]]
+
+    return tuple([str(old_id) if old_id else None] + values)
+
+def _number_segment(values, id_counter):
+    ''' Return new segment property values, numbering the segment if it has no id.
+    '''
+    return (values[0] or str(id_counter.next()), ) + values[1:]
+
+def _segment_feature(geometry, values, id_counter):
+    ''' Return a new segment feature, numbering it if it has no id.
+    '''
+    id, name, motor_vehicles, foot, bicycle, horse, ski, wheelchair = _number_segment(values, id_counter)
+
+    return {
+     "type" : "Feature",
+     "geometry" : geometry,
+     "properties" : {
+         "id" : id,
+         "steward_id" : "0",
+         "name" : name,
+         "motor_vehicles" : motor_vehicles,
+         "foot" : foot,
+         "bicycle" : bicycle,
+         "horse" : horse,
+         "ski" : ski,
+         "wheelchair" : wheelchair,
+         "osm_tags" : None
+     }
+    }
+
+class FieldPlan:
+
+    def __init__(self, plan_fields, messages, keys, *args):
+        '''
+        Value getters for one set of property keys, and the features they're used for
+
+        Messages from planning go to the messages list once, and are
+        counted again for each feature by count_plan_messages().
+        '''
+        plan_messages = []
+        self.getters = plan_fields(plan_messages, keys, *args)
+        self.messages = dedupe_messages(plan_messages)
+        self.count, self.indexes = 0, []
+        self.max_indexes = getattr(messages, 'max_indexes', max_message_indexes)
+        messages.extend(self.messages)
+
+    def used(self, index):
+        self.count += 1
+
+        if index is not None and len(self.indexes) < self.max_indexes:
+            self.indexes.append(index)
+
+def count_plan_messages(messages, plans):
+    ''' Count messages from field plans once for every feature that used them.
+
+        Plain lists of messages can't hold counts, and are left alone.
+    '''
+    if not isinstance(messages, Messages):
+        return
+
+    for plan in plans.values():
+        for message in plan.messages:
+            messages.add(message, plan.count - 1, plan.indexes)
+
+def plan_segment_fields(messages, keys):
+    ''' Return a tuple of value-getting functions for segment properties with these keys.
+
+        Getters are in the order used by segments_transform(). Gather messages
+        along the way about potential problems, once for the whole set of keys.
+    '''
+    return (
+        find_segment_id(messages, keys),
+        find_segment_name(messages, keys),
+        find_segment_motor_vehicles_use(messages, keys),
+        find_segment_foot_use(messages, keys),
+        find_segment_bicycle_use(messages, keys),
+        find_segment_horse_use(messages, keys),
+        find_segment_ski_use(messages, keys),
+        find_segment_wheelchair_use(messages, keys)
+        )
+
+def find_segment_id(messages, keys):
+    ''' Return a getter for a unique segment identifier from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/26
 
         Gather messages along the way about potential problems.
     '''
-    keys, values = zip(*[(k.lower(), v) for (k, v) in properties.items()])
+    column = _find_listed_field(keys, ('id', 'trailid', 'objectid', 'trail id', 'object id'))
 
-    for field in ('id', 'trailid', 'objectid', 'trail id', 'object id'):
-        if field in keys:
-            return values[keys.index(field)]
+    if column is not None:
+        return itemgetter(column)
 
     messages.append(('warning', 'missing-segment-id', 'No column found for trail ID, such as "id" or "trailid". A new numeric ID was created.'))
 
-    return None
+    return _get_nothing
 
-def find_segment_name(messages, properties):
-    ''' Return the value of a segment name from feature properties.
+def find_segment_name(messages, keys):
+    ''' Return a getter for a segment name from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/35
 
         Gather messages along the way about potential problems.
     '''
-    keys, values = zip(*[(k.lower(), v) for (k, v) in properties.items()])
+    column = _find_listed_field(keys, ('name', 'trail', 'trailname', 'trail name', 'trail_name'))
 
-    for field in ('name', 'trail', 'trailname', 'trail name', 'trail_name'):
-        if field in keys:
-            return values[keys.index(field)]
+    if column is not None:
+        return itemgetter(column)
 
     messages.append(('error', 'missing-segment-name', 'No column found for trail name, such as "name" or "trail".'))
 
-    return None
+    return _get_nothing
+
+def _find_listed_field(keys, fieldnames):
+    ''' Return the first key matching one of the case-insensitive field names.
 
-def _has_listed_field(properties, fieldnames):
-    ''' Return true if properties has one of the case-insensitive field names.
+        Fieldnames are searched in order, and the first key with a
+        matching lowercase form wins. Return None if nothing matches.
     '''
-    keys = [k.lower() for k in properties.keys()]
+    lowered = [k.lower() for k in keys]
 
     for field in fieldnames:
-        if field.lower() in keys:
-            return True
+        if field.lower() in lowered:
+            return keys[lowered.index(field.lower())]
 
-    return False
+    return None
 
-def _get_value_yes_no(properties, fieldnames):
-    ''' Return yes/no value for one of the case-insensitive field names.
+def _get_nothing(properties):
+    ''' Return None for any properties; used when no column was found.
+    '''
+    return None
+
+def _get_value_yes_no(column):
+    ''' Return a getter for the yes/no value of a column.
     '''
     yes_nos = {'y': 'yes', 'yes': 'yes', 'n': 'no', 'no': 'no'}
 
-    keys, values = zip(*[(k.lower(), v) for (k, v) in properties.items()])
+    def get_value(properties):
+        value = properties[column]
+        return value and yes_nos.get(value.lower(), None)
 
-    for field in fieldnames:
-        if field.lower() in keys:
-            value = values[keys.index(field.lower())]
-            return value and yes_nos.get(value.lower(), None)
+    return get_value
 
-    return None
-
-def _get_match_yes_no(properties, pattern, fieldnames):
-    ''' Return yes/no value for pattern match on one of the case-insensitive field names.
+def _get_match_yes_no(column, pattern):
+    ''' Return a getter for the yes/no value of a pattern match on a column.
     '''
-    keys, values = zip(*[(k.lower(), v) for (k, v) in properties.items()])
-
-    for field in fieldnames:
-        if field.lower() in keys:
-            value = values[keys.index(field.lower())]
+    def get_match(properties):
+        value = properties[column]
 
-            if type(value) not in (str, unicode):
-                return None
+        if type(value) not in (str, unicode):
+            return None
 
-            return pattern.search(value) and 'yes' or 'no'
+        return pattern.search(value) and 'yes' or 'no'
 
-    return None
+    return get_match
 
-def find_segment_foot_use(messages, properties):
-    ''' Return the value of a segment foot use flag from feature properties.
+def find_segment_foot_use(messages, keys):
+    ''' Return a getter for a segment foot use flag from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/28
 
         Gather messages along the way about potential problems.
     '''
     # Search for a hike column
-    fieldnames = 'hike', 'walk', 'foot'
+    column = _find_listed_field(keys, ('hike', 'walk', 'foot'))
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     # Search for a use column and look for hiking inside
-    fieldnames = 'use', 'use_type', 'pubuse'
+    column = _find_listed_field(keys, ('use', 'use_type', 'pubuse'))
     pattern = re.compile(r'\b(?<!no )(multi-use|hike|foot|hiking|walk|walking)\b', re.I)
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_match_yes_no(properties, pattern, fieldnames)
+    if column is not None:
+        return _get_match_yes_no(column, pattern)
 
     messages.append(('warning', 'missing-segment-foot', 'No column found for foot use, such as "hike" or "walk". Leaving "foot" blank.'))
 
-    return None
+    return _get_nothing
 
-def find_segment_bicycle_use(messages, properties):
-    ''' Return the value of a segment bicycle use flag from feature properties.
+def find_segment_bicycle_use(messages, keys):
+    ''' Return a getter for a segment bicycle use flag from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/29
 
         Gather messages along the way about potential problems.
     '''
     # Search for a bicycle column
-    fieldnames = 'bike', 'roadbike', 'bikes', 'road bike', 'mtnbike'
+    column = _find_listed_field(keys, ('bike', 'roadbike', 'bikes', 'road bike', 'mtnbike'))
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     # Search for a use column and look for biking inside
-    fieldnames = 'use', 'use_type', 'pubuse'
+    column = _find_listed_field(keys, ('use', 'use_type', 'pubuse'))
     pattern = re.compile(r'\b(?<!no )(multi-use|bike|bikes|roadbike|road bike|bicycles|bicycling|bicycling)\b', re.I)
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_match_yes_no(properties, pattern, fieldnames)
+    if column is not None:
+        return _get_match_yes_no(column, pattern)
 
     messages.append(('warning', 'missing-segment-bicycle', 'No column found for bicycle use, such as "bikes" or "road bike". Leaving "bicycle" blank.'))
 
-    return None
+    return _get_nothing
 
-def find_segment_horse_use(messages, properties):
-    ''' Return the value of a segment horse use flag from feature properties.
+def find_segment_horse_use(messages, keys):
+    ''' Return a getter for a segment horse use flag from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/30
 
         Gather messages along the way about potential problems.
     '''
     # Search for a horse column
-    fieldnames = 'horse', 'horses', 'equestrian'
+    column = _find_listed_field(keys, ('horse', 'horses', 'equestrian'))
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     # Search for a use column and look for horsies inside
-    fieldnames = 'use', 'use_type', 'pubuse'
+    column = _find_listed_field(keys, ('use', 'use_type', 'pubuse'))
     pattern = re.compile(r'\b(?<!no )(horse|horses|equestrian|horseback)\b', re.I)
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_match_yes_no(properties, pattern, fieldnames)
+    if column is not None:
+        return _get_match_yes_no(column, pattern)
 
     messages.append(('warning', 'missing-segment-horse', 'No column found for horse use, such as "horses", "equestrian", etc. Leaving "horse" blank.'))
 
-    return None
+    return _get_nothing
 
-def find_segment_ski_use(messages, properties):
-    ''' Return the value of a segment ski use flag from feature properties.
+def find_segment_ski_use(messages, keys):
+    ''' Return a getter for a segment ski use flag from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/31
 
         Gather messages along the way about potential problems.
     '''
     # Search for a ski column
-    fieldnames = 'ski', 'XCntrySki', 'CROSSCSKI'
+    column = _find_listed_field(keys, ('ski', 'XCntrySki', 'CROSSCSKI'))
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     # Search for a use column and look for skis inside
-    fieldnames = 'use', 'use_type', 'pubuse'
+    column = _find_listed_field(keys, ('use', 'use_type', 'pubuse'))
     pattern = re.compile(r'\b(?<!no )(ski|xcntryski|skiing|countryski|crosscountryski|multi-use)\b', re.I)
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_match_yes_no(properties, pattern, fieldnames)
+    if column is not None:
+        return _get_match_yes_no(column, pattern)
 
     messages.append(('warning', 'missing-segment-ski', 'No column found for ski use, such as "skiing" or "cross country ski". Leaving "ski" blank.'))
 
-    return None
+    return _get_nothing
 
-def find_segment_wheelchair_use(messages, properties):
-    ''' Return the value of a segment wheelchair use flag from feature properties.
+def find_segment_wheelchair_use(messages, keys):
+    ''' Return a getter for a segment wheelchair use flag from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/32
 
         Gather messages along the way about potential problems.
     '''
     # Search for a wheelchair column
-    fieldnames = 'wheelchair', "accessible", "adaaccess", "accesibil", "ada"
+    column = _find_listed_field(keys, ('wheelchair', "accessible", "adaaccess", "accesibil", "ada"))
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     messages.append(('warning', 'missing-segment-wheelchair', 'No column found for wheelchair accessibility, such as "accessible" or "ADA". Leaving "wheelchair" blank.'))
 
-    return None
+    return _get_nothing
 
-def find_segment_motor_vehicles_use(messages, properties):
-    ''' Return the value of a segment motor_vehicles use flag from feature properties.
+def find_segment_motor_vehicles_use(messages, keys):
+    ''' Return a getter for a segment motor_vehicles use flag from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/33
 
@@ -254,16 +479,18 @@ def find_segment_motor_vehicles_use(messages, properties):
     fieldnames = "MOTORBIKE", "ALLTERVEH", "ATV", "FOURWD", "4WD", "Motorcycle", "Snowmobile"
     #  we recieved one set of data wherein the field name is MOTORBIKE, and the value is 'motorcycle'
     pattern = re.compile(r'\b(?<!no )(motorcylce)\b', re.I)
+    column = _find_listed_field(keys, fieldnames)
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     messages.append(('warning', 'missing-segment-motor-vehicles', 'No column found for motor vehicle use, such as "motorbike" or "ATV". Leaving "motor_vehicles" blank.'))
 
-    return None
+    return _get_nothing
 
 # AJW Code Begins Here
 
+@timed('transform')
 def trailheads_transform(raw_geojson, dataset):
     ''' Return progress messages and a new GeoJSON structure.
 
@@ -271,190 +498,227 @@ def trailheads_transform(raw_geojson, dataset):
 
         Pattern replicated from segments_transform
     '''
-    messages = []
-    opentrails_trailheads_geojson = {'type': 'FeatureCollection', 'features': []}
+    messages = Messages()
+    features = iter_trailheads_transform(messages, raw_geojson['features'], dataset)
+    opentrails_trailheads_geojson = {'type': 'FeatureCollection', 'features': list(features)}
+
+    return messages, opentrails_trailheads_geojson
+
+@timed('transform')
+def iter_trailheads_transform(messages, raw_features, dataset):
+    ''' Generate new GeoJSON trailhead features one at a time.
+
+        Guess standard fields from properties, gathering messages along the way.
+    '''
     id_counter = itertools.count(1)
+    plans = {}
 
-    for old_trailhead in raw_geojson['features']:
+    for (index, old_trailhead) in enumerate(raw_features):
         old_properties = old_trailhead['properties']
+        keys = tuple(old_properties.keys())
+
+        # Work out which columns to use once for each distinct set of keys.
+        if keys not in plans:
+            plans[keys] = FieldPlan(plan_trailhead_fields, messages, keys, dataset)
+
+        plan = plans[keys]
+        plan.used(index)
+
+        get_id, get_name, get_trail_ids, get_address, get_parking, \
+            get_restrooms, get_kiosk, get_drinkwater = plan.getters
 
         new_trailhead = {
           "type" :  "Feature",
           "geometry" : old_trailhead['geometry'],
           "properties" : {
-            "id": str(find_trailhead_id(messages, old_properties) or id_counter.next()),
+            "id": str(get_id(old_properties) or id_counter.next()),
             "steward_id": "0", # Steward ID 0 is the only steward we generate.
-            "name": find_trailhead_name(messages, old_properties),
+            "name": get_name(old_properties),
             "area_id": "0",
-            "trail_ids": find_trailhead_trail_ids(messages, old_properties, dataset),
-            "address": find_trailhead_address(messages, old_properties),
-            "parking": find_trailhead_parking(messages, old_properties),
-            "restrooms": find_trailhead_restrooms(messages, old_properties),
-            "kiosk": find_trailhead_kiosk(messages, old_properties),
-            "drink water": find_trailhead_drinkwater(messages, old_properties),
+            "trail_ids": get_trail_ids(old_properties, old_trailhead['geometry']),
+            "address": get_address(old_properties),
+            "parking": get_parking(old_properties),
+            "restrooms": get_restrooms(old_properties),
+            "kiosk": get_kiosk(old_properties),
+            "drink water": get_drinkwater(old_properties),
             "osm_tags": None
           }
         }
-        opentrails_trailheads_geojson['features'].append(new_trailhead)
+        yield new_trailhead
 
-    deduped_messages = []
+    count_plan_messages(messages, plans)
 
-    for message in messages:
-        if message not in deduped_messages:
-            deduped_messages.append(message)
+def plan_trailhead_fields(messages, keys, dataset):
+    ''' Return a tuple of value-getting functions for trailhead properties with these keys.
 
-    return deduped_messages, opentrails_trailheads_geojson
-
-
-def find_trailhead_id(messages, properties):
-    ''' Return the value of a unique segment identifier from feature properties.
+        Getters are in the order used by trailheads_transform(). Gather messages
+        along the way about potential problems, once for the whole set of keys.
+    '''
+    return (
+        find_trailhead_id(messages, keys),
+        find_trailhead_name(messages, keys),
+        find_trailhead_trail_ids(messages, keys, dataset),
+        find_trailhead_address(messages, keys),
+        find_trailhead_parking(messages, keys),
+        find_trailhead_restrooms(messages, keys),
+        find_trailhead_kiosk(messages, keys),
+        find_trailhead_drinkwater(messages, keys)
+        )
+
+def find_trailhead_id(messages, keys):
+    ''' Return a getter for a unique segment identifier from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/37
 
         Gather messages along the way about potential problems.
     '''
+    column = _find_listed_field(keys, ('id', 'objectid', 'object id'))
 
-    keys, values = zip(*[(k.lower(), v) for (k, v) in properties.items()])
-
-    for field in ('id', 'objectid', 'object id'):
-        if field in keys:
-            return values[keys.index(field)]
+    if column is not None:
+        return itemgetter(column)
 
     messages.append(('warning', 'missing-trailhead-id', 'No column found for trailhead ID, such as "id" or "objectid". A new numeric ID was created. '))
 
-    return None
+    return _get_nothing
 
-def find_trailhead_name(messages, properties):
-    ''' Return the value of a segment name from feature properties.
+def find_trailhead_name(messages, keys):
+    ''' Return a getter for a segment name from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/36
 
         Gather messages along the way about potential problems.
     '''
+    column = _find_listed_field(keys, ('name', 'thname'))
 
-    keys, values = zip(*[(k.lower(), v) for (k, v) in properties.items()])
-
-    for field in ('name', 'thname'):
-        if field in keys:
-            return values[keys.index(field)]
+    if column is not None:
+        return itemgetter(column)
 
     messages.append(('error', 'missing-trailhead-name', 'No column found for trail name, such as "name" or "thname".'))
 
-    return None
+    return _get_nothing
 
-def find_trailhead_trail_ids(messages, properties, dataset):
-    ''' Return the value of a segment name from feature properties.
+def find_trailhead_trail_ids(messages, keys, dataset):
+    ''' Return a getter for a segment name from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/39
 
         Gather messages along the way about potential problems.
     '''
+    lowered = [k.lower() for k in keys]
+    columns = list()
 
-    keys, values = zip(*[(k.lower(), v) for (k, v) in properties.items()])
+    for key in lowered:
+        if key.startswith('trail') or key.startswith('segment'):
+            columns.append(keys[lowered.index(key)])
 
-    id_values = list()
+    if len(columns):
+        def get_trail_ids(properties, geometry):
+            return encode_list([properties[column] for column in columns])
 
-    for key in keys:
-        if key.startswith('trail') or key.startswith('segment'):
-            id_values.append(values[keys.index(key)])
+        return get_trail_ids
+
+    # Without trail columns, look for segments near each trailhead instead.
+    segment_index = dataset and get_segment_index(dataset)
+
+    if segment_index is not None:
+        distance = app.config['TRAILHEAD_DISTANCE']
+        messages.append(('warning', 'nearby-trailhead-trail-ids', 'No column found for trail names, such as "trailname" or "trail1". Trailheads were associated with trail segments within {0:g} meters.'.format(distance)))
+
+        def get_nearby_trail_ids(properties, geometry):
+            return encode_list(segment_index.nearby(geometry, distance)) or None
 
-    if len(id_values):
-        return encode_list(id_values)
+        return get_nearby_trail_ids
 
     messages.append(('error', 'missing-trailhead-trail-ids', 'No column found for trail names, such as "trailname" or "trail1". Trailhead should be associated with at least one trail.'))
 
-    return None
+    def get_no_trail_ids(properties, geometry):
+        return None
+
+    return get_no_trail_ids
 
-def find_trailhead_address(messages, properties):
-    ''' Return the value of a segment name from feature properties.
+def find_trailhead_address(messages, keys):
+    ''' Return a getter for a segment name from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/41
 
         Gather messages along the way about potential problems.
     '''
+    column = _find_listed_field(keys, ('add', 'addr', 'address', 'street', 'siteaddr'))
 
-    keys, values = zip(*[(k.lower(), v) for (k, v) in properties.items()])
-
-    for field in ('add', 'addr', 'address', 'street', 'siteaddr'):
-        if field in keys:
-            return values[keys.index(field)]
+    if column is not None:
+        return itemgetter(column)
 
     messages.append(('warning', 'missing-trailhead-address', 'No column found for trailhead address, such as "address" or "siteaddr". Leaving "address" blank.'))
 
-    return None
+    return _get_nothing
 
-def find_trailhead_parking(messages, properties):
-    ''' Return the value of a segment name from feature properties.
+def find_trailhead_parking(messages, keys):
+    ''' Return a getter for a segment name from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/42
 
         Gather messages along the way about potential problems.
     '''
+    column = _find_listed_field(keys, ('park', 'parking', 'parking lot', 'roadside'))
 
-    keys, values = zip(*[(k.lower(), v) for (k, v) in properties.items()])
-
-    fieldnames = 'park', 'parking', 'parking lot', 'roadside'
-
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     # Search for a parking column and look for parking strings inside
-    fieldnames = 'park', 'parking'
+    column = _find_listed_field(keys, ('park', 'parking'))
     pattern = re.compile(r'\b(?<!no )(parking lot|roadside parking|parking)\b', re.I)
 
-    if _has_listed_field(properties, fieldnames):
-        return _get_match_yes_no(properties, pattern, fieldnames)
+    if column is not None:
+        return _get_match_yes_no(column, pattern)
 
     messages.append(('warning', 'missing-trailhead-parking', 'No column found for trailhead parking, such as "parking" or "roadside". Leaving "parking" blank.'))
 
-    return None
+    return _get_nothing
 
-def find_trailhead_restrooms(messages, properties):
-    ''' Return the value of a segment name from feature properties.
+def find_trailhead_restrooms(messages, keys):
+    ''' Return a getter for a segment name from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/44
 
         Gather messages along the way about potential problems.
     '''
+    column = _find_listed_field(keys, ('restroom', 'bathroom', 'toilet', 'restrooms'))
 
-    fieldnames = 'restroom', 'bathroom', 'toilet', 'restrooms'
-
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     messages.append(('warning', 'missing-trailhead-restroom', 'No column found for trailhead restroom, such as "bathroom" or "toilet". Leaving "restroom" blank.'))
 
-    return None
+    return _get_nothing
 
-def find_trailhead_kiosk(messages, properties):
-    ''' Return the value of a segment name from feature properties.
+def find_trailhead_kiosk(messages, keys):
+    ''' Return a getter for a segment name from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/45
 
         Gather messages along the way about potential problems.
     '''
+    column = _find_listed_field(keys, ('info', 'information', 'kiosk'))
 
-
-    fieldnames = 'info', 'information', 'kiosk'
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     messages.append(('warning', 'missing-trailhead-kiosk', 'No column found for trailhead kiosk, such as "info" or "kiosk". Leaving "kiosk" blank.'))
 
-    return None
+    return _get_nothing
 
-def find_trailhead_drinkwater(messages, properties):
-    ''' Return the value of a segment name from feature properties.
+def find_trailhead_drinkwater(messages, keys):
+    ''' Return a getter for a segment name from feature properties.
 
         Implements logic in https://github.com/codeforamerica/PLATS/issues/43
 
         Gather messages along the way about potential problems.
     '''
+    column = _find_listed_field(keys, ('water', 'drinkingwa', 'drinkwater'))
 
-    fieldnames = 'water', 'drinkingwa', 'drinkwater'
-    if _has_listed_field(properties, fieldnames):
-        return _get_value_yes_no(properties, fieldnames)
+    if column is not None:
+        return _get_value_yes_no(column)
 
     messages.append(('warning', 'missing-trailhead-drinkwater', 'No column found for trailhead drinking water, such as "drinkwater" or "water". Leaving "drinkwater" blank.'))
 
-    return None
+    return _get_nothing
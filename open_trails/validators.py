@@ -1,8 +1,13 @@
-from os.path import exists, basename
-from csv import DictReader
+from os.path import exists, basename, getsize
+from csv import DictReader, Error as CSVError
+from multiprocessing import Pool, current_process
+from types import GeneratorType
+from zipfile import ZipFile
 from json import load, dumps
 
-from shapely.geometry import shape
+from .functions import Messages, iter_geojson_members
+from .tables import SegmentTable
+from .metrics import timed
 
 class _VE (Exception):
 
@@ -10,109 +15,358 @@ class _VE (Exception):
         self.type = type
         self.message = message
 
-def check_open_trails(ts_path, nt_path, th_path, s_path, a_path):
-    '''
+# File checks in the order their messages are reported, with messages for missing files.
+_file_checks = (
+    ('check_trail_segments', 'error', 'missing-file-trail-segments', 'Could not find required file trail_segments.geojson.'),
+    ('check_named_trails', 'error', 'missing-file-named-trails', 'Could not find required file named_trails.csv.'),
+    ('check_trailheads', 'error', 'missing-file-trailheads', 'Could not find required file trailheads.geojson.'),
+    ('check_stewards', 'error', 'missing-file-stewards', 'Could not find required file stewards.csv.'),
+    ('check_areas', 'warning', 'missing-file-areas', 'Could not find optional file areas.geojson.')
+    )
+
+# Total file size below which files are checked one at a time anyway.
+parallel_bytes = 1024 * 1024
+
+@timed('validate')
+def check_open_trails(ts_path, nt_path, th_path, s_path, a_path, workers=1):
+    ''' Return messages and a success flag for OpenTrails files at the given paths.
+
+        Each path can also be a (zip file path, member name) pair, to read
+        the file straight out of an archive, or None for a missing file.
+        Trail segments can be a SegmentTable, checked without any GeoJSON.
+
+        Messages are deduplicated and counted as they arrive. Given more
+        than one worker, files are checked at the same time in a pool of up
+        to five processes once there's more than parallel_bytes to check.
     '''
-    msgs = []
-    
-    if exists(ts_path):
-        check_trail_segments(msgs, ts_path)
-    else:
-        msgs.append(('error', 'missing-file-trail-segments',
-                     'Could not find required file trail_segments.geojson.'))
-    
-    if exists(nt_path):
-        check_named_trails(msgs, nt_path)
-    else:
-        msgs.append(('error', 'missing-file-named-trails',
-                     'Could not find required file named_trails.csv.'))
-    
-    if exists(th_path):
-        check_trailheads(msgs, th_path)
-    else:
-        msgs.append(('error', 'missing-file-trailheads',
-                     'Could not find required file trailheads.geojson.'))
-    
-    if exists(s_path):
-        check_stewards(msgs, s_path)
-    else:
-        msgs.append(('error', 'missing-file-stewards',
-                     'Could not find required file stewards.csv.'))
-    
-    if exists(a_path):
-        check_areas(msgs, a_path)
+    paths = ts_path, nt_path, th_path, s_path, a_path
+    found = [path for path in paths if _exists(path)]
+
+    if workers > 1 and sum([_getsize(path) for path in found]) <= parallel_bytes:
+        workers = 1
+
+    # Pool workers are daemons, and can't start pools of their own.
+    if min(workers, len(found)) > 1 and not current_process().daemon:
+        file_messages = _check_files_pooled(paths, min(workers, len(found)))
     else:
-        msgs.append(('warning', 'missing-file-areas',
-                     'Could not find optional file areas.geojson.'))
-    
-    deduped_messages = []
-    passed_validation = True
+        file_messages = [_check_file(check[0], path) if _exists(path) else None
+                         for (check, path) in zip(_file_checks, paths)]
+
+    msgs = Messages()
+
+    for ((name, level, id, words), messages) in zip(_file_checks, file_messages):
+        if messages is None:
+            msgs.append((level, id, words))
+        else:
+            msgs.extend(messages)
     
-    for message in msgs:
-        if message not in deduped_messages:
-            deduped_messages.append(message)
-        
-        if message[0] == 'error':
-            passed_validation = False
+    passed_validation = 'error' not in [level for (level, id, words) in msgs]
     
-    return deduped_messages, passed_validation
+    return msgs, passed_validation
+
+def _check_files_pooled(paths, workers):
+    ''' Return a list of Messages for each path, or None for missing paths.
+
+        Biggest files are started first, so the slowest check isn't left for last.
+    '''
+    pool = Pool(workers)
+
+    try:
+        checks = [(_getsize(path), index, name, path) for (index, ((name, _, _, _), path))
+                  in enumerate(zip(_file_checks, paths)) if _exists(path)]
+
+        results = [None] * len(paths)
+
+        for (size, index, name, path) in sorted(checks, reverse=True):
+            results[index] = pool.apply_async(_check_file, (name, path))
+
+        return [result and result.get() for result in results]
+
+    finally:
+        pool.terminate()
+
+def _check_file(name, path):
+    ''' Return Messages from the named check function for one file.
+    '''
+    messages = Messages()
+    globals()[name](messages, path)
+    return messages
+
+def _exists(path):
+    if isinstance(path, SegmentTable):
+        return True
+
+    if type(path) is tuple:
+        zip_path, member = path
+        return member in ZipFile(zip_path).namelist()
+
+    return path is not None and exists(path)
+
+def _getsize(path):
+    if isinstance(path, SegmentTable):
+        return path.coords.itemsize * len(path.coords)
+
+    if type(path) is tuple:
+        zip_path, member = path
+        return ZipFile(zip_path).getinfo(member).file_size
+
+    return getsize(path)
+
+def _basename(path):
+    return basename(path[1] if type(path) is tuple else path)
+
+def _open(path):
+    ''' Return an open file from a path, or from a (zip file path, member name) pair.
+
+        Zipped files are decompressed as they're read, without a copy on disk.
+    '''
+    if type(path) is tuple:
+        zip_path, member = path
+        return ZipFile(zip_path).open(member)
+
+    return open(path)
 
 _geojson_geometry_types = 'Point', 'LineString', 'MultiLineString', 'Polygon', 'MultiPolygon'
 
-def check_geojson_structure(path, allowed_geometry_types=_geojson_geometry_types):
+def check_geojson_structure(path, allowed_geometry_types=_geojson_geometry_types, full_topology=False):
     ''' Verify core GeoJSON syntax of a file.
     
         Return features list if everything checks out, or raise a validation error.
     '''
-    name = basename(path)
+    return list(iter_geojson_structure(path, allowed_geometry_types, full_topology))
+
+def iter_geojson_structure(path, allowed_geometry_types=_geojson_geometry_types, full_topology=False):
+    ''' Verify core GeoJSON syntax of a file, generating features as they're read.
+    
+        Raise a validation error at the end if anything was wrong. Features
+        generated before then should be ignored, just like a partial list.
+        
+        Geometry coordinates are checked for structure only, unless full_topology
+        is true and each geometry is also built with Shapely.
+    '''
+    name = _basename(path)
     t = 'incorrect-geojson-file'
+    data_type, has_features, feature_error = None, False, None
     
     try:
-        data = load(open(path))
-    except:
+        with _open(path) as file:
+            for (key, value) in iter_geojson_members(file):
+                if key == 'type':
+                    data_type = value
+                
+                elif key == 'features':
+                    has_features = isinstance(value, GeneratorType)
+                    
+                    if not has_features or (data_type not in (None, 'FeatureCollection')):
+                        # Skip features that will never be used.
+                        continue
+                    
+                    for feature in value:
+                        try:
+                            _check_geojson_feature(feature, name, allowed_geometry_types, full_topology)
+                        except _VE, e:
+                            feature_error = e
+                            break
+                        
+                        yield feature
+    except (IOError, ValueError):
         raise _VE(t, 'Could not load required file {0}.'.format(name))
     
-    if data.get('type', None) != 'FeatureCollection':
+    if data_type != 'FeatureCollection':
         raise _VE(t, 'Incorrect GeoJSON type in {0}.'.format(name))
     
-    if type(data.get('features', None)) is not list:
+    if not has_features:
         raise _VE(t, 'Bad features list in {0}.'.format(name))
     
-    for feature in data['features']:
-        if feature.get('type', None) != 'Feature':
-            raise _VE(t, 'Incorrect GeoJSON feature type in {0}.'.format(name))
+    if feature_error:
+        raise feature_error
+
+def _check_geojson_feature(feature, name, allowed_geometry_types, full_topology):
+    ''' Verify core GeoJSON syntax of a single feature, or raise a validation error.
+    '''
+    t = 'incorrect-geojson-file'
+    
+    if type(feature) is not dict or feature.get('type', None) != 'Feature':
+        raise _VE(t, 'Incorrect GeoJSON feature type in {0}.'.format(name))
 
-        if type(feature.get('properties', None)) is not dict:
-            raise _VE(t, 'Incorrect GeoJSON properties type in {0}.'.format(name))
+    if type(feature.get('properties', None)) is not dict:
+        raise _VE(t, 'Incorrect GeoJSON properties type in {0}.'.format(name))
 
-        if type(feature.get('geometry', None)) is not dict:
-            raise _VE(t, 'Incorrect GeoJSON geometry type in {0}.'.format(name))
+    if type(feature.get('geometry', None)) is not dict:
+        raise _VE(t, 'Incorrect GeoJSON geometry type in {0}.'.format(name))
+    
+    if feature['geometry'].get('type', None) not in allowed_geometry_types:
+        raise _VE(t, 'Incorrect GeoJSON geometry type in {0}.'.format(name))
+    
+    geometry = feature['geometry']
+    
+    if not check_coordinates(geometry['type'], geometry.get('coordinates', None)):
+        raise _VE(t, 'Unrecognizeable GeoJSON geometry in {0}.'.format(name))
+    
+    if full_topology:
+        from shapely.geometry import shape
+    
+        try:
+            shape(geometry)
+        except ValueError, e:
+            raise _VE(t, 'Unrecognizeable GeoJSON geometry in {0}.'.format(name))
+
+_sequence_types = list, tuple
+_number_types = int, long, float
+
+def check_coordinates(geometry_type, coordinates):
+    ''' Return true if GeoJSON coordinates are well-formed for a geometry type.
+    
+        Checks nesting depth, minimum vertex counts and ring closure without
+        building geometry objects. Empty coordinates are allowed, as in Shapely.
+    '''
+    if type(coordinates) not in _sequence_types:
+        return False
+    
+    if len(coordinates) == 0:
+        return True
+    
+    if geometry_type == 'Point':
+        return _is_position(coordinates)
+    
+    if geometry_type == 'LineString':
+        return _is_line(coordinates)
+    
+    if geometry_type == 'MultiLineString':
+        return all([_is_line(line) for line in coordinates])
+    
+    if geometry_type == 'Polygon':
+        return _is_polygon(coordinates)
+    
+    if geometry_type == 'MultiPolygon':
+        return all([_is_polygon(polygon) for polygon in coordinates])
+    
+    return False
+
+def _is_position(position):
+    ''' Return true for a sequence of two or more numbers.
+    '''
+    if type(position) not in _sequence_types or len(position) < 2:
+        return False
+    
+    for number in position:
+        if type(number) not in _number_types:
+            return False
+    
+    return True
+
+def _is_line(line, minimum=2):
+    ''' Return true for a sequence of at least minimum positions.
+    '''
+    if type(line) not in _sequence_types or len(line) < minimum:
+        return False
+    
+    for position in line:
+        if not _is_position(position):
+            return False
+    
+    return True
+
+def _is_polygon(polygon):
+    ''' Return true for a non-empty sequence of closed rings of four or more positions.
+    '''
+    if type(polygon) not in _sequence_types or len(polygon) == 0:
+        return False
+    
+    for ring in polygon:
+        if not _is_line(ring, 4) or ring[0] != ring[-1]:
+            return False
+    
+    return True
+
+def check_table_structure(table, name, allowed_geometry_types=_geojson_geometry_types):
+    ''' Verify geometries of a SegmentTable, or raise a validation error.
+    
+        Makes the same checks as check_geojson_structure() does for each
+        feature, using the table's coordinate counts instead of building lists.
+    '''
+    t = 'incorrect-geojson-file'
+    
+    for index in xrange(len(table)):
+        geometry_type, dims, counts, coords = table.geometry_layout(index)
         
-        if feature['geometry'].get('type', None) not in allowed_geometry_types:
+        if geometry_type is None:
+            # Not stored in columns, so check it like any other geometry.
+            feature = dict(type='Feature', properties={}, geometry=table.geometry(index))
+            _check_geojson_feature(feature, name, allowed_geometry_types, False)
+            continue
+        
+        if geometry_type not in allowed_geometry_types:
             raise _VE(t, 'Incorrect GeoJSON geometry type in {0}.'.format(name))
         
-        try:
-            shape(feature['geometry'])
-        except ValueError, e:
+        if not _check_counted_coordinates(geometry_type, dims, counts, coords):
             raise _VE(t, 'Unrecognizeable GeoJSON geometry in {0}.'.format(name))
+
+def _check_counted_coordinates(geometry_type, dims, counts, coords):
+    ''' Return true if counted coordinates are well-formed, like check_coordinates().
+    
+        Numbers and dimensions were already checked when the table was filled.
+    '''
+    if geometry_type == 'Point' or counts[0] == 0:
+        return True
     
-    return data['features']
+    if geometry_type == 'LineString':
+        return counts[0] >= 2
+    
+    if geometry_type == 'MultiLineString':
+        return min(counts[1:]) >= 2
+    
+    if geometry_type == 'Polygon':
+        polygons = [counts[1:]]
+    
+    elif geometry_type == 'MultiPolygon':
+        polygons, offset = [], 1
+        while offset < len(counts):
+            polygons.append(counts[offset + 1:offset + 1 + counts[offset]])
+            offset += 1 + counts[offset]
+    
+    else:
+        return False
+    
+    start = 0
+    
+    for rings in polygons:
+        if len(rings) == 0:
+            return False
+        
+        for length in rings:
+            end = start + length
+            first, last = coords[start * dims:(start + 1) * dims], coords[(end - 1) * dims:end * dims]
+            
+            if length < 4 or first != last:
+                return False
+            
+            start = end
+    
+    return True
 
 def check_csv_structure(path):
     ''' Verify core CSV syntax of a file.
     
         Return rows list if everything checks out, or raise a validation error.
     '''
-    name = basename(path)
+    return list(iter_csv_structure(path))
+
+def iter_csv_structure(path):
+    ''' Verify core CSV syntax of a file, generating rows as they're read.
+    
+        Raise a validation error if anything was wrong, possibly after some rows.
+    '''
+    name = _basename(path)
     
     try:
-        rows = list(DictReader(open(path)))
-    except:
+        with _open(path) as file:
+            for row in DictReader(file):
+                yield row
+    except (IOError, CSVError):
         raise _VE('incorrect-csv-file', 'Could not load required file "{0}".'.format(name))
-    
-    return rows
 
-def _check_required_string_field(messages, field, dictionary, table_name):
+def _check_required_string_field(messages, field, dictionary, table_name, index=None):
     ''' Find and note missing or badly-typed required string fields.
     '''
     message_type = 'bad-data-' + table_name.replace(' ', '-')
@@ -120,14 +374,14 @@ def _check_required_string_field(messages, field, dictionary, table_name):
     
     if field not in dictionary:
         message_text = 'Required {0} field "{1}" is missing.'.format(table_name, field)
-        messages.append(('error', message_type, message_text))
+        messages.append(('error', message_type, message_text), index)
 
     elif type(dictionary[field]) not in (str, unicode):
         found_type = type(dictionary[field])
         message_text = '{0} "{1}" field is the wrong type: {2}.'.format(title_name, field, repr(found_type))
-        messages.append(('error', message_type, message_text))
+        messages.append(('error', message_type, message_text), index)
 
-def _check_optional_string_field(messages, field, dictionary, table_name):
+def _check_optional_string_field(messages, field, dictionary, table_name, index=None):
     ''' Find and note missing or badly-typed optional string fields.
     '''
     message_type = 'bad-data-' + table_name.replace(' ', '-')
@@ -135,14 +389,14 @@ def _check_optional_string_field(messages, field, dictionary, table_name):
     
     if field not in dictionary:
         message_text = 'Optional {0} field "{1}" is missing.'.format(table_name, field)
-        messages.append(('warning', message_type, message_text))
+        messages.append(('warning', message_type, message_text), index)
 
     elif type(dictionary[field]) not in (str, unicode, type(None)):
         found_type = type(dictionary[field])
         message_text = '{0} "{1}" field is the wrong type: {2}.'.format(title_name, field, repr(found_type))
-        messages.append(('error', message_type, message_text))
+        messages.append(('error', message_type, message_text), index)
 
-def _check_required_boolean_field(messages, field, dictionary, table_name):
+def _check_required_boolean_field(messages, field, dictionary, table_name, index=None):
     ''' Find and note missing or badly-typed required boolean fields.
     '''
     message_type = 'bad-data-' + table_name.replace(' ', '-')
@@ -150,7 +404,7 @@ def _check_required_boolean_field(messages, field, dictionary, table_name):
     
     if field not in dictionary:
         message_text = 'Optional {0} field "{1}" is missing.'.format(table_name, field)
-        messages.append(('error', message_type, message_text))
+        messages.append(('error', message_type, message_text), index)
 
     else:
         value = dictionary[field].lower() if (dictionary[field] is not None) else None
@@ -158,9 +412,9 @@ def _check_required_boolean_field(messages, field, dictionary, table_name):
         if value not in ('yes', 'no', None):
             found_value = dictionary[field]
             message_text = '{0} "{1}" field is not an allowed value: {2}.'.format(title_name, field, dumps(found_value))
-            messages.append(('error', message_type, message_text))
+            messages.append(('error', message_type, message_text), index)
 
-def _check_optional_boolean_field(messages, field, dictionary, table_name):
+def _check_optional_boolean_field(messages, field, dictionary, table_name, index=None):
     ''' Find and note missing or badly-typed optional boolean fields.
     '''
     message_type = 'bad-data-' + table_name.replace(' ', '-')
@@ -168,7 +422,7 @@ def _check_optional_boolean_field(messages, field, dictionary, table_name):
     
     if field not in dictionary:
         message_text = 'Optional {0} field "{1}" is missing.'.format(table_name, field)
-        messages.append(('warning', message_type, message_text))
+        messages.append(('warning', message_type, message_text), index)
 
     else:
         value = dictionary[field].lower() if (dictionary[field] is not None) else None
@@ -176,30 +430,38 @@ def _check_optional_boolean_field(messages, field, dictionary, table_name):
         if value not in ('yes', 'no', None):
             found_value = dictionary[field]
             message_text = '{0} "{1}" field is not an allowed value: {2}.'.format(title_name, field, dumps(found_value))
-            messages.append(('error', message_type, message_text))
+            messages.append(('error', message_type, message_text), index)
 
 def check_trail_segments(msgs, path):
     '''
     '''
     starting_count = len(msgs)
+    found = Messages()
     
     try:
-        features = check_geojson_structure(path, ('LineString', 'MultiLineString'))
+        if isinstance(path, SegmentTable):
+            check_table_structure(path, 'trail_segments.geojson', ('LineString', 'MultiLineString'))
+            features = iter(path)
+        else:
+            features = iter_geojson_structure(path, ('LineString', 'MultiLineString'))
+    
+        for (index, feature) in enumerate(features):
+            properties = feature['properties']
+        
+            for f in ('id', 'steward_id'):
+                _check_required_string_field(found, f, properties, 'trail segments', index)
+
+            for f in ('osm_tags', ):
+                _check_optional_string_field(found, f, properties, 'trail segments', index)
+        
+            for f in ('motor_vehicles', 'foot', 'bicycle', 'horse', 'ski', 'wheelchair'):
+                _check_optional_boolean_field(found, f, properties, 'trail segments', index)
+    
     except _VE, e:
         msgs.append(('error', e.type, e.message))
         return
     
-    for feature in features:
-        properties = feature['properties']
-        
-        for f in ('id', 'steward_id'):
-            _check_required_string_field(msgs, f, properties, 'trail segments')
-
-        for f in ('osm_tags', ):
-            _check_optional_string_field(msgs, f, properties, 'trail segments')
-        
-        for f in ('motor_vehicles', 'foot', 'bicycle', 'horse', 'ski', 'wheelchair'):
-            _check_optional_boolean_field(msgs, f, properties, 'trail segments')
+    msgs.extend(found)
     
     if len(msgs) == starting_count:
         msgs.append(('success', 'valid-file-trail-segments', 'Your trail-segments.geojson file looks good.'))
@@ -208,19 +470,23 @@ def check_named_trails(messages, path):
     '''
     '''
     starting_count = len(messages)
+    found = Messages()
     
     try:
-        rows = check_csv_structure(path)
+        rows = iter_csv_structure(path)
+    
+        for (index, row) in enumerate(rows):
+            for field in ('name', 'segment_ids', 'id', 'description'):
+                _check_required_string_field(found, field, row, 'named trails', index)
+
+            for field in ('part_of', ):
+                _check_optional_string_field(found, field, row, 'named trails', index)
+    
     except _VE, e:
         messages.append(('error', e.type, e.message))
         return
     
-    for row in rows:
-        for field in ('name', 'segment_ids', 'id', 'description'):
-            _check_required_string_field(messages, field, row, 'named trails')
-
-        for field in ('part_of', ):
-            _check_optional_string_field(messages, field, row, 'named trails')
+    messages.extend(found)
     
     if len(messages) == starting_count:
         messages.append(('success', 'valid-file-named-trails', 'Your named-trails.csv file looks good.'))
@@ -229,24 +495,28 @@ def check_trailheads(msgs, path):
     '''
     '''
     starting_count = len(msgs)
+    found = Messages()
     
     try:
-        features = check_geojson_structure(path, ('Point', ))
-    except _VE, e:
-        msgs.append(('error', e.type, e.message))
-        return
+        features = iter_geojson_structure(path, ('Point', ))
     
-    for feature in features:
-        properties = feature['properties']
+        for (index, feature) in enumerate(features):
+            properties = feature['properties']
         
-        for field in ('name', 'steward_id'):
-            _check_required_string_field(msgs, field, properties, 'trailheads')
+            for field in ('name', 'steward_id'):
+                _check_required_string_field(found, field, properties, 'trailheads', index)
 
-        for field in ('address', 'trail_ids', 'segment_ids', 'area_id', 'osm_tags'):
-            _check_optional_string_field(msgs, field, properties, 'trailheads')
+            for field in ('address', 'trail_ids', 'segment_ids', 'area_id', 'osm_tags'):
+                _check_optional_string_field(found, field, properties, 'trailheads', index)
         
-        for field in ('parking', 'drinkwater', 'restrooms', 'kiosk'):
-            _check_optional_boolean_field(msgs, field, properties, 'trailheads')
+            for field in ('parking', 'drinkwater', 'restrooms', 'kiosk'):
+                _check_optional_boolean_field(found, field, properties, 'trailheads', index)
+    
+    except _VE, e:
+        msgs.append(('error', e.type, e.message))
+        return
+    
+    msgs.extend(found)
     
     if len(msgs) == starting_count:
         msgs.append(('success', 'valid-file-trailheads', 'Your trailheads.geojson file looks good.'))
@@ -255,19 +525,23 @@ def check_stewards(messages, path):
     '''
     '''
     starting_count = len(messages)
+    found = Messages()
     
     try:
-        rows = check_csv_structure(path)
+        rows = iter_csv_structure(path)
+    
+        for (index, row) in enumerate(rows):
+            for field in ('name', 'id', 'url', 'phone', 'address', 'license'):
+                _check_required_string_field(found, field, row, 'stewards', index)
+
+            for field in ('publisher', ):
+                _check_required_boolean_field(found, field, row, 'stewards', index)
+    
     except _VE, e:
         messages.append(('error', e.type, e.message))
         return
     
-    for row in rows:
-        for field in ('name', 'id', 'url', 'phone', 'address', 'license'):
-            _check_required_string_field(messages, field, row, 'stewards')
-
-        for field in ('publisher', ):
-            _check_required_boolean_field(messages, field, row, 'stewards')
+    messages.extend(found)
     
     if len(messages) == starting_count:
         messages.append(('success', 'valid-file-stewards', 'Your stewards.csv file looks good.'))
@@ -276,21 +550,25 @@ def check_areas(messages, path):
     '''
     '''
     starting_count = len(messages)
+    found = Messages()
     
     try:
-        features = check_geojson_structure(path, ('Polygon', 'MultiPolygon'))
+        features = iter_geojson_structure(path, ('Polygon', 'MultiPolygon'))
+    
+        for (index, feature) in enumerate(features):
+            properties = feature['properties']
+        
+            for field in ('name', 'id', 'steward_id'):
+                _check_required_string_field(found, field, properties, 'areas', index)
+
+            for field in ('url', 'osm_tags'):
+                _check_optional_string_field(found, field, properties, 'areas', index)
+    
     except _VE, e:
         messages.append(('error', e.type, e.message))
         return
     
-    for feature in features:
-        properties = feature['properties']
-        
-        for field in ('name', 'id', 'steward_id'):
-            _check_required_string_field(messages, field, properties, 'areas')
-
-        for field in ('url', 'osm_tags'):
-            _check_optional_string_field(messages, field, properties, 'areas')
+    messages.extend(found)
     
     if len(messages) == starting_count:
         messages.append(('success', 'valid-file-areas', 'Your areas.geojson file looks good.'))